@@ -0,0 +1,43 @@
+from collections.abc import Mapping, Sequence
+from typing import Any
+
+# The generated host documents the benchmarks render and parse, and the
+# traversal that reads every node of one
+
+
+def nested_settings(depth: int, i: int) -> dict:
+    settings = {'weight': i, 'enabled': i % 2 == 0}
+    for level in range(depth):
+        settings = {'level': level, 'label': f'level-{level}', 'nested': settings}
+    return settings
+
+
+def generate_host(i: int, interfaces: int = 4, depth: int = 0, prefix: str = 'host-') -> dict:
+    host = {
+        'name': f'{prefix}{i}',
+        'enabled': i % 2 == 0,
+        'weight': i * 0.5,
+        'interfaces': [
+            {'name': f'eth{j}', 'ip': f'10.{i % 256}.{j}.1', 'port': 8000 + j, 'mtu': 1500}
+            for j in range(interfaces)
+        ],
+        'tags': ['web', 'db', 'cache'],
+    }
+    if depth:
+        host['settings'] = nested_settings(depth, i)
+    return host
+
+
+def generate_document(hosts: int, interfaces: int = 4, depth: int = 0) -> dict:
+    return {'hosts': [generate_host(i, interfaces, depth) for i in range(hosts)]}
+
+
+def traverse(node: Any) -> int:
+    if isinstance(node, str):
+        return 1
+    elif isinstance(node, Mapping):
+        return 1 + sum(traverse(node[key]) for key in node)
+    elif isinstance(node, Sequence):
+        return 1 + sum(traverse(node[i]) for i in range(len(node)))
+    else:
+        return 1
@@ -0,0 +1,89 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from bench_batch import TEMPLATE, generate_workload
+
+# A filter reading a side file per host, with the latency of a network file
+# system or an HTTP lookup
+EXTENSION = '''\
+import asyncio
+from pathlib import Path
+from jinja2.ext import Extension
+
+
+async def side_file(name):
+    await asyncio.sleep({latency})
+    return await asyncio.to_thread(Path('side.txt').read_text)
+
+
+def side_file_sync(name):
+    import time
+    time.sleep({latency})
+    return Path('side.txt').read_text()
+
+
+class SideFileExt(Extension):
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.filters['side_file'] = side_file
+
+
+class SyncSideFileExt(Extension):
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.filters['side_file'] = side_file_sync
+'''
+
+SIDE_FILE_TEMPLATE = TEMPLATE.replace(
+    'server {{ host.name }} {', 'server {{ host.name }} { # {{ host.name | side_file }}')
+
+
+def run(root: Path, template: str, *flags: str) -> float:
+    start = time.perf_counter()
+    subprocess.run([
+        sys.executable, '-m', 'jinja2_toolbox',
+        template,
+        '--data-glob', 'data/*.json',
+        '--output', 'out/{data_stem}.{template_stem}.conf',
+        '--j2_trim_blocks',
+        *flags,
+    ], cwd=root, check=True, env={**os.environ, 'PYTHONPATH': f'{Path(__file__).parent.parent}:{root}'})
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--files', type=int, default=200)
+    ap.add_argument('--hosts', type=int, default=20)
+    ap.add_argument('--latency', type=float, default=0.002)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        generate_workload(root, args.files, args.hosts)
+        (root / 'side_file_ext.py').write_text(EXTENSION.format(latency=args.latency))
+        (root / 'side.txt').write_text('from a side file')
+        (root / 'side.conf.jinja2').write_text(SIDE_FILE_TEMPLATE)
+
+        for template in ('server.conf.jinja2', 'side.conf.jinja2'):
+            runs = (
+                ('sync', ('--j2_extensions', 'side_file_ext.SyncSideFileExt')),
+                *(
+                    (f'async, {jobs} jobs in flight', (
+                        '--j2_enable_async', '--async-jobs', str(jobs),
+                        '--j2_extensions', 'side_file_ext.SideFileExt'))
+                    for jobs in (1, 8, 32)
+                ),
+            )
+            for label, flags in runs:
+                elapsed = run(root, template, *flags)
+                print(f'{template:<20} {label:<26} {elapsed:7.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from _data import generate_host
+
+TEMPLATE = '''\
+{% for host in hosts %}
+server {{ host.name }} {
+{% for iface in host.interfaces %}
+    listen {{ iface.ip }}:{{ iface.port }}; # {{ iface.name | upper }}
+{% endfor %}
+}
+{% endfor %}
+'''
+
+
+def generate_workload(root: Path, files: int, hosts: int) -> None:
+    (root / 'out').mkdir()
+    (root / 'data').mkdir()
+    (root / 'server.conf.jinja2').write_text(TEMPLATE)
+    for i in range(files):
+        (root / 'data' / f'site-{i:04}.json').write_text(json.dumps({
+            'hosts': [generate_host(j, prefix=f'host-{i}-') for j in range(hosts)],
+        }))
+
+
+def run(root: Path, jobs: int) -> float:
+    start = time.perf_counter()
+    subprocess.run([
+        sys.executable, '-m', 'jinja2_toolbox',
+        'server.conf.jinja2',
+        '--data-glob', 'data/*.json',
+        '--output', 'out/{data_stem}.conf',
+        '--jobs', str(jobs),
+        '--j2_trim_blocks',
+    ], cwd=root, check=True, env={**os.environ, 'PYTHONPATH': str(Path(__file__).parent.parent)})
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--files', type=int, default=400)
+    ap.add_argument('--hosts', type=int, default=200)
+    ap.add_argument('--max-jobs', type=int, default=os.cpu_count() or 1)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        generate_workload(root, args.files, args.hosts)
+
+        jobs_counts = sorted({1, *(2 ** i for i in range(8) if 2 ** i <= args.max_jobs), args.max_jobs})
+        serial = None
+        for jobs in jobs_counts:
+            elapsed = run(root, jobs)
+            serial = serial or elapsed
+            print(f'--jobs {jobs:>3}: {elapsed:7.2f} s, {args.files / elapsed:7.1f} files/s, '
+                  f'speedup x{serial / elapsed:.2f}')
+
+
+if __name__ == '__main__':
+    main()
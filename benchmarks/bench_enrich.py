@@ -0,0 +1,69 @@
+import argparse
+import json
+import time
+import timeit
+import tracemalloc
+from typing import Any
+
+from _data import generate_document, traverse
+from jinja2_toolbox.data_proxies import enrich, deplete
+
+
+def measure_node_memory(document: Any) -> float:
+    tracemalloc.start()
+    root = enrich(document, memoize=True)
+    before = tracemalloc.get_traced_memory()[0]
+    nodes = traverse(root)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / nodes
+
+
+def measure_attribute_access() -> dict[str, float]:
+    host = enrich({'name': 'host', 'tags': [1, 2, 3]})
+    proxy = host['tags']
+    number = 200000
+    return {
+        name: min(timeit.repeat(stmt, globals={'p': proxy, 'h': host, 'deplete': deplete},
+                                number=number, repeat=3)) / number * 1e9
+        for name, stmt in (
+            ('.parent', 'p.parent'),
+            ('.depleted', 'p.depleted'),
+            ('len()', 'len(p)'),
+            ('str()', 'str(p)'),
+            ('.count', 'p.count'),
+            ('isinstance', 'isinstance(p, list)'),
+            ('jinja .name', 'try:\n getattr(h, "name")\nexcept AttributeError:\n h["name"]'),
+        )
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--hosts', type=int, default=2000)
+    ap.add_argument('--repeat', type=int, default=3)
+    ap.add_argument('--passes', type=int, default=1,
+                    help='Traverse the same enriched document this many times')
+    ap.add_argument('--memoize', action='store_true')
+    args = ap.parse_args()
+
+    # Parsed back, as a data file would be
+    document = json.loads(json.dumps(generate_document(args.hosts)))
+
+    best = float('inf')
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        root = enrich(document, memoize=args.memoize)
+        for _ in range(args.passes):
+            nodes = traverse(root)
+        best = min(best, time.perf_counter() - start)
+
+    print(f'enrich+traverse x{args.passes}: {nodes} nodes in {best * 1000:.1f} ms '
+          f'({best / nodes / args.passes * 1e6:.2f} us/node)')
+    print(f'memory per memoized node: {measure_node_memory(document):.0f} bytes')
+    for name, ns in measure_attribute_access().items():
+        print(f'{name:>12}: {ns:.0f} ns')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import time
+from jinja2 import Environment, StrictUndefined
+from jinja2_toolbox.data_proxies import enrich
+from jinja2_toolbox.query import index_by
+from jinja2_toolbox.render_scope import render_scope
+
+NESTED_LOOPS = '''\
+{% for service in services %}{% for host in hosts if host.name == service.host %}\
+{{ service.name }} {{ host.ip }}
+{% endfor %}{% endfor %}'''
+
+INDEXED = '''\
+{% for service in services %}{% set host = (hosts | index_by('name'))[service.host] %}\
+{{ service.name }} {{ host.ip }}
+{% endfor %}'''
+
+
+def generate_data(hosts: int) -> dict:
+    return {
+        'hosts': [{'name': f'host-{i}', 'ip': f'10.{i // 256 % 256}.{i % 256}.1'} for i in range(hosts)],
+        'services': [{'name': f'service-{i}', 'host': f'host-{i * 7 % hosts}'} for i in range(hosts)],
+    }
+
+
+def measure(template, context) -> float:
+    start = time.perf_counter()
+    with render_scope():
+        template.render(**context)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--sizes', type=int, nargs='+', default=[1000, 2500, 10000])
+    args = ap.parse_args()
+
+    env = Environment(undefined=StrictUndefined)
+    env.filters['index_by'] = index_by
+    nested, indexed = env.from_string(NESTED_LOOPS), env.from_string(INDEXED)
+
+    for size in args.sizes:
+        data = generate_data(size)
+        for label, context in (('raw', data), ('enriched', enrich(data))):
+            with render_scope():
+                assert nested.render(**context) == indexed.render(**context)
+            nested_time, indexed_time = measure(nested, context), measure(indexed, context)
+            print(f'{size:>6} hosts, {label:>8}: nested loops {nested_time * 1000:9.1f} ms, '
+                  f'index_by {indexed_time * 1000:7.1f} ms ({nested_time / indexed_time:.0f}x)')
+
+
+if __name__ == '__main__':
+    main()
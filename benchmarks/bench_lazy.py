@@ -0,0 +1,59 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from _data import generate_host
+
+PACKAGE_ROOT = str(Path(__file__).parent.parent)
+
+TEMPLATE = '''\
+{% for host in hosts %}{% if host.enabled %}{{ host.name }} {{ host.interfaces[0].ip }}
+{% endif %}{% endfor %}'''
+
+
+def write_data(path: Path, hosts: int) -> None:
+    # Written item by item, the dataset would not fit in memory otherwise
+    with path.open('w') as f:
+        f.write('{"meta": {"version": 1}, "hosts": [')
+        for i in range(hosts):
+            f.write((',' if i else '') + json.dumps(generate_host(i)))
+        f.write(']}')
+
+
+def render(cwd: str, *flags: str) -> tuple[float, float]:
+    # Each render runs in its own process for its peak RSS to be its own
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, '-m', 'jinja2_toolbox', 'template.jinja2', '--data', 'data.json',
+         '--output', os.devnull, '--stream', *flags],
+        cwd=cwd, check=True, env={**os.environ, 'PYTHONPATH': PACKAGE_ROOT})
+    elapsed = time.perf_counter() - start
+    return elapsed, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--hosts', type=int, default=300000)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        Path(tmp, 'template.jinja2').write_text(TEMPLATE)
+        write_data(Path(tmp, 'data.json'), args.hosts)
+        size = Path(tmp, 'data.json').stat().st_size / 2**20
+
+        # RUSAGE_CHILDREN reports the largest child so far, the lazy render
+        # goes first
+        for label, flags in (('lazy', ('--lazy-data',)), ('eager', ())):
+            elapsed, peak = render(tmp, *flags)
+            print(f'{args.hosts} hosts ({size:.0f} MiB), {label:>5}: '
+                  f'{elapsed * 1000:8.0f} ms, peak RSS {peak:7.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import argparse
+import io
+import json
+import time
+
+import toml
+import yaml
+
+from _data import generate_document
+from jinja2_toolbox.json_provider import JsonProvider
+from jinja2_toolbox.toml_provider import TomlProvider
+from jinja2_toolbox.yaml_provider import YamlProvider
+
+
+def time_load(provider: object, text: str, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        provider.load(io.StringIO(text))
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--hosts', type=int, default=5000)
+    ap.add_argument('--repeat', type=int, default=3)
+    args = ap.parse_args()
+
+    document = generate_document(args.hosts)
+    sources = (
+        (JsonProvider, json.dumps(document)),
+        (YamlProvider, yaml.safe_dump(document)),
+        (TomlProvider, toml.dumps(document)),
+    )
+
+    for provider, text in sources:
+        size = len(text.encode()) / 2 ** 20
+        timings = {
+            backend: time_load(provider([backend]), text, args.repeat)
+            for backend, available in provider.BACKENDS.items()
+            if available()
+        }
+        slowest = max(timings.values())
+        for backend, elapsed in timings.items():
+            print(f'{provider.__name__:>12} {backend:>8}: {size:6.2f} MB in {elapsed * 1000:8.1f} ms '
+                  f'(x{slowest / elapsed:.1f})')
+
+
+if __name__ == '__main__':
+    main()
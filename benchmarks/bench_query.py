@@ -0,0 +1,61 @@
+import argparse
+import statistics
+import time
+from jinja2 import Environment, StrictUndefined
+from _data import generate_document
+from jinja2_toolbox.data_proxies import enrich
+from jinja2_toolbox.query import query
+
+LOOPS = '''\
+{% for name, host in hosts.items() %}{% for iface in host.interfaces %}{{ iface.ip }}
+{% endfor %}{% endfor %}'''
+
+# Iterating an enriched container yields raw values, templates that need
+# `.parent` on the results index the containers instead
+ENRICHED_LOOPS = '''\
+{% for name in hosts %}{% set interfaces = hosts[name].interfaces %}\
+{% for i in range(interfaces | length) %}{{ interfaces[i].ip }}
+{% endfor %}{% endfor %}'''
+
+QUERY = '''\
+{% for ip in hosts | query('*.interfaces[*].ip') %}{{ ip }}
+{% endfor %}'''
+
+
+def generate_data(hosts: int, interfaces: int) -> dict:
+    # Hosts by name
+    return {'hosts': {host['name']: host for host in generate_document(hosts, interfaces)['hosts']}}
+
+
+def measure(template, context, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        template.render(**context)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--hosts', type=int, default=10000)
+    ap.add_argument('--interfaces', type=int, default=4)
+    ap.add_argument('--repeat', type=int, default=5)
+    args = ap.parse_args()
+
+    env = Environment(undefined=StrictUndefined)
+    env.filters['query'] = query
+    queried = env.from_string(QUERY)
+
+    data = generate_data(args.hosts, args.interfaces)
+    for label, loops, context in (('raw', env.from_string(LOOPS), data),
+                                  ('enriched', env.from_string(ENRICHED_LOOPS), enrich(data))):
+        assert loops.render(**context) == queried.render(**context)
+        loops_time = measure(loops, context, args.repeat)
+        query_time = measure(queried, context, args.repeat)
+        print(f'{label:>8}: nested loops {loops_time * 1000:8.1f} ms, '
+              f'query {query_time * 1000:8.1f} ms ({loops_time / query_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import toml
+import yaml
+
+from _data import generate_document
+from jinja2_toolbox.cli import get_provider
+
+PACKAGE_ROOT = str(Path(__file__).parent.parent)
+
+# Peak RSS of one parse, in a fresh process. The peak is reset once the
+# provider and its parser are imported (Linux only), the growth is the
+# memory the parse itself takes. Modes:
+#   read   read_data() without a cache
+#   cache  a --data-cache miss, hashed and parsed from the mapped file
+#   copy   the same miss from the raw bytes and a decoded copy of them
+SCRIPT = '''\
+import io, sys, tempfile
+from pathlib import Path
+from jinja2_toolbox.cli import get_provider, read_data
+from jinja2_toolbox.data_cache import DataCache
+
+def peak():
+    status = Path('/proc/self/status').read_text()
+    return int(status.split('VmHWM:')[1].split()[0])
+
+path, data_type, backend, mode = sys.argv[1:]
+provider = get_provider(data_type)((backend,))
+provider.load_buffer(b'{}' if data_type == 'json' else b'')
+Path('/proc/self/clear_refs').write_text('5')
+before = peak()
+if mode == 'read':
+    data = read_data(path, data_type, (backend,))
+elif mode == 'cache':
+    with tempfile.TemporaryDirectory() as cache_dir:
+        data = read_data(path, data_type, (backend,), cache_dir)
+else:
+    with tempfile.TemporaryDirectory() as cache_dir:
+        raw = Path(path).read_bytes()
+        data = DataCache(cache_dir).load(
+            raw, data_type, backend, lambda: provider.load(io.TextIOWrapper(io.BytesIO(raw), encoding='utf-8')))
+print(before, peak())
+'''
+
+
+def peak_rss(path: Path, data_type: str, backend: str, mode: str) -> tuple[float, float]:
+    out = subprocess.run(
+        [sys.executable, '-c', SCRIPT, str(path), data_type, backend, mode],
+        capture_output=True, text=True, check=True, env={**os.environ, 'PYTHONPATH': PACKAGE_ROOT}).stdout
+    before, after = map(int, out.split())
+    return after / 1024, (after - before) / 1024
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--hosts', type=int, default=10000)
+    ap.add_argument('--formats', nargs='+', choices=('json', 'yaml', 'toml'), default=['json', 'yaml', 'toml'])
+    args = ap.parse_args()
+
+    document = generate_document(args.hosts)
+    serializers = {'json': json.dumps, 'yaml': yaml.safe_dump, 'toml': toml.dumps}
+    sources = {data_type: serializers[data_type](document) for data_type in args.formats}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for data_type, text in sources.items():
+            path = Path(tmp, f'data.{data_type}')
+            path.write_text(text)
+            size = path.stat().st_size / 2**20
+            for backend, available in get_provider(data_type).BACKENDS.items():
+                if not available():
+                    continue
+                for mode in ('read', 'cache', 'copy'):
+                    peak, growth = peak_rss(path, data_type, backend, mode)
+                    print(f'{data_type:>4} {backend:>8} {size:6.1f} MiB, {mode:>6}: '
+                          f'peak RSS {peak:7.1f} MiB (+{growth:6.1f} MiB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from jinja2_toolbox.client import request_render  # noqa: E402
+
+PACKAGE_ROOT = str(Path(__file__).parent.parent)
+ENV = {**os.environ, 'PYTHONPATH': PACKAGE_ROOT}
+
+TEMPLATE = '''\
+{% for host in hosts %}
+{{ host.name }} {{ host.ip }}
+{% endfor %}
+'''
+
+
+def median_ms(samples: list[float]) -> str:
+    return f'median {statistics.median(samples) * 1000:7.2f} ms, min {min(samples) * 1000:7.2f} ms'
+
+
+def timed(runs: int, action) -> list[float]:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        action()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--runs', type=int, default=20)
+    ap.add_argument('--hosts', type=int, default=100)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        (root / 'hosts.conf.jinja2').write_text(TEMPLATE)
+        (root / 'data.json').write_text(json.dumps({
+            'hosts': [{'name': f'host-{i}', 'ip': f'10.0.{i // 256}.{i % 256}'} for i in range(args.hosts)]
+        }))
+        socket_path = str(root / 'render.sock')
+
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'jinja2_toolbox', 'serve', '--socket', socket_path,
+             '--template-dir', tmp, '--j2_trim_blocks'], env=ENV)
+        try:
+            while not os.path.exists(socket_path):
+                time.sleep(0.01)
+
+            cli = timed(args.runs, lambda: subprocess.run(
+                [sys.executable, '-m', 'jinja2_toolbox', 'hosts.conf.jinja2', '--data', 'data.json',
+                 '--template-dir', tmp, '--j2_trim_blocks'],
+                cwd=tmp, env=ENV, check=True, capture_output=True))
+            client = timed(args.runs, lambda: subprocess.run(
+                [sys.executable, '-m', 'jinja2_toolbox.client', 'hosts.conf.jinja2',
+                 '--socket', socket_path, '--data', 'data.json'],
+                cwd=tmp, env=ENV, check=True, capture_output=True))
+            in_process = timed(args.runs, lambda: ''.join(request_render(
+                socket_path, 'hosts.conf.jinja2', data=str(root / 'data.json'))))
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f'jinja2-toolbox CLI:        {median_ms(cli)}')
+    print(f'client process:            {median_ms(client)}')
+    print(f'server round trip:         {median_ms(in_process)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PACKAGE_ROOT = str(Path(__file__).parent.parent)
+
+
+def run(cwd: str, *python_args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *python_args, '-m', 'jinja2_toolbox', 'template.jinja2', '--data', 'data.json'],
+        cwd=cwd, capture_output=True, text=True, check=True,
+        env={**os.environ, 'PYTHONPATH': PACKAGE_ROOT})
+
+
+def import_times(stderr: str) -> dict[str, int]:
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _self, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--runs', type=int, default=20)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        Path(tmp, 'template.jinja2').write_text('{{ x }}')
+        Path(tmp, 'data.json').write_text('{"x": 1}')
+
+        wall_times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            run(tmp)
+            wall_times.append(time.perf_counter() - start)
+
+        times = import_times(run(tmp, '-X', 'importtime').stderr)
+
+    print(f'render json: median {statistics.median(wall_times) * 1000:.1f} ms, '
+          f'min {min(wall_times) * 1000:.1f} ms over {args.runs} runs')
+    for module in ('jinja2_toolbox.cli', 'jinja2', 'yaml', 'toml', 'concurrent.futures'):
+        if module in times:
+            print(f'import {module}: {times[module] / 1000:.1f} ms')
+        else:
+            print(f'import {module}: not imported')
+
+
+if __name__ == '__main__':
+    main()
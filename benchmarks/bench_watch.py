@@ -0,0 +1,77 @@
+import argparse
+import io
+import os
+import tempfile
+import time
+from pathlib import Path
+from jinja2_toolbox.batch import RenderJob, run_jobs
+from jinja2_toolbox.cli import (add_data_args, add_environment_args, add_render_args, environment_from_args,
+                                 load_context, render_job)
+from jinja2_toolbox.watch import Watcher
+
+
+def generate_tree(root: Path, templates: int, partials: int) -> list[RenderJob]:
+    (root / 'data.json').write_text('{"x": 1}')
+    (root / 'base.jinja2').write_text('{% block body %}{% endblock %}\n')
+    for i in range(partials):
+        (root / f'partial-{i}.jinja2').write_text(f'partial {i} {{{{ x }}}}')
+
+    jobs = []
+    for i in range(templates):
+        (root / f'page-{i}.jinja2').write_text(
+            '{% extends "base.jinja2" %}{% block body %}'
+            f'{{% include "partial-{i % partials}.jinja2" %}}{{% endblock %}}')
+        jobs.append(RenderJob(f'page-{i}.jinja2', 'data.json', f'out/page-{i}.txt'))
+    return jobs
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--templates', type=int, default=500)
+    ap.add_argument('--partials', type=int, default=50)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        os.chdir(root)
+        (root / 'out').mkdir()
+        jobs = generate_tree(root, args.templates, args.partials)
+
+        render_ap = argparse.ArgumentParser()
+        add_render_args(render_ap)
+        add_data_args(render_ap)
+        add_environment_args(render_ap)
+        render_args = render_ap.parse_args([])
+        env = environment_from_args(render_args)
+
+        def render_jobs(jobs):
+            return run_jobs(jobs, lambda job, stdout: render_job(env, job, render_args, load_context, stdout),
+                            io.StringIO())
+
+        start = time.perf_counter()
+        watcher = Watcher(env, jobs, render_jobs, io.StringIO())
+        print(f'dependency graph of {len(watcher.watched_files())} files: '
+              f'{(time.perf_counter() - start) * 1000:.1f} ms')
+
+        start = time.perf_counter()
+        watcher.render(jobs)
+        print(f'full render of {len(jobs)} templates: {(time.perf_counter() - start) * 1000:.1f} ms')
+
+        start = time.perf_counter()
+        for _ in range(100):
+            watcher.poll()
+        print(f'poll: {(time.perf_counter() - start) * 10:.2f} ms')
+
+        partial = root / 'partial-0.jinja2'
+        partial.write_text('changed {{ x }}')
+        mtime = partial.stat().st_mtime_ns + 10**9
+        os.utime(partial, ns=(mtime, mtime))
+
+        start = time.perf_counter()
+        rendered = watcher.step(watcher.poll())
+        print(f'partial change, {len(rendered)} templates re-rendered: '
+              f'{(time.perf_counter() - start) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
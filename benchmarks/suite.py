@@ -0,0 +1,212 @@
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+import jinja2
+from _data import generate_document, traverse
+from jinja2_toolbox.cli import DATA_PROVIDERS, get_provider, make_environment
+from jinja2_toolbox.data_proxies import enrich
+from jinja2_toolbox.output import buffered
+
+# Every stage of a render, measured on generated datasets of increasing size
+# and depth. The results can be saved as a baseline and later runs compared
+# against it, see the bench and bench-baseline recipes of the justfile.
+
+DATASETS = {
+    'small': {'hosts': 100, 'depth': 2},
+    'medium': {'hosts': 1000, 'depth': 4},
+    'large': {'hosts': 5000, 'depth': 6},
+}
+
+# Iterating an enriched list yields its raw items, the loops index the
+# lists instead so that render/enriched goes through the proxies all the way
+TEMPLATE = '''\
+{% macro weight(settings) %}
+{% if 'nested' in settings %}{{ weight(settings.nested) }}{% else %}{{ settings.weight }}{% endif %}
+{% endmacro %}
+{% for i in range(hosts | length) %}{% set host = hosts[i] %}
+server {{ host.name }} {
+{% for j in range(host.interfaces | length) %}{% set iface = host.interfaces[j] %}
+    listen {{ iface.ip }}:{{ iface.port }}; # {{ iface.name | upper }}
+{% endfor %}
+{% for k in range(host.tags | length) if host.tags[k] != 'cache' %}
+    # {{ host.tags[k] }}
+{% endfor %}
+    weight {{ weight(host.settings) }};
+}
+{% endfor %}
+'''
+
+# Data format -> the name of its load stages, the last alias of its
+# provider: yml and yaml are both `load/yaml/...`
+FORMATS = {
+    data_type: [other for other, path in DATA_PROVIDERS.items() if path == provider_path][-1]
+    for data_type, provider_path in DATA_PROVIDERS.items()
+}
+
+
+def serialize(data: Any, data_type: str) -> bytes:
+    if data_type == 'json':
+        return json.dumps(data).encode()
+    elif data_type in ('yml', 'yaml'):
+        import yaml
+        return yaml.safe_dump(data).encode()
+    elif data_type == 'toml':
+        import toml
+        return toml.dumps(data).encode()
+    else:
+        from jinja2_toolbox.snapshot import write_snapshot
+        f = io.BytesIO()
+        write_snapshot(f, data, {'path': '<benchmark>', 'size': 0, 'mtime_ns': 0, 'sha256': ''})
+        return f.getvalue()
+
+
+def measure(run: Callable[[], Any], repeat: int) -> dict:
+    # The memory is measured in a separate run, tracemalloc slows the measured
+    # code down. That run also warms up the lazy imports and caches.
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    return {'time': statistics.median(timings), 'peak_memory': peak}
+
+
+def loaders() -> list[tuple[str, str]]:
+    # One entry per provider and backend available here, e.g. ('yaml', 'libyaml')
+    entries = []
+    for data_type in dict.fromkeys(FORMATS.values()):
+        for backend, available in get_provider(data_type).BACKENDS.items():
+            if available():
+                entries.append((data_type, backend))
+    return entries
+
+
+def stage_prefix(prefix: str) -> str:
+    # Any alias of a format selects its load stages
+    parts = prefix.split('/')
+    if len(parts) > 1 and parts[0] == 'load' and parts[1] in FORMATS:
+        parts[1] = FORMATS[parts[1]]
+    return '/'.join(parts)
+
+
+def benchmark_dataset(name: str, hosts: int, depth: int, repeat: int,
+                      skip: tuple[str, ...]) -> dict[str, dict]:
+    data = generate_document(hosts, depth=depth)
+    results = {}
+
+    def run(stage: str, func: Callable[[], Any]) -> None:
+        if any(stage.startswith(prefix) for prefix in skip):
+            return
+        results[f'{name}/{stage}'] = measure(func, repeat)
+        result = results[f'{name}/{stage}']
+        print(f'{name}/{stage:<28} {result["time"] * 1e3:10.2f} ms '
+              f'{result["peak_memory"] / 2**20:10.2f} MiB', flush=True)
+
+    for data_type, backend in loaders():
+        try:
+            raw = serialize(data, data_type)
+        except ImportError:
+            continue
+        provider = get_provider(data_type)((backend,))
+        # dict() decodes the lazily loaded values too
+        run(f'load/{data_type}/{backend}', lambda: dict(provider.load_buffer(raw)))
+
+    run('enrich/construct', lambda: enrich(data))
+    run('enrich/traverse', lambda: traverse(enrich(data)))
+    run('enrich/traverse-memoized', lambda: traverse(enrich(data, memoize=True)))
+
+    run('environment', lambda: make_environment('.', {'trim_blocks': True}))
+    env = make_environment('.', {'trim_blocks': True})
+    run('compile', lambda: env.from_string(TEMPLATE))
+
+    template = env.from_string(TEMPLATE)
+    run('render', lambda: template.render(**data))
+    run('render/enriched', lambda: template.render(**enrich(data)))
+
+    with open(os.devnull, 'w') as sink:
+        run('stream', lambda: sink.writelines(buffered(template.generate(**data), 256)))
+
+    return results
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float) -> int:
+    regressions = 0
+    print(f'\n{"benchmark":<38} {"time":>8} {"memory":>8}')
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+
+        ratios = {
+            metric: result[metric] / reference[metric] if reference[metric] else 1.0
+            for metric in ('time', 'peak_memory')
+        }
+        regressed = [metric for metric, ratio in ratios.items() if ratio > threshold]
+        regressions += bool(regressed)
+        print(f'{name:<38} {ratios["time"]:7.2f}x {ratios["peak_memory"]:7.2f}x'
+              + ('  REGRESSION' if regressed else ''))
+
+    return regressions
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--datasets', nargs='+', choices=tuple(DATASETS), default=list(DATASETS))
+    ap.add_argument('--repeat', type=int, default=3)
+    ap.add_argument('--skip', nargs='+', default=[],
+                    help='Skip the stages starting with these prefixes, e.g. load/yaml/pyyaml or render')
+    ap.add_argument('--save', metavar='PATH', help='Save the results, e.g. as the new baseline')
+    ap.add_argument('--baseline', metavar='PATH', help='Compare the results with a saved run')
+    ap.add_argument('--threshold', type=float, default=1.25,
+                    help='Time or memory ratio to the baseline above which a benchmark regressed')
+    args = ap.parse_args()
+
+    results = {}
+    for name in args.datasets:
+        results.update(benchmark_dataset(name, **DATASETS[name], repeat=args.repeat,
+                                         skip=tuple(map(stage_prefix, args.skip))))
+
+    if args.save:
+        Path(args.save).write_text(json.dumps({
+            'machine': {
+                'python': platform.python_version(),
+                'jinja2': jinja2.__version__,
+                'platform': platform.platform(),
+            },
+            'results': results,
+        }, indent=2))
+
+    if args.baseline:
+        if not Path(args.baseline).exists():
+            print(f'\nNo baseline at {args.baseline}, run `just bench-baseline` first')
+            return
+
+        baseline = json.loads(Path(args.baseline).read_text())['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'\n{regressions} benchmarks regressed by more than {args.threshold:.2f}x')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
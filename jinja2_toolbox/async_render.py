@@ -0,0 +1,193 @@
+from collections import OrderedDict
+from jinja2 import Environment
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator, Optional, TextIO
+from .batch import JobResult, RenderJob
+from .metrics import counted_output, counted_output_async, measured, measured_render, metrics_to_file
+from .output import buffered_async, write_output
+from .profiling import Profiler, profiled
+from .render_scope import render_scope
+import argparse
+import asyncio
+import io
+import queue
+
+# Batch rendering on an event loop, for environments created with
+# --j2_enable_async. Several jobs are in flight at once: while one renders,
+# the next ones read their data files and the previous ones write their
+# outputs, both in worker threads, and a job awaiting an async filter lets
+# the others render meanwhile.
+
+AsyncJobRenderer = Callable[[RenderJob, TextIO], Awaitable[None]]
+
+
+class AsyncContextLoader:
+    # Parsed data shared by the jobs in flight. Jobs are ordered data-major,
+    # so the ones running together mostly share their data files.
+    def __init__(self, load_context: Callable[..., Any], max_entries: int) -> None:
+        self.load_context = load_context
+        self.max_entries = max_entries
+        self._tasks: OrderedDict[tuple, asyncio.Future] = OrderedDict()
+
+    def __call__(self, *args: Any) -> Awaitable[Any]:
+        task = self._tasks.get(args)
+        if task is None:
+            task = self._tasks[args] = asyncio.ensure_future(
+                asyncio.to_thread(self.load_context, *args))
+            while len(self._tasks) > self.max_entries:
+                self._tasks.popitem(last=False)
+        else:
+            self._tasks.move_to_end(args)
+        return task
+
+
+# Chunks waiting for the writer thread: a slow reader (a pipe, a slow disk)
+# holds the render back instead of the output piling up in memory
+_HANDOVER_CHUNKS = 16
+# Seconds a blocked handover waits before checking that the writer is alive
+_HANDOVER_POLL = 0.1
+
+
+def _handed_over(handover: queue.Queue) -> Iterator[str]:
+    # Ends with None, or with the render error for write_output to discard
+    # its partial output as it would for a failing generator
+    while True:
+        chunk = handover.get()
+        if chunk is None:
+            return
+        elif isinstance(chunk, BaseException):
+            raise chunk
+        yield chunk
+
+
+def _put(handover: queue.Queue, item: Any) -> bool:
+    try:
+        handover.put(item, timeout=_HANDOVER_POLL)
+    except queue.Full:
+        return False
+    return True
+
+
+async def _hand_over(handover: queue.Queue, item: Any, writer: asyncio.Future) -> bool:
+    # False once the writer failed, it takes no more chunks then
+    try:
+        handover.put_nowait(item)
+        return True
+    except queue.Full:
+        pass
+    # The writer is behind, waited for in a thread
+    while not writer.done():
+        if await asyncio.to_thread(_put, handover, item):
+            return True
+    return False
+
+
+async def stream_output(output: str, chunks: AsyncIterator[str], stdout: TextIO,
+                        buffer_size: int, atomic: bool) -> None:
+    # The chunks are handed over to a thread running the usual write_output,
+    # the loop never waits for the disk
+    handover: queue.Queue = queue.Queue(maxsize=_HANDOVER_CHUNKS)
+    writer = asyncio.ensure_future(asyncio.to_thread(
+        write_output, output, _handed_over(handover), stdout, flush=True, atomic=atomic))
+    # Starts the writer thread now: a template calling only sync filters never
+    # gives the loop a chance to until it is done rendering
+    await asyncio.sleep(0)
+    try:
+        async for chunk in buffered_async(chunks, max(buffer_size, 1)):
+            # Failed, its error is raised below
+            if writer.done() or not await _hand_over(handover, chunk, writer):
+                break
+    except BaseException as e:
+        await _hand_over(handover, e, writer)
+        await asyncio.gather(writer, return_exceptions=True)
+        raise
+
+    await _hand_over(handover, None, writer)
+    await writer
+
+
+async def render_to_async(env: Environment, job: RenderJob, output: str, atomic: bool,
+                          args: argparse.Namespace, context_loader: Callable[..., Awaitable[Any]],
+                          stdout: TextIO, profiler: Optional[Profiler] = None) -> None:
+    template_context = await context_loader(
+        job.data, job.data_format or args.data_format, args.enrich, args.enrich_memoize,
+        tuple(args.data_backend), args.data_cache, args.lazy_data, profiler)
+    with profiled(profiler, 'stage', 'load template'), measured('template_load_seconds'):
+        template = env.get_template(job.template)
+
+    with render_scope(), profiled(profiler, 'stage', 'render'), measured_render():
+        if args.stream:
+            await stream_output(output, counted_output_async(template.generate_async(**template_context)),
+                                stdout, args.stream_buffer, atomic)
+        else:
+            text = await template.render_async(**template_context)
+            chunks = counted_output((text,))
+            await asyncio.to_thread(write_output, output, chunks, stdout, atomic=atomic)
+
+
+async def render_job_async(env: Environment, job: RenderJob, args: argparse.Namespace,
+                           context_loader: Callable[..., Awaitable[Any]], stdout: TextIO,
+                           profiler: Optional[Profiler] = None) -> None:
+    # Same --render-cache and --metrics-file handling as render_job, the
+    # files are hashed and copied in threads
+    with metrics_to_file(args.metrics_file, kind='job', template=job.template,
+                         data_files=list(job.data_files), output=job.output,
+                         templates_compiled=0) as metrics:
+        if args.render_cache:
+            from .render_cache import render_cache_for
+
+            cache = render_cache_for(env, args)
+            with profiled(profiler, 'stage', 'render cache'):
+                key = await asyncio.to_thread(cache.key, job, args)
+                if key is not None and await asyncio.to_thread(
+                        cache.fetch, key, job.output, stdout, args.atomic_output):
+                    return
+            if key is not None:
+                if metrics is not None:
+                    metrics['render_cache'] = 'miss'
+                with cache.new_entry(key) as path:
+                    await render_to_async(env, job, str(path), False, args, context_loader, stdout,
+                                          profiler)
+                if await asyncio.to_thread(cache.fetch, key, job.output, stdout, args.atomic_output,
+                                           False):
+                    return
+
+        await render_to_async(env, job, job.output, args.atomic_output, args, context_loader, stdout,
+                              profiler)
+
+
+async def _run_job_async(job: RenderJob, render: AsyncJobRenderer, stdout: TextIO,
+                         slots: asyncio.Semaphore) -> JobResult:
+    async with slots:
+        try:
+            await render(job, stdout)
+            return JobResult(job)
+        except Exception as e:
+            return JobResult(job, f'{type(e).__name__}: {e}')
+
+
+async def run_jobs_async(jobs: Iterable[RenderJob], render: AsyncJobRenderer, stdout: TextIO,
+                         concurrency: int) -> list[JobResult]:
+    # stdout jobs are captured and written in the job order, as they finish
+    slots = asyncio.Semaphore(max(concurrency, 1))
+    captured = []
+    tasks = []
+    for job in jobs:
+        captured.append(io.StringIO())
+        tasks.append(asyncio.ensure_future(_run_job_async(job, render, captured[-1], slots)))
+
+    results = []
+    for task, output in zip(tasks, captured):
+        results.append(await task)
+        stdout.write(output.getvalue())
+    return results
+
+
+def run_batch_async(jobs: list[RenderJob], args: argparse.Namespace, env: Environment,
+                    load_context: Callable[..., Any], concurrency: int, stdout: TextIO,
+                    profiler: Optional[Profiler] = None) -> list[JobResult]:
+    context_loader = AsyncContextLoader(load_context, concurrency)
+
+    def render(job: RenderJob, stdout: TextIO) -> Awaitable[None]:
+        return render_job_async(env, job, args, context_loader, stdout, profiler)
+
+    return asyncio.run(run_jobs_async(jobs, render, stdout, concurrency))
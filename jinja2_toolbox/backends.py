@@ -0,0 +1,24 @@
+from typing import Callable, Iterable
+import importlib.util
+
+
+def module_available(name: str) -> Callable[[], bool]:
+    return lambda: importlib.util.find_spec(name) is not None
+
+
+def select_backend(data_type: str, backends: dict[str, Callable[[], bool]],
+                   overrides: Iterable[str] = ()) -> str:
+    # Every provider only looks at the overrides naming one of its backends,
+    # so a single list of overrides may cover several data formats
+    for name in overrides:
+        if name in backends:
+            if not backends[name]():
+                raise RuntimeError(f'The {name} backend for {data_type} data is not available')
+            return name
+
+    # Backends are listed from the fastest to the slowest one
+    for name, available in backends.items():
+        if available():
+            return name
+
+    raise RuntimeError(f'No backend available for {data_type} data')
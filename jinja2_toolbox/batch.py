@@ -0,0 +1,138 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional, TextIO, Union
+import glob
+import io
+
+
+@dataclass
+class RenderJob:
+    template: str
+    # Several data files are merged in order
+    data: Union[str, tuple[str, ...]]
+    output: str = '-'
+    data_format: Optional[str] = None
+
+    @property
+    def data_files(self) -> tuple[str, ...]:
+        return (self.data,) if isinstance(self.data, str) else self.data
+
+
+@dataclass
+class JobResult:
+    job: RenderJob
+    error: Optional[str] = None
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+
+def parse_manifest(manifest: Any) -> list[RenderJob]:
+    # TOML can't express a top-level array, so `jobs = [...]` is accepted too
+    if isinstance(manifest, dict):
+        manifest = manifest.get('jobs')
+
+    if not isinstance(manifest, list):
+        raise RuntimeError('The manifest must be a list of jobs or contain a "jobs" list')
+
+    jobs = []
+    for i, entry in enumerate(manifest):
+        if not isinstance(entry, dict) or 'template' not in entry or 'data' not in entry:
+            raise RuntimeError(
+                f'Manifest job #{i} must be a mapping with "template" and "data" keys')
+
+        unknown = set(entry.keys()) - {'template', 'data', 'output', 'data_format'}
+        if unknown:
+            raise RuntimeError(
+                f'Manifest job #{i} has unknown keys: {", ".join(sorted(unknown))}')
+
+        if isinstance(entry['data'], list):
+            # Hashable, consecutive jobs with the same data files share their parsed data
+            entry = {**entry, 'data': tuple(entry['data'])}
+
+        jobs.append(RenderJob(**entry))
+
+    return jobs
+
+
+def expand_matrix(templates: Iterable[str], data_glob: str, output_pattern: str) -> list[RenderJob]:
+    data_files = sorted(glob.glob(data_glob, recursive=True))
+    if not data_files:
+        raise RuntimeError(f'No data files match {data_glob}')
+
+    # Jobs are ordered data-major, so consecutive jobs share their data file
+    return [
+        RenderJob(
+            template=template,
+            data=data,
+            output=output_pattern if output_pattern == '-' else output_pattern.format(
+                template=template,
+                template_stem=Path(template).name.split('.')[0],
+                data=data,
+                data_stem=Path(data).name.split('.')[0],
+            ),
+        )
+        for data in data_files
+        for template in templates
+    ]
+
+
+JobRenderer = Callable[[RenderJob, TextIO], None]
+
+
+def run_job(job: RenderJob, render: JobRenderer, stdout: TextIO) -> JobResult:
+    try:
+        render(job, stdout)
+        return JobResult(job)
+    except Exception as e:
+        return JobResult(job, f'{type(e).__name__}: {e}')
+
+
+def run_jobs(jobs: Iterable[RenderJob], render: JobRenderer, stdout: TextIO) -> list[JobResult]:
+    return [run_job(job, render, stdout) for job in jobs]
+
+
+# Per worker process renderer, built once by the pool initializer
+_worker_render: Optional[JobRenderer] = None
+
+
+def _init_worker(make_renderer: Callable[..., JobRenderer], *args: Any) -> None:
+    global _worker_render
+    _worker_render = make_renderer(*args)
+
+
+def _run_worker_job(job: RenderJob) -> tuple[JobResult, str]:
+    # stdout jobs are captured and written by the parent in the job order
+    stdout = io.StringIO()
+    return run_job(job, _worker_render, stdout), stdout.getvalue()
+
+
+def run_jobs_parallel(jobs: list[RenderJob], workers: int, stdout: TextIO,
+                      make_renderer: Callable[..., JobRenderer], *args: Any) -> list[JobResult]:
+    # Imported here, it's a costly import that serial runs never need
+    from concurrent.futures import ProcessPoolExecutor
+
+    # A few chunks per worker keep the load balanced while consecutive jobs,
+    # which usually share their data file, stay on the same worker
+    chunksize = max(1, len(jobs) // (workers * 4))
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(make_renderer, *args)) as pool:
+        for result, output in pool.map(_run_worker_job, jobs, chunksize=chunksize):
+            stdout.write(output)
+            results.append(result)
+
+    return results
+
+
+def report_failures(results: list[JobResult], stream: TextIO) -> int:
+    failures = [result for result in results if result.failed]
+    for result in failures:
+        job = result.job
+        stream.write(
+            f'Job {job.template} ({", ".join(job.data_files)} -> {job.output}) failed: {result.error}\n')
+
+    return len(failures)
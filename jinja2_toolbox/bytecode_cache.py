@@ -0,0 +1,57 @@
+from jinja2 import Environment
+from jinja2.bccache import Bucket, FileSystemBytecodeCache
+from pathlib import Path
+from typing import Any, Optional
+import hashlib
+import jinja2
+
+
+def _callable_name(value: Any) -> Any:
+    if callable(value):
+        return f'{getattr(value, "__module__", "")}.{getattr(value, "__qualname__", repr(value))}'
+    return value
+
+
+def environment_fingerprint(environment: Environment) -> str:
+    # Everything the generated code depends on besides the template source
+    options = (
+        jinja2.__version__,
+        environment.block_start_string,
+        environment.block_end_string,
+        environment.variable_start_string,
+        environment.variable_end_string,
+        environment.comment_start_string,
+        environment.comment_end_string,
+        environment.line_statement_prefix,
+        environment.line_comment_prefix,
+        environment.trim_blocks,
+        environment.lstrip_blocks,
+        environment.newline_sequence,
+        environment.keep_trailing_newline,
+        environment.optimized,
+        environment.is_async,
+        _callable_name(environment.autoescape),
+        _callable_name(environment.finalize),
+        sorted(environment.extensions),
+        # Unknown filters and tests are compiled into runtime errors
+        sorted(environment.filters),
+        sorted(environment.tests),
+    )
+    return hashlib.sha256(repr(options).encode()).hexdigest()
+
+
+# The stock file system cache keys on the template name and file name only,
+# here the key also covers the environment fingerprint so that environments
+# with different options can share a directory. Bytecode is written to a
+# temporary file and renamed, which is safe with concurrent processes.
+class EnvironmentAwareBytecodeCache(FileSystemBytecodeCache):
+    def __init__(self, directory: str) -> None:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        super().__init__(directory)
+
+    def get_bucket(self, environment: Environment, name: str,
+                   filename: Optional[str], source: str) -> Bucket:
+        key = self.get_cache_key(name, f'{filename}|{environment_fingerprint(environment)}')
+        bucket = Bucket(environment, key, self.get_source_checksum(source))
+        self.load_bytecode(bucket)
+        return bucket
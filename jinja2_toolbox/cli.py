@@ -1,20 +1,52 @@
 import argparse
 from pathlib import Path
-from jinja2 import Environment, FileSystemLoader, StrictUndefined
-from .json_provider import JsonProvider
-from .yaml_provider import YamlProvider
-from .toml_provider import TomlProvider
-from .data_proxies import enrich, deplete
+from jinja2 import BaseLoader, Environment, FileSystemLoader, ModuleLoader, StrictUndefined
+from .data_proxies import count_nodes, enrich, deplete
+from .mapped import map_file, mapped_file
+from .merge import deep_merge
+from .query import index_by, query
+from .render_scope import render_scope
+from .output import write_output
+from .profiling import Profiler, install_profiler, profiled
+from .metrics import (
+    counted_output, counted_output_async, current_metrics, data_metrics, install_metrics, measured,
+    measured_render, metrics_to_file)
+from .bytecode_cache import EnvironmentAwareBytecodeCache
+from .batch import (
+    JobRenderer, JobResult, RenderJob, parse_manifest, expand_matrix, run_jobs, run_jobs_parallel, report_failures)
+from typing import Any, Callable, Iterable, Optional, TextIO, Union
+import functools
+import importlib
 import inspect
+import os
 import sys
 
+# Providers are imported only once a data file of their format is read, so
+# rendering JSON data doesn't pay for importing the YAML and TOML parsers
 DATA_PROVIDERS = {
-    'json': JsonProvider,
-    'yml': YamlProvider,
-    'yaml': YamlProvider,
-    'toml': TomlProvider,
+    'json': '.json_provider:JsonProvider',
+    'yml': '.yaml_provider:YamlProvider',
+    'yaml': '.yaml_provider:YamlProvider',
+    'toml': '.toml_provider:TomlProvider',
+    'j2snap': '.snapshot:SnapshotProvider',
 }
 
+# Names of the providers' BACKENDS, kept here for the same reason
+DATA_BACKENDS = ('orjson', 'json', 'libyaml', 'pyyaml', 'tomllib', 'toml', 'marshal')
+
+
+# `jinja2-toolbox <subcommand> ...`, each implemented by a main(argv) function
+SUBCOMMANDS = {
+    'serve': '.server:main',
+    'compile-data': '.snapshot:main',
+    'precompile': '.precompile:main',
+}
+
+
+def get_provider(data_type: str) -> type:
+    module_name, class_name = DATA_PROVIDERS[data_type].split(':')
+    return getattr(importlib.import_module(module_name, __package__), class_name)
+
 
 def deduce_data_type(filename: Path, override: str) -> str:
     if override:
@@ -29,13 +61,61 @@ def deduce_data_type(filename: Path, override: str) -> str:
         return extension
 
 
-def read_data(datapath: str, data_format: str) -> dict:
-    provider = DATA_PROVIDERS[deduce_data_type(datapath, data_format)]()
-    if datapath == '-':
-        return provider.load(sys.stdin)
-    else:
-        with Path(datapath).open() as f:
-            return provider.load(f)
+def read_data(datapath: str, data_format: str, backend_overrides: Iterable[str] = (),
+              cache_dir: Optional[str] = None, lazy: bool = False) -> dict:
+    data_type = deduce_data_type(datapath, data_format)
+    with data_metrics(datapath, data_type) as metrics:
+        if lazy and data_type == 'json' and datapath != '-':
+            from .lazy_json import load_lazy_json
+
+            metrics['backend'] = 'lazy'
+            return load_lazy_json(datapath)
+
+        provider = get_provider(data_type)(backend_overrides)
+        metrics['backend'] = provider.backend
+
+        def parsed(data: Any) -> Any:
+            # The parser that actually ran: the JSON provider leaves the
+            # small files to the stdlib parser
+            metrics['backend'] = getattr(provider, 'parsed_with', provider.backend)
+            return data
+
+        if datapath == '-':
+            return parsed(provider.load(sys.stdin))
+        elif getattr(provider, 'KEEPS_BUFFER', False):
+            # Decoded from the map as the values are read, the map is closed
+            # along with the data. Caching it would only add a copy.
+            return parsed(provider.load_buffer(map_file(datapath)))
+
+        elif not cache_dir:
+            # Mapping the file doesn't lower the peak memory of a parse, the
+            # parsed objects take 7-10x the size of the file and dominate it
+            with Path(datapath).open(encoding='utf-8') as f:
+                return parsed(provider.load(f))
+
+        from .data_cache import DataCache
+
+        # The cache key is hashed from the map and a miss parses the same map,
+        # instead of holding the raw bytes and a decoded copy at once
+        with mapped_file(datapath) as raw:
+            def parse() -> Any:
+                metrics['cache'] = 'miss'
+                return parsed(provider.load_buffer(raw))
+
+            metrics['cache'] = 'hit'
+            return DataCache(cache_dir).load(raw, data_type, provider.backend, parse)
+
+
+def read_data_files(datapaths: Iterable[str], data_format: str, backend_overrides: Iterable[str] = (),
+                    cache_dir: Optional[str] = None, profiler: Optional[Profiler] = None,
+                    lazy: bool = False) -> dict:
+    data = []
+    for datapath in datapaths:
+        with profiled(profiler, 'data', datapath):
+            data.append(read_data(datapath, data_format, backend_overrides, cache_dir, lazy))
+
+    # Merged in order, the later files override the earlier ones
+    return deep_merge(*data)
 
 
 def add_j2_cli_args(ap: argparse.ArgumentParser) -> None:
@@ -84,6 +164,9 @@ def add_j2_cli_args(ap: argparse.ArgumentParser) -> None:
         'will reload the template.  For higher performance it\'s possible to '
         'disable that.',
         'optimized': 'should the optimizer be enabled?',
+        'enable_async': 'If set to true this enables async template execution which allows using '
+        'async functions and generators. Batch jobs are then rendered concurrently, see '
+        '--async-jobs.',
     }
 
     refl_args = inspect.signature(Environment.__init__).parameters
@@ -110,63 +193,365 @@ def add_j2_cli_args(ap: argparse.ArgumentParser) -> None:
     # 'undefined'
     # 'finalize'
     # 'loader'
-    # 'bytecode_cache'
-    # 'enable_async'
 
     pass
 
 
-def main() -> None:
-    ap = argparse.ArgumentParser(
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    ap.add_argument('template', help='Jinja2 template file path.')
-    ap.add_argument(
-        '--data',
-        default='-',
-        help=f'Template data file path. Supported formats: {", ".join(DATA_PROVIDERS.keys())}. '
-        '"-" to read the data from stdin.')
-    ap.add_argument('--output', default='-',
-                    help='Generated output file path. stdout by default')
+def add_data_args(ap: argparse.ArgumentParser) -> None:
     ap.add_argument(
         '--data-format', choices=tuple(DATA_PROVIDERS.keys()), help='Override automatically-detected data format')
+    ap.add_argument(
+        '--data-backend', action='append', default=[],
+        choices=DATA_BACKENDS,
+        help='Parser to use instead of the fastest available one for its data format. '
+        'May be repeated to pick the parsers of several formats')
+    ap.add_argument('--data-cache', metavar='DIR',
+                    help='Directory where parsed data files are cached between runs, keyed by '
+                    'their content')
+    ap.add_argument('--lazy-data', action='store_true',
+                    help='Parse JSON data files on demand from a memory map instead of loading '
+                    'them at once, for data too big to fit in memory')
     ap.add_argument('--enrich', action='store_true',
                     help='Automatically enrich the input data')
-    ap.add_argument('--template-dir', default='.', help='Path to the templates root directory')
+    ap.add_argument('--enrich-memoize', action='store_true',
+                    help='Enrich the input data, caching enriched children so that repeated '
+                    'access returns the same proxy instead of re-wrapping the value')
 
-    add_j2_cli_args(ap)
 
-    args = ap.parse_args()
+def add_render_args(ap: argparse.ArgumentParser) -> None:
+    # The options render_job() reads
+    ap.add_argument('--stream', action='store_true',
+                    help='Write the output while it is being rendered instead of rendering it '
+                    'into memory first')
+    ap.add_argument('--stream-buffer', type=int, default=256,
+                    help='Number of rendered template chunks grouped into a single write with '
+                    '--stream, 1 to write every chunk as soon as it is generated')
+    ap.add_argument('--atomic-output', action='store_true',
+                    help='Render --output into a temporary file and atomically move it in place, '
+                    'only if its content changed. Unchanged outputs keep their modification time')
+    ap.add_argument('--render-cache', metavar='DIR',
+                    help='Directory where the outputs are cached, keyed by the template and the '
+                    'templates it references, the data files and the options. A cached output is '
+                    'copied instead of being rendered again')
+    ap.add_argument('--render-cache-size', type=float, default=1024, metavar='MIB',
+                    help='Size of --render-cache beyond which the least recently used outputs '
+                    'are evicted')
+    ap.add_argument('--render-cache-link', action='store_true',
+                    help='Hard link the outputs to the --render-cache entries instead of copying '
+                    'them. The outputs must not be modified in place then')
+    ap.add_argument('--metrics-file',
+                    help='JSON lines file to append metrics to: one line per job (data file sizes '
+                    'and parse times, enriched nodes, template load and compilation, render time, '
+                    'output bytes, peak RSS) and one for the whole run')
 
-    if args.data == '-' and not args.data_format:
-        raise RuntimeError(
-            f'The --data-format option must be specified when reading the data from the stdin')
 
-    if not Path(args.template_dir).exists() or not Path(args.template_dir).is_dir():
-        raise RuntimeError(f'Invalid template directory {args.template_dir}')
+def add_environment_args(ap: argparse.ArgumentParser) -> None:
+    ap.add_argument('--template-dir', default='.', help='Path to the templates root directory')
+    ap.add_argument('--bytecode-cache', metavar='DIR',
+                    help='Directory where compiled templates are cached between runs')
+    ap.add_argument('--precompiled', metavar='DIR',
+                    help='Load the templates from a directory written by `jinja2-toolbox precompile` '
+                    'instead of compiling them from --template-dir. Refused if it was precompiled '
+                    'with other --j2_* options')
+
+    add_j2_cli_args(ap)
 
-    template_context = read_data(args.data, args.data_format)
-    if args.enrich:
-        template_context = enrich(template_context)
 
-    j2_args = {
+def get_j2_args(args: argparse.Namespace) -> dict:
+    return {
         key.lstrip('j2_'): value
         for key, value in vars(args).items()
         if key.startswith('j2_')
     }
 
+
+def make_environment(template_dir: str, j2_args: dict, bytecode_cache: Optional[str] = None,
+                     profiler: Optional[Profiler] = None, precompiled: Optional[str] = None,
+                     metrics: bool = False) -> Environment:
+    loader: BaseLoader
+    if precompiled:
+        if bytecode_cache:
+            raise RuntimeError('--bytecode-cache has no use with --precompiled templates')
+        if not Path(precompiled).is_dir():
+            raise RuntimeError(f'Invalid precompiled templates directory {precompiled}')
+        loader = ModuleLoader(precompiled)
+    elif not Path(template_dir).exists() or not Path(template_dir).is_dir():
+        raise RuntimeError(f'Invalid template directory {template_dir}')
+    else:
+        loader = FileSystemLoader(template_dir)
+
     env = Environment(
-        loader=FileSystemLoader(args.template_dir),
+        loader=loader,
         undefined=StrictUndefined,
+        bytecode_cache=EnvironmentAwareBytecodeCache(bytecode_cache) if bytecode_cache else None,
         **j2_args
     )
 
     env.filters['enrich'] = enrich
     env.filters['deplete'] = deplete
+    env.filters['query'] = query
+    env.globals['query'] = query
+    env.filters['index_by'] = index_by
+    env.globals['index_by'] = index_by
+
+    if metrics:
+        install_metrics(env)
+
+    if precompiled:
+        from .precompile import check_precompiled
+
+        check_precompiled(env, precompiled)
+
+    if profiler is not None:
+        install_profiler(env, profiler)
 
-    template = env.get_template(args.template)
+    return env
 
-    if args.output is None or args.output == '-':
-        sys.stdout.write(template.render(**template_context))
+
+def environment_from_args(args: argparse.Namespace, profiler: Optional[Profiler] = None) -> Environment:
+    with profiled(profiler, 'stage', 'environment'), measured('environment_seconds'):
+        # The render server and precompile have no --metrics-file
+        return make_environment(args.template_dir, get_j2_args(args), args.bytecode_cache, profiler,
+                                args.precompiled, bool(getattr(args, 'metrics_file', None)))
+
+
+def load_context(datapath: Union[str, tuple[str, ...]], data_format: str, enrich_data: bool,
+                 memoize: bool, backend_overrides: tuple[str, ...] = (),
+                 cache_dir: Optional[str] = None, lazy: bool = False,
+                 profiler: Optional[Profiler] = None) -> Any:
+    datapaths = (datapath,) if isinstance(datapath, str) else datapath
+    if '-' in datapaths and not data_format:
+        raise RuntimeError(
+            f'The --data-format option must be specified when reading the data from the stdin')
+
+    with profiled(profiler, 'stage', 'read data'):
+        template_context = read_data_files(
+            datapaths, data_format, backend_overrides, cache_dir, profiler, lazy)
+    if enrich_data or memoize:
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics['enrich_nodes'] = count_nodes(template_context)
+        with profiled(profiler, 'stage', 'enrich'):
+            template_context = enrich(template_context, memoize=memoize)
+
+    return template_context
+
+
+def render_to(env: Environment, job: RenderJob, output: str, atomic: bool, args: argparse.Namespace,
+              context_loader: Callable[..., Any], stdout: TextIO,
+              profiler: Optional[Profiler] = None) -> None:
+    template_context = context_loader(
+        job.data, job.data_format or args.data_format, args.enrich, args.enrich_memoize,
+        tuple(args.data_backend), args.data_cache, args.lazy_data, profiler)
+    with profiled(profiler, 'stage', 'load template'), measured('template_load_seconds'):
+        template = env.get_template(job.template)
+
+    with render_scope(), profiled(profiler, 'stage', 'render'), measured_render():
+        if args.stream and env.is_async:
+            # generate() of an async environment renders the whole output before
+            # yielding its first chunk, the async generator streams it
+            import asyncio
+            from .async_render import stream_output
+
+            asyncio.run(stream_output(
+                output, counted_output_async(template.generate_async(**template_context)), stdout,
+                args.stream_buffer, atomic))
+        elif args.stream:
+            # Chunks are written as they are generated, so the memory use doesn't
+            # depend on the output size
+            write_output(output, counted_output(template.generate(**template_context)), stdout,
+                         buffer_size=args.stream_buffer, flush=True, atomic=atomic)
+        else:
+            write_output(output, counted_output((template.render(**template_context),)), stdout,
+                         atomic=atomic)
+
+
+def render_job(env: Environment, job: RenderJob, args: argparse.Namespace,
+               context_loader: Callable[..., Any] = load_context,
+               stdout: Optional[TextIO] = None, profiler: Optional[Profiler] = None) -> None:
+    stdout = stdout or sys.stdout
+    with metrics_to_file(args.metrics_file, kind='job', template=job.template,
+                         data_files=list(job.data_files), output=job.output,
+                         templates_compiled=0) as metrics:
+        if args.render_cache:
+            from .render_cache import render_cache_for
+
+            cache = render_cache_for(env, args)
+            with profiled(profiler, 'stage', 'render cache'):
+                key = cache.key(job, args)
+                if key is not None and cache.fetch(key, job.output, stdout, args.atomic_output):
+                    return
+            if key is not None:
+                if metrics is not None:
+                    metrics['render_cache'] = 'miss'
+                with cache.new_entry(key) as path:
+                    render_to(env, job, str(path), False, args, context_loader, stdout, profiler)
+                # Unless another process evicted it already
+                if cache.fetch(key, job.output, stdout, args.atomic_output, record_hit=False):
+                    return
+
+        render_to(env, job, job.output, args.atomic_output, args, context_loader, stdout, profiler)
+
+
+def make_job_renderer(args: argparse.Namespace, profiler: Optional[Profiler] = None) -> JobRenderer:
+    env = environment_from_args(args, profiler)
+    # Consecutive jobs reading the same data file parse it only once
+    context_loader = functools.lru_cache(maxsize=1)(load_context)
+
+    def render(job: RenderJob, stdout: TextIO) -> None:
+        render_job(env, job, args, context_loader, stdout, profiler)
+
+    return render
+
+
+def collect_jobs(args: argparse.Namespace) -> Optional[list[RenderJob]]:
+    if args.manifest:
+        # Manifest paths are not rebased: they are resolved the same way
+        # as the command line ones
+        return parse_manifest(read_data(args.manifest, None, args.data_backend))
+    elif args.data_glob:
+        if not args.template:
+            raise RuntimeError('At least one template is required with --data-glob')
+        return expand_matrix(args.template, args.data_glob, args.output)
     else:
-        with Path(args.output).open('w') as f:
-            f.write(template.render(**template_context))
+        return None
+
+
+def run_batch(jobs: list[RenderJob], args: argparse.Namespace,
+              profiler: Optional[Profiler] = None) -> None:
+    workers = args.jobs or os.cpu_count() or 1
+    if workers == 1 and args.j2_enable_async:
+        from .async_render import run_batch_async
+
+        # Overlapping jobs would blur the profile
+        concurrency = 1 if profiler is not None else args.async_jobs
+        results = run_batch_async(jobs, args, environment_from_args(args, profiler), load_context,
+                                  concurrency, sys.stdout, profiler)
+    elif workers == 1:
+        results = run_jobs(jobs, make_job_renderer(args, profiler), sys.stdout)
+    else:
+        # Every worker builds its own environment once, see make_job_renderer
+        results = run_jobs_parallel(jobs, workers, sys.stdout, make_job_renderer, args)
+
+    failed = report_failures(results, sys.stderr)
+    if failed:
+        raise RuntimeError(f'{failed} of {len(results)} render jobs failed')
+
+
+def watch(jobs: list[RenderJob], args: argparse.Namespace) -> None:
+    if any('-' in job.data_files for job in jobs):
+        raise RuntimeError('The data can\'t be read from the stdin with --watch')
+
+    # Imported here, only the watch mode needs the template dependency graph
+    from .watch import Watcher
+
+    env = environment_from_args(args)
+
+    def render_jobs(jobs: list[RenderJob]) -> list[JobResult]:
+        # The data files may have changed since the previous round
+        context_loader = functools.lru_cache(maxsize=1)(load_context)
+        return run_jobs(jobs, lambda job, stdout: render_job(env, job, args, context_loader, stdout),
+                        sys.stdout)
+
+    watcher = Watcher(env, jobs, render_jobs, sys.stderr, args.watch_interval, args.watch_debounce)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def profile(jobs: list[RenderJob], batch: bool, args: argparse.Namespace) -> None:
+    if args.watch or args.jobs != 1:
+        raise RuntimeError('--profile can\'t be combined with --watch or --jobs')
+
+    profiler = Profiler()
+    try:
+        if batch:
+            run_batch(jobs, args, profiler)
+        else:
+            render_job(environment_from_args(args, profiler), jobs[0], args, profiler=profiler)
+    finally:
+        if args.profile_file == '-':
+            profiler.write_report(sys.stderr, args.profile_format)
+        else:
+            with Path(args.profile_file).open('w') as f:
+                profiler.write_report(f, args.profile_format)
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        module_name, function_name = SUBCOMMANDS[sys.argv[1]].split(':')
+        module = importlib.import_module(module_name, __package__)
+        getattr(module, function_name)(sys.argv[2:])
+        return
+
+    ap = argparse.ArgumentParser(
+        epilog=f'Subcommands: {", ".join(SUBCOMMANDS)}. Run `jinja2-toolbox <subcommand> --help` '
+        'for their options.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ap.add_argument('template', nargs='*',
+                    help='Jinja2 template file path. Several templates may be given with --data-glob.')
+    ap.add_argument(
+        '--data',
+        action='append',
+        help=f'Template data file path. Supported formats: {", ".join(DATA_PROVIDERS.keys())}. '
+        '"-" to read the data from stdin, the default. May be repeated: the files are deep merged '
+        'in order, mappings key by key, and the later files override the earlier ones')
+    ap.add_argument('--output', default='-',
+                    help='Generated output file path. stdout by default. With --data-glob this is a '
+                    'pattern that may refer to {template}, {template_stem}, {data} and {data_stem}')
+    ap.add_argument('--manifest',
+                    help='Batch mode: render every job of the manifest file (json, yaml or toml), '
+                    'a list of {template, data, output, data_format} entries')
+    ap.add_argument('--data-glob',
+                    help='Batch mode: render every template against every data file matching '
+                    'the glob pattern')
+    ap.add_argument('--jobs', type=int, default=1,
+                    help='Number of worker processes rendering the batch jobs in parallel, '
+                    '0 to use all the CPU cores')
+    ap.add_argument('--async-jobs', type=int, default=8,
+                    help='With --j2_enable_async and a single worker process, number of batch jobs '
+                    'in flight at once: their data files are read and their outputs written in '
+                    'threads while the others render, and async filters of one job let the others '
+                    'render while they wait')
+    ap.add_argument('--watch', action='store_true',
+                    help='Keep running and render the outputs again when their template, a template '
+                    'it includes, imports or extends, or their data file changes. Jobs are rendered '
+                    'serially')
+    ap.add_argument('--watch-interval', type=float, default=0.5,
+                    help='Seconds between two checks of the watched files')
+    ap.add_argument('--watch-debounce', type=float, default=0.2,
+                    help='Seconds without any further change before rendering the changed files')
+    ap.add_argument('--profile', action='store_true',
+                    help='Time the data loading, enrichment, template compilation and rendering, '
+                    'every template, block and filter, and write a report sorted by total time')
+    ap.add_argument('--profile-format', choices=('text', 'json'), default='text',
+                    help='Format of the --profile report')
+    ap.add_argument('--profile-file', default='-',
+                    help='File the --profile report is written to, stderr by default')
+
+    add_render_args(ap)
+    add_data_args(ap)
+    add_environment_args(ap)
+
+    args = ap.parse_args()
+    if args.render_cache and args.precompiled:
+        # The cache keys on the template sources, which precompiled templates don't have
+        raise RuntimeError('--render-cache can\'t be combined with --precompiled templates')
+
+    jobs = collect_jobs(args)
+    batch = jobs is not None
+    if not batch:
+        if len(args.template) != 1:
+            raise RuntimeError('Exactly one template is expected')
+        jobs = [RenderJob(args.template[0], tuple(args.data or ('-',)), args.output)]
+
+    with metrics_to_file(args.metrics_file, kind='run', jobs=len(jobs)):
+        if args.profile:
+            profile(jobs, batch, args)
+        elif args.watch:
+            watch(jobs, args)
+        elif batch:
+            run_batch(jobs, args)
+        else:
+            render_job(environment_from_args(args), jobs[0], args)
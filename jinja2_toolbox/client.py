@@ -0,0 +1,77 @@
+from typing import Iterator, Optional, Union
+from .output import write_output
+from .protocol import write_request, read_output
+import argparse
+import os
+import socket
+import sys
+
+# The client is kept free of jinja2 and of the data parsers, so that its
+# startup stays as short as possible
+
+
+def request_render(socket_path: str, template: str, data: Union[str, list[str], None] = None,
+                   data_content: Optional[str] = None, data_format: Optional[str] = None,
+                   data_backend: tuple[str, ...] = (), enrich: bool = False,
+                   enrich_memoize: bool = False) -> Iterator[str]:
+    if isinstance(data, str):
+        data = [data]
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as f:
+            write_request(f, {
+                'template': template,
+                # The server may run from another working directory
+                'data': [os.path.abspath(path) for path in data] if data is not None else None,
+                'data_content': data_content,
+                'data_format': data_format,
+                'data_backend': list(data_backend),
+                'enrich': enrich,
+                'enrich_memoize': enrich_memoize,
+            })
+            f.flush()
+            yield from read_output(f)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(
+        prog='jinja2-toolbox-client',
+        description='Render a template with a running `jinja2-toolbox serve` server.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ap.add_argument('template', help='Jinja2 template path, relative to the server template directory')
+    ap.add_argument('--socket', required=True, help='Unix socket path of the render server')
+    ap.add_argument('--data', action='append',
+                    help='Template data file path. "-" to send the data read from stdin, the default. '
+                    'May be repeated to merge several data files')
+    ap.add_argument('--data-format', help='Override automatically-detected data format')
+    ap.add_argument('--data-backend', action='append', default=[],
+                    help='Parser to use instead of the fastest available one for its data format')
+    ap.add_argument('--enrich', action='store_true', help='Automatically enrich the input data')
+    ap.add_argument('--enrich-memoize', action='store_true',
+                    help='Enrich the input data, caching the enriched children')
+    ap.add_argument('--output', default='-', help='Generated output file path. stdout by default')
+    ap.add_argument('--atomic-output', action='store_true',
+                    help='Write --output atomically, only if its content changed')
+
+    args = ap.parse_args()
+
+    if args.data in (None, ['-']):
+        if not args.data_format:
+            raise RuntimeError(
+                f'The --data-format option must be specified when reading the data from the stdin')
+        data, data_content = None, sys.stdin.read()
+    else:
+        if '-' in args.data:
+            raise RuntimeError('The data read from the stdin can\'t be merged with data files')
+        data, data_content = args.data, None
+
+    chunks = request_render(
+        args.socket, args.template, data=data, data_content=data_content,
+        data_format=args.data_format, data_backend=tuple(args.data_backend),
+        enrich=args.enrich, enrich_memoize=args.enrich_memoize)
+    write_output(args.output, chunks, sys.stdout, flush=True, atomic=args.atomic_output)
+
+
+if __name__ == '__main__':
+    main()
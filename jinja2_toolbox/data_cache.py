@@ -0,0 +1,51 @@
+from pathlib import Path
+from typing import Any, Callable
+from .mapped import Buffer
+import hashlib
+import os
+import pickle
+
+# Bumped whenever the cached representation changes
+_CACHE_VERSION = 1
+
+
+class DataCache:
+    # Parsed data pickled under the hash of the raw file content, the data
+    # type and the parser, so any change to the file misses the cache
+    def __init__(self, directory: str) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, raw: Buffer, data_type: str, backend: str) -> Path:
+        digest = hashlib.sha256(f'{_CACHE_VERSION}|{data_type}|{backend}|'.encode())
+        # Hashed straight from the mapped file
+        digest.update(raw)
+        return self.directory / f'{digest.hexdigest()}.pickle'
+
+    def load(self, raw: Buffer, data_type: str, backend: str, parse: Callable[[], Any]) -> Any:
+        path = self.path(raw, data_type, backend)
+        try:
+            with path.open('rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            # Truncated, written by something else than this cache, or
+            # referencing a class that is gone (ModuleNotFoundError,
+            # AttributeError, ...): parsed again and the entry rewritten
+            pass
+
+        data = parse()
+
+        # Same temporary file and rename dance as the atomic outputs, so
+        # that concurrent runs never read a partial pickle
+        tmp_path = path.with_name(f'.{path.name}.{os.urandom(8).hex()}.tmp')
+        try:
+            with tmp_path.open('xb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        return data
@@ -4,73 +4,233 @@ import typing
 import inspect
 
 
+class _RichProxy:
+    # `depleted` and `parent` are slots, so reading them is a plain descriptor
+    # lookup instead of a string comparison chain in __getattribute__
+    __slots__ = ('depleted', 'parent', '_children')
+
+    def __init__(self, value: Any, parent: Any) -> None:
+        _set_depleted(self, value)
+        _set_parent(self, parent)
+
+    @property
+    def __class__(self) -> typing.Type:
+        return type(_get_depleted(self))
+
+
+class _DynamicRichProxy(_RichProxy):
+    __slots__ = ()
+
+    def __getattr__(self, name: str) -> Any:
+        # Only reached for the names the proxy itself does not define, i.e.
+        # the instance attributes of the wrapped value
+        return getattr(_get_depleted(self), name)
+
+
+# The proxies forward __setattr__ to the wrapped value, the slots are
+# written through their descriptors directly
+_get_depleted = _RichProxy.depleted.__get__
+_set_depleted = _RichProxy.depleted.__set__
+_set_parent = _RichProxy.parent.__set__
+_get_children = _RichProxy._children.__get__
+_set_children = _RichProxy._children.__set__
+
+_FORWARDED_DUNDERS = frozenset((
+    '__add__', '__contains__', '__delattr__', '__doc__', '__eq__',
+    '__format__', '__ge__', '__getitem__', '__getslice__', '__gt__',
+    '__hash__', '__le__', '__len__', '__lt__', '__mod__', '__mul__',
+    '__ne__', '__reduce__', '__reduce_ex__', '__repr__', '__rmod__',
+    '__rmul__', '__setattr__', '__str__', '__iter__'
+))
+_UNARY_DUNDERS = frozenset((
+    '__hash__', '__iter__', '__len__', '__reduce__', '__repr__', '__str__'
+))
+
+
+def _forward_call(name: str, method: typing.Callable) -> typing.Callable:
+    if name in _UNARY_DUNDERS:
+        def call_unary(self: Any) -> Any:
+            return method(_get_depleted(self))
+
+        return call_unary
+
+    def call(self: Any, *args: Any) -> Any:
+        return method(_get_depleted(self), *args)
+
+    return call
+
+
+def _forward_attribute(name: str) -> property:
+    return property(lambda self: getattr(_get_depleted(self), name))
+
+
 def wrap_type_into_rich_proxy(
         cls: typing.Type,
         bases: typing.Iterable[typing.Type] = tuple(),
         overrides: dict[str, typing.Callable] = {}) -> typing.Type:
-    def __init__(self, value: Any, parent: Any) -> None:
-        object.__setattr__(self, 'value', value)
-        object.__setattr__(self, 'parent', parent)
-
-    def __getattribute__(self, name):
-        if name == 'parent':
-            return object.__getattribute__(self, 'parent')
-        elif name == 'depleted':
-            return object.__getattribute__(self, 'value')
-        else:
-            # TODO: Try to enrich here?
-            return object.__getattribute__(self, 'value').__getattribute__(name)
-
-    static_attrs = {
-        '__init__': __init__,
-        '__getattribute__': __getattribute__,
-        **overrides
+    dynamic_attrs = {
+        name: _forward_call(name, method)
+        for name, method in inspect.getmembers(cls, inspect.isroutine)
+        if name not in overrides
+        if name in _FORWARDED_DUNDERS
     }
 
-    attr_whitelist = tuple((
-        '__add__', '__contains__', '__delattr__', '__doc__', '__eq__',
-        '__format__', '__ge__', '__getitem__', '__getslice__', '__gt__',
-        '__hash__', '__le__', '__len__', '__lt__', '__mod__', '__mul__',
-        '__ne__', '__reduce__', '__reduce_ex__', '__repr__', '__rmod__',
-        '__rmul__', '__setattr__', '__str__', '__iter__'
-    ))
+    # Public attributes of the wrapped type (`items`, `count`, `upper`, ...)
+    # are resolved on the proxy class itself, so looking them up never goes
+    # through a failed lookup and a __getattr__ fallback
+    forwarded_attrs = {
+        name: _forward_attribute(name)
+        for name in dir(cls)
+        if not name.startswith('_')
+        if name not in _RichProxy.__slots__
+    }
 
-    # TODO: Test out are functions accessible from jinja?
-    def forward_call(name) -> Any:
-        def call(self, *args, **kwargs) -> Any:
-            return object.__getattribute__(self, 'value').__getattribute__(name)(*args, **kwargs)
+    # Values that may carry their own attributes need the dynamic fallback
+    dynamic = bool(cls.__dictoffset__) or hasattr(cls, '__getattr__')
 
-        return call
+    proxy_type = type(f'_JinjaToolboxRichProxy_{cls.__name__}',
+                      (_DynamicRichProxy if dynamic else _RichProxy,), {
+                          '__slots__': (),
+                          **forwarded_attrs,
+                          **dynamic_attrs,
+                          **overrides,
+                      })
 
-    dynamic_attrs = {
-        name: forward_call(name)
-        for name, _func in inspect.getmembers(cls, inspect.isroutine)
-        if name not in static_attrs
-        if name in attr_whitelist
-    }
+    # The ABCs are registered rather than inherited: their mixin methods
+    # (`get`, `items`, ...) would shadow the ones of the wrapped value
+    for base in bases:
+        base.register(proxy_type)
 
-    return type(f'_JinjaToolboxRichProxy_{cls.__name__}', (bases), {
-        **static_attrs,
-        **dynamic_attrs,
-    })
+    return proxy_type
 
 
-def enrich(d: Any, parent: Any = None) -> Any:
-    t = type(d)
-    if t.__name__.startswith('_JinjaToolboxRichProxy'):
-        return d
-    elif isinstance(d, Mapping):
-        return wrap_type_into_rich_proxy(t, bases=(Mapping,), overrides={
-            '__getitem__': lambda self, key: enrich(object.__getattribute__(self, 'value')[key], self),
-        })(d, parent)
-    elif isinstance(d, Sequence):
-        return wrap_type_into_rich_proxy(t, bases=(Sequence,), overrides={
-            '__getitem__': lambda self, key: enrich(object.__getattribute__(self, 'value')[key], self),
-        })(d, parent)
-    elif isinstance(d, (int, float, str, bool)):
-        return wrap_type_into_rich_proxy(t)(d, parent)
+def _get_item_override(self: Any, key: Any) -> Any:
+    return enrich(_get_depleted(self)[key], self)
+
+
+def _child_cache(self: Any) -> dict:
+    try:
+        return _get_children(self)
+    except AttributeError:
+        children: dict = {}
+        _set_children(self, children)
+        return children
+
+
+def _get_memoized_mapping_item(self: Any, key: Any) -> Any:
+    children = _child_cache(self)
+    try:
+        return children[key]
+    except KeyError:
+        child = enrich(_get_depleted(self)[key], self, memoize=True)
+        children[key] = child
+        return child
+
+
+def _get_memoized_sequence_item(self: Any, key: Any) -> Any:
+    value = _get_depleted(self)
+    if isinstance(key, slice):
+        # Slices produce new sequences, there is no node to be stable with
+        return enrich(value[key], self, memoize=True)
+    elif key < 0:
+        key += len(value)
+
+    children = _child_cache(self)
+    try:
+        return children[key]
+    except KeyError:
+        child = enrich(value[key], self, memoize=True)
+        children[key] = child
+        return child
+
+
+_PROXY_OVERRIDES: dict[str, dict[str, typing.Callable]] = {
+    'value': {},
+    'container': {'__getitem__': _get_item_override},
+    # Memoized containers keep their enriched children for their own
+    # lifetime, so every node of the data tree is wrapped at most once and
+    # the cache never outgrows the data it mirrors
+    'memoized_mapping': {'__getitem__': _get_memoized_mapping_item},
+    'memoized_sequence': {'__getitem__': _get_memoized_sequence_item},
+}
+
+# Proxy classes are generated once per (wrapped type, base, override kind)
+# and reused, so enriching a value costs a single instance allocation
+_proxy_classes: dict[tuple[typing.Type, tuple[typing.Type, ...], str], typing.Type] = {}
+_proxy_types: set[typing.Type] = set()
+
+
+def get_rich_proxy_type(
+        cls: typing.Type,
+        bases: tuple[typing.Type, ...] = tuple(),
+        kind: str = 'value') -> typing.Type:
+    key = (cls, bases, kind)
+    proxy_type = _proxy_classes.get(key)
+    if proxy_type is None:
+        proxy_type = wrap_type_into_rich_proxy(
+            cls, bases=bases, overrides=_PROXY_OVERRIDES[kind])
+        _proxy_classes[key] = proxy_type
+        _proxy_types.add(proxy_type)
+    return proxy_type
+
+
+def _select_proxy_type(t: typing.Type, memoize: bool) -> typing.Type:
+    if issubclass(t, Mapping):
+        kind = 'memoized_mapping' if memoize else 'container'
+        return get_rich_proxy_type(t, (Mapping,), kind)
+    elif issubclass(t, Sequence):
+        kind = 'memoized_sequence' if memoize else 'container'
+        return get_rich_proxy_type(t, (Sequence,), kind)
+    elif issubclass(t, (int, float, str, bool)):
+        return get_rich_proxy_type(t)
     else:
-        raise RuntimeError(f'Unsupported data type {type(d)} for wrapping')
+        raise RuntimeError(f'Unsupported data type {t} for wrapping')
+
+
+# Proxy type to use for a given value type, indexed by the memoize flag. It
+# spares enrich() the (slow) ABC instance checks for every wrapped value
+_enrich_proxy_types: tuple[dict[typing.Type, typing.Type], ...] = ({}, {})
+
+
+def enrich(d: Any, parent: Any = None, memoize: bool = False) -> Any:
+    t = type(d)
+    proxy_type = _enrich_proxy_types[memoize].get(t)
+    if proxy_type is None:
+        if t in _proxy_types:
+            return d
+        proxy_type = _select_proxy_type(t, memoize)
+        _enrich_proxy_types[memoize][t] = proxy_type
+    return proxy_type(d, parent)
+
+
+def enrich_child(parent: Any, key: Any, value: Any) -> Any:
+    # parent[key], for a value already read from the depleted parent. Only
+    # memoized parents are indexed, to hand out the child they cache.
+    if type(parent).__getitem__ is _get_item_override:
+        return enrich(value, parent)
+    return parent[key]
+
+
+def count_nodes(d: Any) -> int:
+    # The values of a data tree that may be enriched, containers and scalars,
+    # for the metrics. Lazily loaded containers (lazy JSON, snapshots) count
+    # as one, counting their items would load them.
+    count = 0
+    pending = [d]
+    while pending:
+        value = pending.pop()
+        count += 1
+        t = type(value)
+        if t is dict:
+            pending.extend(value.values())
+        elif t is list or t is tuple:
+            pending.extend(value)
+    return count
+
+
+def is_enriched(d: Any) -> bool:
+    # The proxies claim the class of their value, the actual type tells them apart
+    return type(d) in _proxy_types
 
 
 def deplete(d: Any) -> Union[map, tuple, list, int, float, str]:
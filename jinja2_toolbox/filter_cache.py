@@ -0,0 +1,171 @@
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence, Set
+from typing import Any, Callable, Optional
+from .data_proxies import deplete, is_enriched
+from .render_scope import current_render_scope
+import functools
+import inspect
+import threading
+
+# Memoization for expensive custom filters, e.g. in an extension:
+#
+#   @cached_filter(maxsize=4096)
+#   def subnet(ip, prefix): ...
+#
+#   environment.filters['subnet'] = subnet
+#
+# scope='render' (the default) keeps the results for the current render
+# only, as index_by does; nothing is cached outside of a render.
+# scope='process' keeps them for the lifetime of the process, across the
+# batch jobs and the render server requests, which is only right for
+# filters that don't depend on anything but their arguments.
+
+RENDER = 'render'
+PROCESS = 'process'
+
+_MISSING = object()
+
+
+class CacheStats:
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Arguments that can't be hashed, even once frozen
+        self.uncacheable = 0
+
+
+class _Unhashable(Exception):
+    pass
+
+
+def _freeze(value: Any) -> Any:
+    # Enriched values are keyed on the value they wrap, so a filter called
+    # with a proxy and with the raw value shares the entry. Values are keyed
+    # with their type, as lru_cache(typed=True) does, so 1, 1.0 and True
+    # don't share one. Containers are turned into tuples, tagged so that a
+    # list doesn't match a tuple.
+    if is_enriched(value):
+        value = deplete(value)
+    t = type(value)
+    # Hashable containers are frozen too, (1,) and (True,) are equal
+    if t is tuple:
+        return (tuple, tuple(_freeze(item) for item in value))
+    elif t is frozenset:
+        return (frozenset, frozenset(_freeze(item) for item in value))
+    try:
+        hash(value)
+        return t, value
+    except TypeError:
+        pass
+
+    if isinstance(value, Mapping):
+        return (Mapping, tuple((_freeze(key), _freeze(item)) for key, item in value.items()))
+    elif isinstance(value, Set):
+        return (Set, frozenset(_freeze(item) for item in value))
+    elif isinstance(value, Sequence) and not isinstance(value, str):
+        return (Sequence, tuple(_freeze(item) for item in value))
+    raise _Unhashable
+
+
+def _cache_key(args: tuple, kwargs: dict) -> Any:
+    key = tuple(_freeze(arg) for arg in args)
+    if kwargs:
+        key += (_MISSING, *((name, _freeze(value)) for name, value in sorted(kwargs.items())))
+    return key
+
+
+class _LruCache:
+    def __init__(self, maxsize: Optional[int], stats: CacheStats) -> None:
+        self.maxsize = maxsize
+        self.stats = stats
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, key: Any) -> Any:
+        value = self.entries.get(key, _MISSING)
+        if value is _MISSING:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: Any, value: Any) -> None:
+        self.entries[key] = value
+        if self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.stats.evictions += 1
+
+
+def cached_filter(func: Optional[Callable] = None, *, maxsize: Optional[int] = 1024,
+                  scope: str = RENDER) -> Callable:
+    if func is None:
+        return functools.partial(cached_filter, maxsize=maxsize, scope=scope)
+    if scope not in (RENDER, PROCESS):
+        raise RuntimeError(f'Invalid filter cache scope {scope!r}, expected {RENDER!r} or {PROCESS!r}')
+
+    stats = CacheStats()
+    process_cache = _LruCache(maxsize, stats)
+    # The render server renders in several threads
+    lock = threading.Lock() if scope == PROCESS else None
+    # The context, eval context or environment passed to the pass_* filters
+    # is not part of the key
+    skip = 1 if hasattr(func, 'jinja_pass_arg') else 0
+
+    def lookup(args: tuple, kwargs: dict) -> tuple[Optional[_LruCache], Any, Any]:
+        if scope == RENDER:
+            render_scope = current_render_scope()
+            if render_scope is None:
+                return None, None, _MISSING
+            cache = render_scope.get(('cached_filter', cached))
+            if cache is None:
+                cache = render_scope[('cached_filter', cached)] = _LruCache(maxsize, stats)
+        else:
+            cache = process_cache
+
+        try:
+            key = _cache_key(args[skip:], kwargs)
+        except _Unhashable:
+            stats.uncacheable += 1
+            return None, None, _MISSING
+
+        if lock is None:
+            return cache, key, cache.get(key)
+        with lock:
+            return cache, key, cache.get(key)
+
+    def store(cache: _LruCache, key: Any, value: Any) -> None:
+        if lock is None:
+            cache.put(key, value)
+        else:
+            with lock:
+                cache.put(key, value)
+
+    if inspect.iscoroutinefunction(func):
+        # Async filters of --j2_enable_async environments, their results are
+        # cached once awaited
+        @functools.wraps(func)
+        async def cached(*args: Any, **kwargs: Any) -> Any:
+            cache, key, value = lookup(args, kwargs)
+            if value is _MISSING:
+                value = await func(*args, **kwargs)
+                if cache is not None:
+                    store(cache, key, value)
+            return value
+    else:
+        @functools.wraps(func)
+        def cached(*args: Any, **kwargs: Any) -> Any:
+            cache, key, value = lookup(args, kwargs)
+            if value is _MISSING:
+                value = func(*args, **kwargs)
+                if cache is not None:
+                    store(cache, key, value)
+            return value
+
+    def cache_clear() -> None:
+        process_cache.entries.clear()
+
+    cached.cache_stats = stats
+    cached.cache_scope = scope
+    cached.cache_clear = cache_clear
+    return cached
@@ -1,6 +1,82 @@
-from typing import TextIO, Any
+from typing import TextIO, Any, Iterable
+from .backends import module_available, select_backend
+from .mapped import Buffer, release
 import json
 
+# orjson turns integers wider than 64 bits into floats instead of failing.
+# Looking for 19 zeroes in a translated copy is much faster than a regex
+_DIGITS_TO_ZERO = str.maketrans('123456789', '0' * 9)
+_WIDE_NUMBER = '0' * 19
+_BYTES_TO_ZERO = bytes.maketrans(b'123456789', b'0' * 9)
+_WIDE_NUMBER_BYTES = b'0' * 19
+# Buffers are translated chunk by chunk, a copy of a whole mapped file would
+# defeat the purpose of mapping it
+_SCAN_CHUNK = 1 << 20
+
+# Below this size importing orjson costs more than it saves, the stdlib json
+# module is imported by jinja2 anyway
+_ORJSON_MIN_SIZE = 1 << 16
+
+
 class JsonProvider:
+    BACKENDS = {
+        'orjson': module_available('orjson'),
+        'json': lambda: True,
+    }
+
+    def __init__(self, backend_overrides: Iterable[str] = ()) -> None:
+        backend_overrides = tuple(backend_overrides)
+        self.backend = select_backend('json', self.BACKENDS, backend_overrides)
+        self.forced = self.backend in backend_overrides
+        # The parser of the last load, the stdlib one when orjson passed on
+        # the file
+        self.parsed_with = self.backend
+
     def load(self, f: TextIO) -> Any:
-        return json.load(f)
+        self.parsed_with = 'json'
+        if self.backend == 'orjson':
+            text = f.read()
+            if len(text) < _ORJSON_MIN_SIZE and not self.forced:
+                return json.loads(text)
+
+            import orjson
+            if _WIDE_NUMBER not in text.translate(_DIGITS_TO_ZERO):
+                try:
+                    data = orjson.loads(text)
+                    self.parsed_with = 'orjson'
+                    return data
+                except orjson.JSONDecodeError:
+                    # orjson is stricter than the stdlib (NaN, Infinity),
+                    # which gets the final say
+                    pass
+            return json.loads(text)
+        else:
+            return json.load(f)
+
+    def load_buffer(self, data: Buffer) -> Any:
+        self.parsed_with = 'json'
+        if self.backend == 'orjson' and (len(data) >= _ORJSON_MIN_SIZE or self.forced):
+            import orjson
+            if not _has_wide_number(data):
+                try:
+                    # orjson parses the buffer in place, without a decoded copy
+                    with memoryview(data) as view:
+                        parsed = orjson.loads(view)
+                    self.parsed_with = 'orjson'
+                    return parsed
+                except orjson.JSONDecodeError:
+                    pass
+
+        text = str(data, 'utf-8')
+        release(data)
+        return json.loads(text)
+
+
+def _has_wide_number(data: Buffer) -> bool:
+    # The chunks overlap so that no number is split between two of them
+    overlap = len(_WIDE_NUMBER_BYTES) - 1
+    for start in range(0, len(data), _SCAN_CHUNK):
+        chunk = data[start:start + _SCAN_CHUNK + overlap]
+        if _WIDE_NUMBER_BYTES in chunk.translate(_BYTES_TO_ZERO):
+            return True
+    return False
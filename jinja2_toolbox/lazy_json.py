@@ -0,0 +1,244 @@
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+from typing import Any, Iterator, Optional, Union
+from .mapped import Buffer, map_file
+import json
+import mmap
+import re
+
+# JSON documents read on demand from a memory-mapped file. Only the offsets
+# of the values are found up front, by skipping over them; the values are
+# parsed when they are accessed, and the big containers become lazy objects
+# themselves. Iterating a lazy array parses one item at a time, so a template
+# looping over a huge array runs in bounded memory.
+
+_WHITESPACE = re.compile(rb'[ \t\n\r]*')
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+_SCALAR = re.compile(rb'[^,:\]}\s]*')
+# Everything up to the next bracket, strings included. The regex engine runs
+# through the text, the Python loop only sees the brackets
+_UNTIL_BRACKET = re.compile(rb'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+
+
+def _nested_container(depth: int) -> bytes:
+    # A container nesting at most `depth` levels of containers, matched by the
+    # regex engine in one go. The runs between the strings and containers
+    # can only be split one way, so a failed match doesn't backtrack much.
+    run = rb'[^"\[\]{}]*'
+    string = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+    item = string if depth == 0 else string + rb'|' + _nested_container(depth - 1)
+    return rb'[\[{]' + run + rb'(?:(?:' + item + rb')' + run + rb')*[\]}]'
+
+
+_SMALL_CONTAINER = re.compile(_nested_container(6))
+
+_OPENING = frozenset(b'[{')
+_CLOSING = frozenset(b']}')
+
+# json.loads() sniffs the encoding of bytes, JSON files are UTF-8 encoded
+_decode = json.JSONDecoder().decode
+
+# Containers smaller than this are parsed at once when accessed
+LAZY_THRESHOLD = 1 << 16
+
+# Pages of the file already read are given back to the OS every this many bytes
+_RELEASE_STEP = 1 << 24
+
+
+class _Buffer:
+    def __init__(self, data: Buffer) -> None:
+        self.data = data
+        self.released = 0
+        self.releasable = isinstance(data, mmap.mmap) and hasattr(mmap, 'MADV_DONTNEED')
+
+    def error(self, pos: int, expected: str) -> RuntimeError:
+        return RuntimeError(f'Invalid JSON data at offset {pos}: expected {expected}')
+
+    def skip_whitespace(self, pos: int) -> int:
+        return _WHITESPACE.match(self.data, pos).end()
+
+    def expect(self, pos: int, chars: bytes, expected: str) -> int:
+        if pos >= len(self.data) or self.data[pos] not in chars:
+            raise self.error(pos, expected)
+        return self.data[pos]
+
+    def value_end(self, pos: int) -> int:
+        data = self.data
+        if pos >= len(data):
+            raise self.error(pos, 'a value')
+
+        first = data[pos]
+        if first == 0x22:
+            m = _STRING.match(data, pos)
+            if m is None:
+                raise self.error(pos, 'a string')
+            return m.end()
+        elif first not in _OPENING:
+            end = _SCALAR.match(data, pos).end()
+            if end == pos:
+                raise self.error(pos, 'a value')
+            return end
+
+        depth = 0
+        while True:
+            pos = _UNTIL_BRACKET.match(data, pos).end()
+            if pos >= len(data):
+                raise self.error(pos, 'a closing bracket')
+            if data[pos] in _OPENING:
+                # The nested containers are skipped by the regex engine when
+                # they are small. It keeps a backtracking entry per
+                # repetition, so it doesn't get to match the big ones.
+                m = _SMALL_CONTAINER.match(data, pos, pos + LAZY_THRESHOLD)
+                if m is not None:
+                    if depth == 0:
+                        return m.end()
+                    pos = m.end() - 1
+                else:
+                    depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos + 1
+            pos += 1
+            if pos - self.released >= _RELEASE_STEP:
+                self.release(pos)
+
+    def release(self, pos: int) -> None:
+        # The mapped pages count in the resident memory until the kernel
+        # reclaims them, the ones already read are dropped right away. They
+        # are read from the file again if needed.
+        if pos < self.released:
+            # Another pass over the data
+            self.released = pos - pos % mmap.PAGESIZE
+        elif pos - self.released >= _RELEASE_STEP and self.releasable:
+            end = pos - pos % mmap.PAGESIZE
+            self.data.madvise(mmap.MADV_DONTNEED, self.released, end - self.released)
+            self.released = end
+
+    def load(self, start: int, end: int) -> Any:
+        if end - start >= LAZY_THRESHOLD:
+            if self.data[start] == 0x7b:
+                return LazyJsonObject(self, start)
+            elif self.data[start] == 0x5b:
+                return LazyJsonArray(self, start)
+        return _decode(str(self.data[start:end], 'utf-8'))
+
+    def object_entries(self, pos: int) -> tuple[dict[str, tuple[int, int]], int]:
+        # The start and end offsets of the object's values by key, and the
+        # end of the object
+        offsets: dict[str, tuple[int, int]] = {}
+        pos = self.skip_whitespace(pos + 1)
+        if self.expect(pos, b'"}', 'a key or }') == 0x7d:
+            return offsets, pos + 1
+
+        while True:
+            self.expect(pos, b'"', 'a key')
+            key_end = self.value_end(pos)
+            key = _decode(str(self.data[pos:key_end], 'utf-8'))
+
+            pos = self.skip_whitespace(key_end)
+            self.expect(pos, b':', ':')
+            start = self.skip_whitespace(pos + 1)
+            end = self.value_end(start)
+            offsets[key] = (start, end)
+
+            pos = self.skip_whitespace(end)
+            if self.expect(pos, b',}', ', or }') == 0x7d:
+                return offsets, pos + 1
+            pos = self.skip_whitespace(pos + 1)
+
+    def array_items(self, pos: int) -> Iterator[tuple[int, int]]:
+        pos = self.skip_whitespace(pos + 1)
+        if pos < len(self.data) and self.data[pos] == 0x5d:
+            return
+
+        while True:
+            end = self.value_end(pos)
+            yield pos, end
+
+            pos = self.skip_whitespace(end)
+            if self.expect(pos, b',]', ', or ]') == 0x5d:
+                return
+            pos = self.skip_whitespace(pos + 1)
+
+
+class LazyJsonObject(Mapping):
+    def __init__(self, buffer: _Buffer, pos: int) -> None:
+        self._buffer = buffer
+        self._offsets, self._end = buffer.object_entries(pos)
+        self._values: dict[str, Any] = {}
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = self._buffer.load(*self._offsets[key])
+            return value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __repr__(self) -> str:
+        return f'<LazyJsonObject with {len(self)} keys>'
+
+
+class LazyJsonArray(Sequence):
+    # The items are not kept: iterating parses them again
+    def __init__(self, buffer: _Buffer, pos: int) -> None:
+        self._buffer = buffer
+        self._pos = pos
+        self._offsets: Optional[list[tuple[int, int]]] = None
+
+    def __iter__(self) -> Iterator[Any]:
+        buffer = self._buffer
+        for start, end in buffer.array_items(self._pos):
+            yield buffer.load(start, end)
+            buffer.release(start)
+
+    def _item_offsets(self) -> list[tuple[int, int]]:
+        # Built on the first random access only
+        if self._offsets is None:
+            self._offsets = list(self._buffer.array_items(self._pos))
+        return self._offsets
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:
+        offsets = self._item_offsets()
+        if isinstance(index, slice):
+            return [self._buffer.load(*item) for item in offsets[index]]
+        return self._buffer.load(*offsets[index])
+
+    def __len__(self) -> int:
+        return len(self._item_offsets())
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, Sequence) or isinstance(other, (str, bytes)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f'<LazyJsonArray at offset {self._pos}>'
+
+
+def load_lazy_json(path: Union[str, Path]) -> Any:
+    data = map_file(path)
+    buffer = _Buffer(data)
+    start = buffer.skip_whitespace(0)
+    if start < len(data) and data[start] == 0x5b:
+        # Checking what follows the array would mean a pass over all of it,
+        # and an array can't be the template context anyway
+        return LazyJsonArray(buffer, start)
+    elif start < len(data) and data[start] == 0x7b:
+        value = LazyJsonObject(buffer, start)
+        end = value._end
+    else:
+        end = buffer.value_end(start)
+        value = _decode(str(data[start:end], 'utf-8'))
+
+    if buffer.skip_whitespace(end) != len(data):
+        raise buffer.error(end, 'the end of the data')
+    return value
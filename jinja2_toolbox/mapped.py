@@ -0,0 +1,35 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Union
+import mmap
+
+# Raw content of a data file, as handed to the providers' load_buffer()
+Buffer = Union[bytes, mmap.mmap]
+
+
+def map_file(path: Union[str, Path]) -> Buffer:
+    # The parsers read the mapped page cache directly, instead of a copy of
+    # the file made by read(). Empty files can't be mapped, nor can pipes
+    # (e.g. `--data <(...)`), those are read.
+    with Path(path).open('rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return f.read()
+
+
+@contextmanager
+def mapped_file(path: Union[str, Path]) -> Iterator[Buffer]:
+    data = map_file(path)
+    try:
+        yield data
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def release(data: Buffer) -> None:
+    # For the parsers working on a decoded copy: the mapped pages would stay
+    # resident next to it until the file is closed
+    if isinstance(data, mmap.mmap) and hasattr(mmap, 'MADV_DONTNEED') and len(data):
+        data.madvise(mmap.MADV_DONTNEED)
@@ -0,0 +1,19 @@
+from collections.abc import Mapping
+from typing import Any
+
+
+def deep_merge(*values: Any) -> Any:
+    # Later values win. Mappings are merged key by key, anything else (lists
+    # included) replaces the earlier value. The inputs are left untouched, the
+    # unmerged subtrees are shared with the result.
+    result = values[0]
+    for value in values[1:]:
+        if isinstance(result, Mapping) and isinstance(value, Mapping):
+            merged = dict(result)
+            for key, item in value.items():
+                merged[key] = deep_merge(merged[key], item) if key in merged else item
+            result = merged
+        else:
+            result = value
+
+    return result
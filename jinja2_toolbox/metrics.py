@@ -0,0 +1,171 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from jinja2 import Environment
+from time import perf_counter
+from typing import Any, AsyncIterator, Iterable, Iterator, Optional
+import functools
+import json
+import os
+import sys
+
+# Numbers about each render, for capacity planning. Collection is opt-in:
+#
+#   with collect_metrics(template='page.jinja2') as record:
+#       ...  # read data, enrich, load and render templates
+#
+# fills `record` with what the toolbox hooks report while the block runs
+# (per data file size and parse time, enriched nodes, template load time and
+# compilations, render time, output bytes, peak RSS). The hooks cost nothing
+# outside of such a block. --metrics-file appends one record per job, and one
+# for the whole run, to a JSON lines file.
+
+_current_metrics: ContextVar[Optional[dict]] = ContextVar('jinja2_toolbox_metrics', default=None)
+
+
+def current_metrics() -> Optional[dict]:
+    return _current_metrics.get()
+
+
+def peak_rss() -> Optional[int]:
+    # Process-wide, in bytes. Not available on Windows
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@contextmanager
+def collect_metrics(**fields: Any) -> Iterator[dict]:
+    record = dict(fields)
+    token = _current_metrics.set(record)
+    start = perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        _current_metrics.reset(token)
+        record['seconds'] = perf_counter() - start
+        record['peak_rss_bytes'] = peak_rss()
+
+
+def write_metrics(path: str, record: dict) -> None:
+    # A single write of a single line, the --jobs workers append to the
+    # same file
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+@contextmanager
+def metrics_to_file(path: Optional[str], **fields: Any) -> Iterator[Optional[dict]]:
+    if not path:
+        yield None
+        return
+
+    record = None
+    try:
+        with collect_metrics(**fields) as record:
+            yield record
+    finally:
+        if record is not None:
+            write_metrics(path, record)
+
+
+def record_metric(name: str, value: Any) -> None:
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics[name] = value
+
+
+@contextmanager
+def measured(name: str) -> Iterator[None]:
+    # Seconds spent in the block, summed over the blocks of the same name
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield
+        return
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        metrics[name] = metrics.get(name, 0.0) + perf_counter() - start
+
+
+@contextmanager
+def data_metrics(path: str, data_type: str) -> Iterator[dict]:
+    # The entry of a data file, read_data() adds the parser and the cache
+    # outcome to it
+    metrics = _current_metrics.get()
+    entry: dict = {'path': path, 'format': data_type}
+    if metrics is None:
+        yield entry
+        return
+
+    entry['size'] = None if path == '-' else os.stat(path).st_size
+    start = perf_counter()
+    try:
+        yield entry
+    finally:
+        entry['parse_seconds'] = perf_counter() - start
+        metrics.setdefault('data', []).append(entry)
+
+
+@contextmanager
+def measured_render() -> Iterator[None]:
+    # The render time, and whether the templates it used, loaded before or
+    # during the render, all came from a cache
+    with measured('render_seconds'):
+        yield
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics['compile_cache'] = 'miss' if metrics.get('templates_compiled') else 'hit'
+
+
+def _count_output(metrics: dict, chunk: str) -> None:
+    metrics['output_bytes'] = metrics.get('output_bytes', 0) + len(chunk.encode())
+
+
+def counted_output(chunks: Iterable[str]) -> Iterable[str]:
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return chunks
+
+    def counted() -> Iterator[str]:
+        for chunk in chunks:
+            _count_output(metrics, chunk)
+            yield chunk
+
+    return counted()
+
+
+def counted_output_async(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return chunks
+
+    async def counted() -> AsyncIterator[str]:
+        async for chunk in chunks:
+            _count_output(metrics, chunk)
+            yield chunk
+
+    return counted()
+
+
+def install_metrics(env: Environment) -> None:
+    # Counts the templates compiled while collecting: none means they all
+    # came from the environment's cache, the bytecode cache or --precompiled
+    compile_template = env.compile
+
+    @functools.wraps(compile_template)
+    def counted_compile(*args: Any, **kwargs: Any) -> Any:
+        metrics = _current_metrics.get()
+        if metrics is not None:
+            metrics['templates_compiled'] = metrics.get('templates_compiled', 0) + 1
+        return compile_template(*args, **kwargs)
+
+    env.compile = counted_compile
@@ -0,0 +1,88 @@
+from itertools import islice
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Iterator, TextIO
+import hashlib
+import os
+import stat
+
+
+def buffered(chunks: Iterable[str], buffer_size: int) -> Iterator[str]:
+    if buffer_size <= 1:
+        yield from chunks
+        return
+
+    # islice + join keep the grouping loop in C
+    chunks = iter(chunks)
+    while True:
+        buffer = ''.join(islice(chunks, buffer_size))
+        if not buffer:
+            return
+        yield buffer
+
+
+async def buffered_async(chunks: AsyncIterator[str], buffer_size: int) -> AsyncIterator[str]:
+    # Same grouping for the generate_async() of --j2_enable_async environments
+    buffer = []
+    async for chunk in chunks:
+        buffer.append(chunk)
+        if len(buffer) >= buffer_size:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _file_digest(path: Path) -> bytes:
+    digest = hashlib.sha256()
+    with path.open('rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def _same_content(a: Path, b: Path) -> bool:
+    try:
+        if a.stat().st_size != b.stat().st_size:
+            return False
+    except FileNotFoundError:
+        return False
+    return _file_digest(a) == _file_digest(b)
+
+
+def write_file_atomically(path: Path, chunks: Iterable[str]) -> bool:
+    # The temporary file lives next to the target so that the final rename
+    # stays within one file system, which is what makes it atomic
+    tmp_path = path.with_name(f'.{path.name}.{os.urandom(8).hex()}.tmp')
+    try:
+        with tmp_path.open('x') as f:
+            f.writelines(chunks)
+
+        if _same_content(tmp_path, path):
+            # Leaves the mtime alone, nothing downstream gets rebuilt
+            tmp_path.unlink()
+            return False
+
+        if path.exists():
+            os.chmod(tmp_path, stat.S_IMODE(path.stat().st_mode))
+        os.replace(tmp_path, path)
+        return True
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def write_output(output: str, chunks: Iterable[str], stdout: TextIO,
+                 buffer_size: int = 0, flush: bool = False, atomic: bool = False) -> None:
+    chunks = buffered(chunks, buffer_size)
+    if output is None or output == '-':
+        for chunk in chunks:
+            stdout.write(chunk)
+            # Pushes the chunk through a block-buffered stdout (e.g. a pipe)
+            # right away instead of when rendering ends
+            if flush:
+                stdout.flush()
+    elif atomic:
+        write_file_atomically(Path(output), chunks)
+    else:
+        with Path(output).open('w') as f:
+            f.writelines(chunks)
@@ -0,0 +1,93 @@
+import argparse
+from jinja2 import Environment
+from pathlib import Path
+from typing import Optional
+from .bytecode_cache import environment_fingerprint
+import compileall
+import json
+import os
+import py_compile
+import shutil
+
+# Templates compiled ahead of time by `jinja2-toolbox precompile` into a
+# directory of Python modules, one per template, which --precompiled loads
+# through a ModuleLoader: nothing is lexed, parsed or compiled at run time.
+# The generated code depends on the environment options, the directory
+# records their fingerprint and is refused by an environment that differs.
+
+FINGERPRINT_FILE = 'jinja2-toolbox-precompiled.json'
+
+
+def write_precompiled(env: Environment, target: str, extensions: Optional[list[str]] = None) -> None:
+    # Compiled next to the target and swapped in at the end, a failing
+    # template leaves the previous directory alone
+    target_path = Path(target)
+    # Only a directory written by this command is ever replaced, anything
+    # else (e.g. --output pointing at the templates) is refused
+    if target_path.exists() and not (target_path / FINGERPRINT_FILE).is_file():
+        if not target_path.is_dir() or any(target_path.iterdir()):
+            raise RuntimeError(
+                f'{target} exists and doesn\'t hold precompiled templates, refusing to replace it')
+
+    tmp_path = target_path.with_name(f'.{target_path.name}.{os.urandom(8).hex()}.tmp')
+    try:
+        env.compile_templates(tmp_path, extensions=extensions, zip=None, ignore_errors=False)
+        # The modules are byte-compiled too, importing them then doesn't even
+        # compile the Python source, nor need a writable directory. The
+        # directory is only ever replaced as a whole, the sources aren't
+        # checked against the bytecode.
+        compileall.compile_dir(tmp_path, quiet=1, workers=1,
+                               invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        (tmp_path / FINGERPRINT_FILE).write_text(json.dumps({
+            'fingerprint': environment_fingerprint(env),
+            'templates': sorted(env.list_templates(extensions=extensions)),
+        }, indent=2))
+
+        if target_path.exists() and not any(target_path.iterdir()):
+            target_path.rmdir()
+        if target_path.exists():
+            old_path = target_path.with_name(f'.{target_path.name}.{os.urandom(8).hex()}.old')
+            os.rename(target_path, old_path)
+            os.rename(tmp_path, target_path)
+            shutil.rmtree(old_path)
+        else:
+            os.rename(tmp_path, target_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def check_precompiled(env: Environment, directory: str) -> None:
+    try:
+        info = json.loads((Path(directory) / FINGERPRINT_FILE).read_text())
+    except FileNotFoundError:
+        raise RuntimeError(
+            f'{directory} holds no precompiled templates, run `jinja2-toolbox precompile` first')
+
+    if info['fingerprint'] != environment_fingerprint(env):
+        raise RuntimeError(
+            f'The templates in {directory} were precompiled with other environment options '
+            '(--j2_* options, extensions or Jinja2 version), run `jinja2-toolbox precompile` again '
+            'with the options used to render')
+
+
+def main(argv: list[str]) -> None:
+    from . import cli
+
+    ap = argparse.ArgumentParser(
+        prog='jinja2-toolbox precompile',
+        description='Compile every template of --template-dir into Python modules, with the given '
+        '--j2_* options. Render with --precompiled and the same options to skip the template '
+        'compilation altogether.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ap.add_argument('--output', required=True, help='Directory the compiled templates are written to')
+    ap.add_argument('--extension', action='append', dest='extensions',
+                    help='Only compile the templates with this file extension (e.g. jinja2). '
+                    'May be repeated. All the files of --template-dir by default')
+    cli.add_environment_args(ap)
+
+    args = ap.parse_args(argv)
+    if args.precompiled or args.bytecode_cache:
+        ap.error('--precompiled and --bytecode-cache have no use when precompiling')
+
+    write_precompiled(cli.environment_from_args(args), args.output, args.extensions)
@@ -0,0 +1,177 @@
+from contextlib import contextmanager, nullcontext
+from jinja2 import Environment, Template
+from time import perf_counter
+from typing import Any, AsyncIterator, Callable, ContextManager, Iterator, Optional, TextIO
+import functools
+import inspect
+import json
+
+# Times are inclusive: a block includes the blocks, includes and filters it
+# renders, a template includes its parent template when extending one
+
+
+class Profiler:
+    def __init__(self) -> None:
+        # (category, name) -> [calls, total seconds]
+        self.timings: dict[tuple[str, str], list] = {}
+        # Filter name -> the CacheStats of a cached_filter and their values
+        # when profiling started, the stats are per process
+        self.caches: dict[str, tuple[Any, dict]] = {}
+
+    def record(self, category: str, name: str, elapsed: float) -> None:
+        timing = self.timings.get((category, name))
+        if timing is None:
+            self.timings[(category, name)] = [1, elapsed]
+        else:
+            timing[0] += 1
+            timing[1] += elapsed
+
+    @contextmanager
+    def stage(self, category: str, name: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(category, name, perf_counter() - start)
+
+    def timed(self, category: str, name: str, func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            return self._timed_coroutine(category, name, func)
+
+        # functools.wraps also carries over the pass_context & co. markers
+        @functools.wraps(func)
+        def timed_call(*args: Any, **kwargs: Any) -> Any:
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(category, name, perf_counter() - start)
+
+        return timed_call
+
+    def _timed_coroutine(self, category: str, name: str, func: Callable) -> Callable:
+        # Async filters of --j2_enable_async environments, timed until awaited
+        @functools.wraps(func)
+        async def timed_call(*args: Any, **kwargs: Any) -> Any:
+            start = perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.record(category, name, perf_counter() - start)
+
+        return timed_call
+
+    def timed_generator(self, category: str, name: str, func: Callable) -> Callable:
+        if inspect.isasyncgenfunction(func):
+            return self._timed_async_generator(category, name, func)
+
+        # Only the time spent producing the chunks counts, not the time the
+        # consumer spends writing them
+        @functools.wraps(func)
+        def timed_generation(*args: Any, **kwargs: Any) -> Iterator:
+            elapsed = 0.0
+            start = perf_counter()
+            try:
+                for chunk in func(*args, **kwargs):
+                    elapsed += perf_counter() - start
+                    yield chunk
+                    start = perf_counter()
+                elapsed += perf_counter() - start
+            finally:
+                self.record(category, name, elapsed)
+
+        return timed_generation
+
+    def _timed_async_generator(self, category: str, name: str, func: Callable) -> Callable:
+        # The render functions of --j2_enable_async environments
+        @functools.wraps(func)
+        async def timed_generation(*args: Any, **kwargs: Any) -> AsyncIterator:
+            elapsed = 0.0
+            start = perf_counter()
+            try:
+                async for chunk in func(*args, **kwargs):
+                    elapsed += perf_counter() - start
+                    yield chunk
+                    start = perf_counter()
+                elapsed += perf_counter() - start
+            finally:
+                self.record(category, name, elapsed)
+
+        return timed_generation
+
+    def report(self) -> list[dict]:
+        return [
+            {'category': category, 'name': name, 'calls': calls, 'total': total}
+            for (category, name), (calls, total) in sorted(
+                self.timings.items(), key=lambda item: item[1][1], reverse=True)
+        ] + [
+            {'category': 'cache', 'name': name,
+             **{counter: value - start[counter] for counter, value in vars(stats).items()}}
+            for name, (stats, start) in sorted(self.caches.items())
+        ]
+
+    def write_report(self, stream: TextIO, report_format: str = 'text') -> None:
+        report = self.report()
+        if report_format == 'json':
+            json.dump(report, stream, indent=2)
+            stream.write('\n')
+            return
+
+        name_width = max([len(entry['name']) for entry in report] + [4])
+        timings = [entry for entry in report if entry['category'] != 'cache']
+        stream.write(f'{"category":<10} {"name":<{name_width}} {"calls":>8} '
+                     f'{"total ms":>11} {"mean ms":>10}\n')
+        for entry in timings:
+            stream.write(
+                f'{entry["category"]:<10} {entry["name"]:<{name_width}} {entry["calls"]:>8} '
+                f'{entry["total"] * 1e3:>11.3f} {entry["total"] * 1e3 / entry["calls"]:>10.3f}\n')
+
+        caches = [entry for entry in report if entry['category'] == 'cache']
+        if caches:
+            stream.write(f'\n{"category":<10} {"name":<{name_width}} {"hits":>8} {"misses":>8} '
+                         f'{"evictions":>10} {"hit rate":>9}\n')
+        for entry in caches:
+            lookups = entry['hits'] + entry['misses']
+            hit_rate = entry['hits'] / lookups if lookups else 0.0
+            stream.write(
+                f'{entry["category"]:<10} {entry["name"]:<{name_width}} {entry["hits"]:>8} '
+                f'{entry["misses"]:>8} {entry["evictions"]:>10} {hit_rate:>9.1%}\n')
+
+
+def profiled(profiler: Optional[Profiler], category: str, name: str) -> ContextManager:
+    return nullcontext() if profiler is None else profiler.stage(category, name)
+
+
+def profiled_template_class(profiler: Profiler) -> type:
+    class ProfiledTemplate(Template):
+        @classmethod
+        def _from_namespace(cls, environment: Environment, namespace: Any, globals: Any) -> Template:
+            template = super()._from_namespace(environment, namespace, globals)
+            template.root_render_func = profiler.timed_generator(
+                'template', template.name or '<string>', template.root_render_func)
+            template.blocks = {
+                name: profiler.timed_generator('block', f'{template.name}:{name}', render_block)
+                for name, render_block in template.blocks.items()
+            }
+            return template
+
+    return ProfiledTemplate
+
+
+def install_profiler(env: Environment, profiler: Profiler) -> None:
+    # Must run before any template is compiled: the compiled templates keep
+    # the filters they use
+    for name, func in env.filters.items():
+        if hasattr(func, 'cache_stats'):
+            profiler.caches[name] = (func.cache_stats, dict(vars(func.cache_stats)))
+        env.filters[name] = profiler.timed('filter', name, func)
+
+    compile_template = env.compile
+
+    @functools.wraps(compile_template)
+    def timed_compile(source: Any, name: Any = None, *args: Any, **kwargs: Any) -> Any:
+        with profiler.stage('compile', name or '<string>'):
+            return compile_template(source, name, *args, **kwargs)
+
+    env.compile = timed_compile
+    env.template_class = profiled_template_class(profiler)
@@ -0,0 +1,62 @@
+from typing import Any, BinaryIO, Iterator, Optional
+import json
+import struct
+
+# Frames exchanged over the render server socket: a one byte type, the
+# payload length as a big-endian uint32 and the payload itself
+REQUEST = b'R'
+OUTPUT = b'D'
+ERROR = b'E'
+DONE = b'K'
+
+_HEADER = struct.Struct('>cI')
+
+
+def write_frame(f: BinaryIO, kind: bytes, payload: bytes = b'') -> None:
+    f.write(_HEADER.pack(kind, len(payload)))
+    f.write(payload)
+
+
+def read_frame(f: BinaryIO) -> Optional[tuple[bytes, bytes]]:
+    header = f.read(_HEADER.size)
+    if not header:
+        return None
+    if len(header) != _HEADER.size:
+        raise RuntimeError('Truncated frame header')
+
+    kind, length = _HEADER.unpack(header)
+    payload = f.read(length)
+    if len(payload) != length:
+        raise RuntimeError('Truncated frame payload')
+    return kind, payload
+
+
+def write_request(f: BinaryIO, request: dict) -> None:
+    write_frame(f, REQUEST, json.dumps(request).encode())
+
+
+def read_request(f: BinaryIO) -> Any:
+    frame = read_frame(f)
+    if frame is None:
+        # The client hung up without a request, e.g. a liveness probe
+        return None
+    if frame[0] != REQUEST:
+        raise RuntimeError('Expected a render request')
+    return json.loads(frame[1])
+
+
+def read_output(f: BinaryIO) -> Iterator[str]:
+    while True:
+        frame = read_frame(f)
+        if frame is None:
+            raise RuntimeError('The render server closed the connection')
+
+        kind, payload = frame
+        if kind == OUTPUT:
+            yield payload.decode()
+        elif kind == ERROR:
+            raise RuntimeError(payload.decode())
+        elif kind == DONE:
+            return
+        else:
+            raise RuntimeError(f'Unexpected frame {kind!r}')
@@ -0,0 +1,208 @@
+from collections.abc import Mapping, Sequence
+from typing import Any, Iterator
+from .data_proxies import deplete, enrich_child, is_enriched
+from .render_scope import current_render_scope
+import functools
+import re
+
+# Path expressions select values from nested data, e.g.
+# `hosts.*.interfaces[*].ip`:
+#   name, .name, ['name'], ["name"]  the value of a mapping key
+#   [n]                              the n-th item of a sequence, negative from the end
+#   *, .*, [*]                       every value of a mapping or item of a sequence
+_BRACKETED = re.compile(r'''\[(?:
+    (?P<star>\*) | (?P<index>-?\d+) | '(?P<single_quoted>[^']*)' | "(?P<double_quoted>[^"]*)"
+)\]''', re.VERBOSE)
+_DOTTED = re.compile(r'''(?P<star>\*)|(?P<name>[^.\[\]*'"]+)''')
+
+_KEY = 'key'
+_INDEX = 'index'
+_WILDCARD = 'wildcard'
+
+
+@functools.lru_cache(maxsize=256)
+def compile_query(path: str) -> tuple[tuple[str, Any], ...]:
+    steps = []
+    pos = 0
+    while pos < len(path):
+        m = _BRACKETED.match(path, pos)
+        if m is None:
+            # Dotted segments are separated by dots, only the first one goes without
+            if pos > 0 and path[pos] == '.':
+                pos += 1
+            m = _DOTTED.match(path, pos) if pos == 0 or path[pos - 1] == '.' else None
+        if m is None:
+            raise RuntimeError(f'Invalid query {path!r} at position {pos}')
+
+        groups = m.groupdict()
+        if groups['star']:
+            steps.append((_WILDCARD, None))
+        elif groups.get('index') is not None:
+            steps.append((_INDEX, int(groups['index'])))
+        else:
+            key = groups.get('name')
+            if key is None:
+                key = groups['single_quoted'] if groups['single_quoted'] is not None \
+                    else groups['double_quoted']
+            steps.append((_KEY, key))
+
+        pos = m.end()
+
+    return tuple(steps)
+
+
+def _is_mapping(value: Any) -> bool:
+    # The plain containers the parsers produce skip the (slower) ABC checks
+    return isinstance(value, dict) or isinstance(value, Mapping)
+
+
+def _is_sequence(value: Any) -> bool:
+    return isinstance(value, list) or (isinstance(value, Sequence) and not isinstance(value, str))
+
+
+def _select(steps: tuple[tuple[str, Any], ...], values: list) -> list:
+    # Step by step over all the current matches, the values that don't have
+    # the selected key or index are dropped
+    for kind, arg in steps:
+        if kind == _KEY:
+            values = [value[arg] for value in values if _is_mapping(value) and arg in value]
+        elif kind == _INDEX:
+            values = [
+                value[arg] for value in values
+                if _is_sequence(value) and -len(value) <= arg < len(value)
+            ]
+        else:
+            selected = []
+            for value in values:
+                if _is_mapping(value):
+                    selected.extend(value.values())
+                elif _is_sequence(value):
+                    selected.extend(value)
+            values = selected
+
+    return values
+
+
+def _select_enriched(steps: tuple[tuple[str, Any], ...], data: Any) -> list:
+    # Same as _select on the raw values, every match keeping the position of
+    # the match it was selected from and its key or index. The proxies are
+    # only built afterwards, along the paths of the final matches: the
+    # siblings a wildcard expands and a later step drops never get one.
+    # Going through the proxies keeps the `.parent` of the matches and the
+    # identity of memoized children.
+    values = [deplete(data)]
+    levels = []
+    for kind, arg in steps:
+        selected: list = []
+        links: list = []
+        for pos, value in enumerate(values):
+            if kind == _KEY:
+                if _is_mapping(value) and arg in value:
+                    selected.append(value[arg])
+                    links.append((pos, arg))
+            elif kind == _INDEX:
+                if _is_sequence(value) and -len(value) <= arg < len(value):
+                    selected.append(value[arg])
+                    links.append((pos, arg))
+            elif _is_mapping(value):
+                selected.extend(value.values())
+                links.extend([(pos, key) for key in value])
+            elif _is_sequence(value):
+                selected.extend(value)
+                links.extend([(pos, i) for i in range(len(value))])
+        values = selected
+        levels.append((links, values))
+
+    # The positions on the surviving paths, level by level up from the final
+    # matches. None when every match of a level is on one.
+    needed: list = [None]
+    for (links, _values), (parents, parent_values) in zip(levels[:0:-1], levels[-2::-1]):
+        if needed[-1] is None:
+            positions = {pos for pos, _key in links}
+        else:
+            positions = {links[pos][0] for pos in needed[-1]}
+        needed.append(None if len(positions) == len(parent_values) else positions)
+    needed.reverse()
+
+    nodes: Any = [data]
+    for (links, values), positions in zip(levels, needed):
+        if positions is None:
+            nodes = [enrich_child(nodes[parent], key, value)
+                     for (parent, key), value in zip(links, values)]
+        else:
+            nodes = {pos: enrich_child(nodes[links[pos][0]], links[pos][1], values[pos])
+                     for pos in positions}
+
+    return nodes
+
+
+def query(data: Any, path: str) -> list:
+    steps = compile_query(path)
+    if is_enriched(data):
+        return _select_enriched(steps, data)
+    else:
+        return _select(steps, [data])
+
+
+class SequenceIndex(Mapping):
+    # Read-only view of a sequence by key. The items are looked up in the
+    # sequence itself, so enriched sequences return enriched items.
+    def __init__(self, sequence: Any, positions: dict) -> None:
+        self._sequence = sequence
+        self._positions = positions
+
+    def __getitem__(self, key: Any) -> Any:
+        return self._sequence[self._positions[key]]
+
+    def __iter__(self) -> Iterator:
+        return iter(self._positions)
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+
+def _index_positions(sequence: Any, steps: tuple[tuple[str, Any], ...], path: str) -> dict:
+    # Key -> position of the first item with that key, the items without
+    # the key are left out
+    positions: dict = {}
+    i = value = None
+    try:
+        if len(steps) == 1 and steps[0][0] == _KEY:
+            key = steps[0][1]
+            for i, item in enumerate(sequence):
+                if _is_mapping(item) and key in item:
+                    value = item[key]
+                    positions.setdefault(value, i)
+        else:
+            for i, item in enumerate(sequence):
+                found = _select(steps, [item])
+                if found:
+                    value = found[0]
+                    positions.setdefault(value, i)
+    except TypeError:
+        # Unhashable, a list or a mapping
+        raise RuntimeError(
+            f'index_by({path!r}): item {i} has a {type(value).__name__} at {path!r}, '
+            'which can\'t be used as a key') from None
+
+    return positions
+
+
+def index_by(sequence: Any, path: str) -> SequenceIndex:
+    steps = compile_query(path)
+    value = deplete(sequence) if is_enriched(sequence) else sequence
+    if not _is_sequence(value):
+        raise RuntimeError(f'index_by expects a sequence, got {type(value).__name__}')
+
+    scope = current_render_scope()
+    if scope is None:
+        return SequenceIndex(sequence, _index_positions(value, steps, path))
+
+    # Memoized for the render by identity of the raw sequence, which the
+    # entry keeps alive so that its id can't be reused
+    key = ('index_by', id(value), steps)
+    entry = scope.get(key)
+    if entry is None:
+        entry = scope[key] = (value, _index_positions(value, steps, path))
+
+    return SequenceIndex(sequence, entry[1])
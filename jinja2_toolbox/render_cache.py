@@ -0,0 +1,213 @@
+from contextlib import contextmanager
+from jinja2 import Environment
+from pathlib import Path
+from typing import Iterator, Optional, TextIO
+from weakref import WeakKeyDictionary
+from .batch import RenderJob
+from .bytecode_cache import environment_fingerprint
+from .mapped import mapped_file
+from .metrics import record_metric
+from .output import _same_content
+from .watch import DependencyGraph, _stamp
+import argparse
+import errno
+import hashlib
+import os
+import shutil
+
+# Rendered outputs stored under a hash of everything they depend on: the
+# sources of the template and of the templates it includes, imports or
+# extends, the raw bytes of the data files, the environment options and the
+# data options. A hit skips the data loading and the rendering altogether.
+#
+# Templates referencing a name computed at render time, and data read from
+# the stdin, are never cached. The code of extensions and custom filters is
+# not part of the key, only their names are: clear the cache when it changes.
+
+# Bumped whenever the key or the stored entries change
+_CACHE_VERSION = 1
+
+_caches: 'WeakKeyDictionary[Environment, RenderCache]' = WeakKeyDictionary()
+
+
+class RenderCache:
+    def __init__(self, env: Environment, directory: str, max_size: int, link: bool = False) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.link = link
+
+        self.graph = DependencyGraph(env)
+        self.fingerprint = environment_fingerprint(env)
+        # Template name -> stamp of the file when its references were scanned
+        self.scanned: dict[str, Optional[tuple[int, int]]] = {}
+        # Path -> (stamp, sha256), hashed again once the file changes
+        self.digests: dict[str, tuple[Optional[tuple[int, int]], str]] = {}
+        # Bytes stored, counted once and then tracked by this process
+        self.size: Optional[int] = None
+
+    def digest(self, path: str) -> str:
+        stamp = _stamp(path)
+        cached = self.digests.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        with mapped_file(path) as data:
+            digest = hashlib.sha256(data).hexdigest()
+        self.digests[path] = (stamp, digest)
+        return digest
+
+    def closure(self, name: str) -> Optional[list[str]]:
+        # The template and every template it references, directly or not,
+        # None when one of them references a name computed at render time
+        self.graph.add(name)
+        closure = []
+        pending = [name]
+        while pending:
+            name = pending.pop()
+            if name in closure:
+                continue
+            stamp = _stamp(self.graph.filenames[name])
+            if self.scanned.setdefault(name, stamp) != stamp:
+                # Changed since it was scanned, e.g. in --watch mode
+                self.graph.update(name)
+                self.scanned[name] = stamp
+            if name in self.graph.dynamic:
+                return None
+            closure.append(name)
+            pending.extend(self.graph.references[name])
+        return closure
+
+    def key(self, job: RenderJob, args: argparse.Namespace) -> Optional[str]:
+        if '-' in job.data_files:
+            return None
+        closure = self.closure(job.template)
+        if closure is None:
+            return None
+
+        try:
+            templates = sorted((name, self.digest(self.graph.filenames[name])) for name in closure)
+            data = [self.digest(path) for path in job.data_files]
+        except FileNotFoundError:
+            # Rendered as usual, for the render to report the missing file
+            return None
+
+        key = (
+            _CACHE_VERSION,
+            self.fingerprint,
+            job.template,
+            templates,
+            data,
+            job.data_format or args.data_format,
+            tuple(args.data_backend),
+            args.enrich,
+            args.enrich_memoize,
+        )
+        return hashlib.sha256(repr(key).encode()).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory / f'{key}.out'
+
+    def fetch(self, key: str, output: str, stdout: TextIO, atomic: bool = False,
+              record_hit: bool = True) -> bool:
+        path = self.path(key)
+        try:
+            if record_hit:
+                # Before anything is written, a missing entry raises here
+                record_metric('output_bytes', path.stat().st_size)
+                record_metric('render_cache', 'hit')
+
+            if output is None or output == '-':
+                with path.open() as f:
+                    shutil.copyfileobj(f, stdout)
+                return True
+
+            output_path = Path(output)
+            if atomic and _same_content(path, output_path):
+                # As --atomic-output does, the unchanged output keeps its mtime
+                return True
+
+            # Outputs are always replaced, never written to in place, so that
+            # a hard link doesn't write through to the cache entry
+            tmp_path = output_path.with_name(f'.{output_path.name}.{os.urandom(8).hex()}.tmp')
+            try:
+                if not (self.link and self.hard_link(path, tmp_path)):
+                    shutil.copyfile(path, tmp_path)
+                    # Marks the entry as recently used for the eviction. A
+                    # linked entry is left alone, its mtime is the output's too
+                    os.utime(path)
+                os.replace(tmp_path, output_path)
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
+            return True
+        except FileNotFoundError:
+            if not path.exists():
+                # Not cached yet, or evicted meanwhile
+                return False
+            raise
+
+    def hard_link(self, path: Path, link_path: Path) -> bool:
+        # False when the output is on another file system than the cache,
+        # it is copied then
+        try:
+            os.link(path, link_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            return False
+        return True
+
+    @contextmanager
+    def new_entry(self, key: str) -> Iterator[Path]:
+        # Yields the path to render into, which becomes the entry once the
+        # render succeeded. Concurrent writers of the same entry write the
+        # same content, the last rename wins.
+        path = self.path(key)
+        tmp_path = path.with_name(f'.{path.name}.{os.urandom(8).hex()}.tmp')
+        try:
+            yield tmp_path
+            size = tmp_path.stat().st_size
+            os.replace(tmp_path, path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        if self.size is None:
+            self.size = sum(st.st_size for st, _entry in self.listing())
+        else:
+            self.size += size
+        if self.size > self.max_size:
+            self.evict(keep=path)
+
+    def listing(self) -> list[tuple[os.stat_result, Path]]:
+        # Other processes may evict entries meanwhile
+        listing = []
+        for entry in self.directory.glob('*.out'):
+            try:
+                listing.append((entry.stat(), entry))
+            except FileNotFoundError:
+                pass
+        return listing
+
+    def evict(self, keep: Path) -> None:
+        # Least recently used first. The entries written by other processes
+        # are counted here, when the directory is listed again.
+        listing = sorted(self.listing(), key=lambda item: item[0].st_mtime_ns)
+        self.size = sum(st.st_size for st, _entry in listing)
+        for st, entry in listing:
+            if self.size <= self.max_size:
+                break
+            if entry != keep:
+                entry.unlink(missing_ok=True)
+                self.size -= st.st_size
+
+
+def render_cache_for(env: Environment, args: argparse.Namespace) -> RenderCache:
+    # One per environment, its dependency graph and digests are reused
+    # by the following jobs
+    cache = _caches.get(env)
+    if cache is None:
+        cache = _caches[env] = RenderCache(
+            env, args.render_cache, int(args.render_cache_size * (1 << 20)), args.render_cache_link)
+    return cache
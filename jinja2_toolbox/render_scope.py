@@ -0,0 +1,22 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+# Values computed by filters and globals that stay valid for a single render,
+# such as the indexes of index_by. The toolbox opens a scope around every
+# render, outside of one nothing is memoized.
+_render_scope: ContextVar[Optional[dict]] = ContextVar('jinja2_toolbox_render_scope', default=None)
+
+
+@contextmanager
+def render_scope() -> Iterator[dict]:
+    scope: dict = {}
+    token = _render_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _render_scope.reset(token)
+
+
+def current_render_scope() -> Optional[dict]:
+    return _render_scope.get()
@@ -0,0 +1,181 @@
+from collections import OrderedDict
+from jinja2 import Environment, Template
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterator, Optional
+from . import cli
+from .data_proxies import enrich
+from .merge import deep_merge
+from .output import buffered, buffered_async
+from .protocol import OUTPUT, ERROR, DONE, write_frame, read_request
+from .render_scope import render_scope
+import argparse
+import asyncio
+import io
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+
+class ParsedDataCache:
+    # Parsed data files, reused as long as their size and mtime don't change
+    def __init__(self, max_entries: int, cache_dir: Optional[str] = None, lazy: bool = False) -> None:
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.lazy = lazy
+        self._entries: OrderedDict[tuple, tuple[tuple[int, int], Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, datapath: str, data_format: Optional[str],
+             backend_overrides: tuple[str, ...]) -> Any:
+        st = os.stat(datapath)
+        stamp = (st.st_size, st.st_mtime_ns)
+        key = (datapath, data_format, backend_overrides)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(key)
+                return entry[1]
+
+        data = cli.read_data(datapath, data_format, backend_overrides, self.cache_dir, self.lazy)
+
+        with self._lock:
+            self._entries[key] = (stamp, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return data
+
+
+class RenderRequestHandler(socketserver.StreamRequestHandler):
+    # Buffered, flushed after every output frame
+    wbufsize = 1 << 16
+
+    def handle(self) -> None:
+        try:
+            request = read_request(self.rfile)
+            if request is None:
+                return
+
+            with render_scope():
+                if self.server.env.is_async:
+                    asyncio.run(self.write_output_async(request))
+                else:
+                    for chunk in self.server.render(request):
+                        self.write_output(chunk)
+            write_frame(self.wfile, DONE)
+        except Exception as e:
+            write_frame(self.wfile, ERROR, f'{type(e).__name__}: {e}'.encode())
+
+    def write_output(self, chunk: str) -> None:
+        write_frame(self.wfile, OUTPUT, chunk.encode())
+        self.wfile.flush()
+
+    async def write_output_async(self, request: dict) -> None:
+        # Every connection has its own thread, hence its own event loop
+        async for chunk in self.server.render_async(request):
+            self.write_output(chunk)
+
+
+class RenderServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, env: Environment, args: argparse.Namespace) -> None:
+        self.env = env
+        self.args = args
+        self.data_cache = ParsedDataCache(args.data_cache_entries, args.data_cache, args.lazy_data)
+        super().__init__(socket_path, RenderRequestHandler)
+
+    def server_bind(self) -> None:
+        # The socket is created private, clients may have the server read any
+        # file. A chmod() after bind() would leave it open meanwhile.
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def server_close(self) -> None:
+        super().server_close()
+        # A socket left behind only gets in the way of the next start
+        Path(self.server_address).unlink(missing_ok=True)
+
+    def prepare(self, request: dict) -> tuple[Template, Any]:
+        data_format = request.get('data_format') or self.args.data_format
+        backend_overrides = tuple(request.get('data_backend') or self.args.data_backend)
+
+        if request.get('data_content') is not None:
+            if not data_format:
+                raise RuntimeError('The data format must be specified for inline data')
+            template_context = cli.get_provider(data_format)(backend_overrides).load(
+                io.StringIO(request['data_content']))
+        else:
+            datapaths = request['data']
+            if isinstance(datapaths, str):
+                datapaths = [datapaths]
+            template_context = deep_merge(*(
+                self.data_cache.load(datapath, data_format, backend_overrides)
+                for datapath in datapaths
+            ))
+
+        memoize = request.get('enrich_memoize', self.args.enrich_memoize)
+        if request.get('enrich', self.args.enrich) or memoize:
+            template_context = enrich(template_context, memoize=memoize)
+
+        # auto_reload (on by default) recompiles the templates whose files
+        # changed, the others come from the environment cache
+        return self.env.get_template(request['template']), template_context
+
+    def render(self, request: dict) -> Iterator[str]:
+        template, template_context = self.prepare(request)
+        return buffered(template.generate(**template_context), self.args.stream_buffer)
+
+    def render_async(self, request: dict) -> AsyncIterator[str]:
+        template, template_context = self.prepare(request)
+        return buffered_async(template.generate_async(**template_context), self.args.stream_buffer)
+
+
+def prepare_socket_path(socket_path: str) -> None:
+    if not os.path.exists(socket_path):
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            # Left behind by a server that is gone
+            os.unlink(socket_path)
+            return
+
+    raise RuntimeError(f'A render server is already listening on {socket_path}')
+
+
+def main(argv: list[str]) -> None:
+    ap = argparse.ArgumentParser(
+        prog='jinja2-toolbox serve',
+        description='Render server keeping a warm Jinja2 environment. '
+        'Use jinja2-toolbox-client to send it render requests.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ap.add_argument('--socket', required=True, help='Unix socket path to listen on')
+    ap.add_argument('--stream-buffer', type=int, default=256,
+                    help='Number of rendered template chunks sent to the client at once')
+    ap.add_argument('--data-cache-entries', type=int, default=32,
+                    help='Number of parsed data files kept in memory')
+    cli.add_data_args(ap)
+    cli.add_environment_args(ap)
+
+    args = ap.parse_args(argv)
+
+    env = cli.environment_from_args(args)
+
+    # Stopped by a service manager: serve_forever() unwinds and the socket
+    # is closed and removed as on ^C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    prepare_socket_path(args.socket)
+    with RenderServer(args.socket, env, args) as server:
+        server.serve_forever()
@@ -0,0 +1,229 @@
+import argparse
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any, BinaryIO, Iterable, Iterator, Optional, TextIO
+from .backends import select_backend
+from .mapped import Buffer, mapped_file
+import hashlib
+import marshal
+import os
+import pickle
+import struct
+import sys
+
+# Binary snapshots of parsed data files, written by `jinja2-toolbox
+# compile-data`. Loading one skips the parser altogether:
+#
+#   magic | version | marshal version | Python major, minor | header codec |
+#   header length | header | payloads
+#
+# The header records the source file and an index of the payloads, one per
+# top-level key, so the values are decoded from the mapped file only when
+# a template reads them. Payloads are marshalled, which is the fastest to
+# load, or pickled for the values marshal can't encode (YAML dates, ...).
+# Pickles run code when loaded: only use snapshots you compiled yourself.
+# marshal data isn't portable across Python versions, a snapshot is only
+# loaded by the Python version (and marshal format) that compiled it.
+
+MAGIC = b'J2SNAP'
+VERSION = 2
+EXTENSION = 'j2snap'
+
+_PREAMBLE = struct.Struct('<6sBBBBBI')
+_MARSHAL = 0
+_PICKLE = 1
+
+
+def _encode(value: Any) -> tuple[int, bytes]:
+    try:
+        return _MARSHAL, marshal.dumps(value)
+    except ValueError:
+        return _PICKLE, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _decode(codec: int, data: Any) -> Any:
+    return marshal.loads(data) if codec == _MARSHAL else pickle.loads(data)
+
+
+def _file_digest(path: Path) -> str:
+    with mapped_file(path) as data:
+        return hashlib.sha256(data).hexdigest()
+
+
+def write_snapshot(f: BinaryIO, data: Any, source: dict) -> None:
+    if isinstance(data, Mapping):
+        entries = [(key, _encode(value)) for key, value in data.items()]
+    else:
+        entries = [(None, _encode(data))]
+
+    index = []
+    offset = 0
+    for key, (codec, payload) in entries:
+        index.append((key, offset, len(payload), codec))
+        offset += len(payload)
+
+    header_codec, header = _encode({
+        'source': source,
+        'mapping': isinstance(data, Mapping),
+        'index': index,
+    })
+    f.write(_PREAMBLE.pack(MAGIC, VERSION, marshal.version, *sys.version_info[:2], header_codec,
+                           len(header)))
+    f.write(header)
+    for _key, (_codec, payload) in entries:
+        f.write(payload)
+
+
+def read_header(data: Buffer) -> tuple[dict, int]:
+    # The header and the offset of the first payload
+    if len(data) < _PREAMBLE.size:
+        raise RuntimeError('Not a data snapshot: the file is truncated')
+    magic, version, marshal_version, major, minor, codec, length = _PREAMBLE.unpack_from(data)
+    if magic != MAGIC:
+        raise RuntimeError('Not a data snapshot, compile one with `jinja2-toolbox compile-data`')
+    if version != VERSION:
+        raise RuntimeError(f'Unsupported data snapshot version {version}, compile it again')
+    if (marshal_version, major, minor) != (marshal.version, *sys.version_info[:2]):
+        raise RuntimeError(
+            f'The data snapshot was compiled by Python {major}.{minor} (marshal version '
+            f'{marshal_version}), it can\'t be loaded by Python {sys.version_info[0]}.'
+            f'{sys.version_info[1]} (marshal version {marshal.version}). Compile it again with '
+            '`jinja2-toolbox compile-data`')
+
+    start = _PREAMBLE.size
+    with memoryview(data) as view:
+        header = _decode(codec, view[start:start + length])
+    return header, start + length
+
+
+def stale_reason(source: dict) -> Optional[str]:
+    # A source file that is gone doesn't make the snapshot stale, it may have
+    # been shipped on its own
+    path = Path(source['path'])
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+
+    if (st.st_size, st.st_mtime_ns) == (source['size'], source['mtime_ns']):
+        return None
+    # Touched but not changed, e.g. by a checkout
+    if _file_digest(path) == source['sha256']:
+        return None
+    return f'{path} changed since the snapshot was compiled'
+
+
+class Snapshot(Mapping):
+    # The values are decoded on first access and kept. The buffer stays
+    # mapped for as long as the snapshot is alive.
+    def __init__(self, data: Buffer, start: int, index: list) -> None:
+        self._data = data
+        self._payloads = {key: (start + offset, length, codec) for key, offset, length, codec in index}
+        self._values: dict = {}
+
+    def __getitem__(self, key: Any) -> Any:
+        try:
+            return self._values[key]
+        except KeyError:
+            offset, length, codec = self._payloads[key]
+            with memoryview(self._data) as view:
+                value = self._values[key] = _decode(codec, view[offset:offset + length])
+            return value
+
+    def __iter__(self) -> Iterator:
+        return iter(self._payloads)
+
+    def __len__(self) -> int:
+        return len(self._payloads)
+
+    def __repr__(self) -> str:
+        return f'<Snapshot with {len(self)} keys>'
+
+
+def load_snapshot(data: Buffer, check_source: bool = True) -> Any:
+    header, start = read_header(data)
+    if check_source:
+        reason = stale_reason(header['source'])
+        if reason is not None:
+            raise RuntimeError(
+                f'The data snapshot is stale: {reason}. Run `jinja2-toolbox compile-data '
+                f'{header["source"]["path"]}` again')
+
+    snapshot = Snapshot(data, start, header['index'])
+    return snapshot if header['mapping'] else snapshot[None]
+
+
+class SnapshotProvider:
+    BACKENDS = {
+        'marshal': lambda: True,
+    }
+
+    # load_buffer() keeps the buffer to decode the values from it later, the
+    # caller must not close it
+    KEEPS_BUFFER = True
+
+    def __init__(self, backend_overrides: Iterable[str] = ()) -> None:
+        self.backend = select_backend(EXTENSION, self.BACKENDS, backend_overrides)
+
+    def load(self, f: TextIO) -> Any:
+        # Snapshots are binary, stdin is read through its underlying buffer
+        return self.load_buffer(getattr(f, 'buffer', f).read())
+
+    def load_buffer(self, data: Buffer) -> Any:
+        return load_snapshot(data)
+
+
+def compile_data(source: str, output: str, data_format: Optional[str] = None,
+                 backend_overrides: Iterable[str] = ()) -> None:
+    from . import cli
+
+    if cli.deduce_data_type(source, data_format) == EXTENSION:
+        raise RuntimeError(f'{source} is a data snapshot already')
+    st = os.stat(source)
+    data = cli.read_data(source, data_format, backend_overrides)
+
+    source_info = {
+        'path': str(Path(source).resolve()),
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'sha256': _file_digest(Path(source)),
+    }
+
+    # Written next to the output and renamed, a render reading the snapshot
+    # meanwhile sees either the old or the new one
+    output_path = Path(output)
+    tmp_path = output_path.with_name(f'.{output_path.name}.{os.urandom(8).hex()}.tmp')
+    try:
+        with tmp_path.open('xb') as f:
+            write_snapshot(f, data, source_info)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def main(argv: list[str]) -> None:
+    from . import cli
+
+    ap = argparse.ArgumentParser(
+        prog='jinja2-toolbox compile-data',
+        description='Compile a data file into a binary snapshot, loaded much faster than the data '
+        'file is parsed. Pass the snapshot as --data, it is refused once the data file changes.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ap.add_argument('source', nargs='+', help='Data file to compile')
+    ap.add_argument('--output', help=f'Snapshot path, the source path with a .{EXTENSION} suffix '
+                    'by default. Only with a single source')
+    ap.add_argument(
+        '--data-format', choices=tuple(name for name in cli.DATA_PROVIDERS if name != EXTENSION),
+        help='Override automatically-detected data format')
+    ap.add_argument(
+        '--data-backend', action='append', default=[], choices=cli.DATA_BACKENDS,
+        help='Parser to use instead of the fastest available one for its data format')
+
+    args = ap.parse_args(argv)
+    if args.output and len(args.source) > 1:
+        ap.error('--output needs a single source')
+
+    for source in args.source:
+        compile_data(source, args.output or f'{source}.{EXTENSION}', args.data_format,
+                     tuple(args.data_backend))
@@ -1,6 +1,33 @@
-from typing import TextIO, Any
-import toml
+from typing import TextIO, Any, Iterable
+from .backends import module_available, select_backend
+from .mapped import Buffer, release
+
 
 class TomlProvider:
+    BACKENDS = {
+        'tomllib': module_available('tomllib'),
+        'toml': module_available('toml'),
+    }
+
+    def __init__(self, backend_overrides: Iterable[str] = ()) -> None:
+        self.backend = select_backend('toml', self.BACKENDS, backend_overrides)
+
     def load(self, f: TextIO) -> Any:
-        return toml.load(f)
+        if self.backend == 'tomllib':
+            import tomllib
+            return tomllib.loads(f.read())
+        else:
+            import toml
+            return toml.load(f)
+
+    def load_buffer(self, data: Buffer) -> Any:
+        # Both parsers want a str, decoded straight from the buffer. tomllib's
+        # own load() would read a bytes copy first.
+        text = str(data, 'utf-8')
+        release(data)
+        if self.backend == 'tomllib':
+            import tomllib
+            return tomllib.loads(text)
+        else:
+            import toml
+            return toml.loads(text)
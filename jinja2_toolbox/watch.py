@@ -0,0 +1,172 @@
+from jinja2 import Environment, FileSystemLoader, TemplateNotFound, TemplateSyntaxError, meta
+from jinja2.loaders import split_template_path
+from typing import Callable, Iterable, Optional, TextIO
+from .batch import JobResult, RenderJob, report_failures
+import os
+import time
+
+
+class DependencyGraph:
+    # Templates referenced through include, import and extends, in both
+    # directions, so that a change to a partial finds the templates using it
+    def __init__(self, env: Environment) -> None:
+        if not isinstance(env.loader, FileSystemLoader):
+            raise RuntimeError('The template dependencies can only be tracked on the file system')
+
+        self.env = env
+        self.references: dict[str, set[str]] = {}
+        self.referrers: dict[str, set[str]] = {}
+        # Templates referencing a name computed at render time, which may
+        # then depend on any template
+        self.dynamic: set[str] = set()
+        self.filenames: dict[str, str] = {}
+
+    def add(self, name: str) -> None:
+        pending = [name]
+        while pending:
+            name = pending.pop()
+            if name not in self.references:
+                pending.extend(self.scan(name))
+
+    def update(self, name: str) -> None:
+        # Picks up the references added to a changed template
+        for reference in self.scan(name):
+            self.add(reference)
+
+    def scan(self, name: str) -> set[str]:
+        for reference in self.references.get(name, ()):
+            self.referrers[reference].discard(name)
+        self.dynamic.discard(name)
+
+        references = set()
+        try:
+            source, filename, _ = self.env.loader.get_source(self.env, name)
+            for reference in meta.find_referenced_templates(self.env.parse(source, name, filename)):
+                if reference is None:
+                    self.dynamic.add(name)
+                else:
+                    references.add(reference)
+        except TemplateNotFound:
+            # Watched at the path where it would be created
+            filename = os.path.join(self.env.loader.searchpath[0], *split_template_path(name))
+        except TemplateSyntaxError:
+            # Reported by the render, the references are found once it's fixed
+            pass
+
+        self.filenames[name] = filename
+        self.references[name] = references
+        for reference in references:
+            self.referrers.setdefault(reference, set()).add(name)
+
+        return references
+
+    def affected(self, changed: Iterable[str]) -> set[str]:
+        # The changed templates and everything referencing them, directly or not
+        pending = set(changed)
+        if pending:
+            pending |= self.dynamic
+
+        affected = set()
+        while pending:
+            name = pending.pop()
+            if name not in affected:
+                affected.add(name)
+                pending |= self.referrers.get(name, set())
+
+        return affected
+
+
+def _stamp(path: str) -> Optional[tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class Watcher:
+    # inotify isn't reachable from the standard library, the watched files are
+    # polled instead. Only the templates of the dependency graph and the data
+    # files are checked, a few hundred stat() calls per poll.
+    def __init__(self, env: Environment, jobs: list[RenderJob],
+                 render_jobs: Callable[[list[RenderJob]], list[JobResult]],
+                 stderr: TextIO, interval: float = 0.5, debounce: float = 0.2) -> None:
+        self.jobs = jobs
+        self.render_jobs = render_jobs
+        self.stderr = stderr
+        self.interval = interval
+        self.debounce = debounce
+
+        self.graph = DependencyGraph(env)
+        for job in jobs:
+            self.graph.add(job.template)
+
+        self.stamps: dict[str, Optional[tuple[int, int]]] = {}
+        self.poll()
+
+    def watched_files(self) -> dict[str, Optional[str]]:
+        # File path -> template name, None for data files
+        files: dict[str, Optional[str]] = {
+            path: None for job in self.jobs for path in job.data_files}
+        files.update((filename, name) for name, filename in self.graph.filenames.items())
+        return files
+
+    def poll(self) -> set[str]:
+        changed = set()
+        for path in self.watched_files():
+            stamp = _stamp(path)
+            if self.stamps.get(path, stamp) != stamp:
+                changed.add(path)
+            self.stamps[path] = stamp
+
+        return changed
+
+    def wait_for_changes(self) -> set[str]:
+        while True:
+            time.sleep(self.interval)
+            changed = self.poll()
+            if changed:
+                break
+
+        # Editors and checkouts touch several files in a row, they are
+        # rendered once they settle
+        while True:
+            time.sleep(self.debounce)
+            more = self.poll()
+            if not more:
+                return changed
+            changed |= more
+
+    def affected_jobs(self, changed: set[str]) -> list[RenderJob]:
+        files = self.watched_files()
+        templates = [files[path] for path in changed if files.get(path) is not None]
+        for name in templates:
+            self.graph.update(name)
+
+        # The newly referenced templates are watched from now on
+        self.poll()
+
+        affected = self.graph.affected(templates)
+        return [
+            job for job in self.jobs
+            if job.template in affected or not changed.isdisjoint(job.data_files)
+        ]
+
+    def render(self, jobs: list[RenderJob]) -> None:
+        results = self.render_jobs(jobs)
+        failed = report_failures(results, self.stderr)
+        self.stderr.write(
+            f'Rendered {len(jobs)} of {len(self.jobs)} jobs'
+            + (f', {failed} failed\n' if failed else '\n'))
+        self.stderr.flush()
+
+    def step(self, changed: set[str]) -> list[RenderJob]:
+        jobs = self.affected_jobs(changed)
+        if jobs:
+            self.render(jobs)
+        return jobs
+
+    def run(self) -> None:
+        self.render(self.jobs)
+        while True:
+            self.step(self.wait_for_changes())
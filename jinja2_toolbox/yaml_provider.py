@@ -1,8 +1,25 @@
-from typing import TextIO, Any
+from typing import TextIO, Any, Iterable
+from .backends import select_backend
+from .mapped import Buffer
 import yaml
 
+
 class YamlProvider:
+    BACKENDS = {
+        'libyaml': lambda: yaml.__with_libyaml__,
+        'pyyaml': lambda: True,
+    }
+
+    def __init__(self, backend_overrides: Iterable[str] = ()) -> None:
+        self.backend = select_backend('yaml', self.BACKENDS, backend_overrides)
+
     def load(self, f: TextIO) -> Any:
         # TODO: Think if unsafe load? The tool may leverage that 
         # to execute custom python code...
-        return yaml.safe_load(f)
+        loader = yaml.CSafeLoader if self.backend == 'libyaml' else yaml.SafeLoader
+        return yaml.load(f, Loader=loader)
+
+    def load_buffer(self, data: Buffer) -> Any:
+        # Both parsers read a mapped file in chunks, like any binary file
+        loader = yaml.CSafeLoader if self.backend == 'libyaml' else yaml.SafeLoader
+        return yaml.load(data, Loader=loader)
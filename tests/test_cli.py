@@ -1,8 +1,17 @@
 import io
+import math
+import os
+import subprocess
+import sys
+from pathlib import Path
 from pyfakefs.fake_filesystem import FakeFilesystem
 from dataclasses import dataclass
 from jinja2_toolbox.cli import main as toolbox_main
 from jinja2_toolbox.data_proxies import *
+from jinja2_toolbox.output import write_output
+from jinja2_toolbox.json_provider import JsonProvider
+from jinja2_toolbox.yaml_provider import YamlProvider
+from jinja2_toolbox.toml_provider import TomlProvider
 import pytest
 
 
@@ -192,6 +201,21 @@ test_cases = (
         ],
         expected_stdout="{'bar': [1, 2, 3]} [1, 2, 3]",
     ),
+    Case(
+        'Memoized enrichment',
+        argv=[
+            'template.jinja2',
+            '--data-format', 'json',
+            '--enrich-memoize',
+        ],
+        stdin='{"foo": {"bar": [1, 2, 3]} }',
+        files=[
+            File('template.jinja2',
+                 '{{ foo.bar is sameas foo.bar }} {{ foo.bar.parent is sameas foo }} '
+                 '{{ foo.bar.depleted }} {{ foo.bar.2.parent.parent.bar | length }}'),
+        ],
+        expected_stdout='True True [1, 2, 3] 3',
+    ),
     Case(
         'Proxy mapping is recognised as mapping',
         argv=[
@@ -376,6 +400,193 @@ test_cases = (
         expected_exception=True
     ),
 
+    Case(
+        'Streaming output to stdout',
+        argv=[
+            'template.jinja2',
+            '--data', 'data.json',
+            '--stream',
+            '--stream-buffer', '1',
+        ],
+        files=[
+            File('data.json', '{"x": [1, 2, 3]}'),
+            File('template.jinja2', '{% for i in x %}<{{ i }}>{% endfor %}'),
+        ],
+        expected_stdout='<1><2><3>',
+    ),
+    Case(
+        'Streaming output to a file',
+        argv=[
+            'template.jinja2',
+            '--data', 'data.json',
+            '--output', 'out.txt',
+            '--stream',
+        ],
+        files=[
+            File('data.json', '{"x": [1, 2, 3]}'),
+            File('template.jinja2', '{% for i in x %}<{{ i }}>{% endfor %}'),
+        ],
+        expected_files=[
+            File('out.txt', '<1><2><3>'),
+        ],
+    ),
+    Case(
+        'Streaming output error',
+        argv=[
+            'template.jinja2',
+            '--data', 'data.json',
+            '--stream',
+            '--stream-buffer', '1',
+        ],
+        files=[
+            File('data.json', '{"x": [1, 2, 3]}'),
+            File('template.jinja2', '{% for i in x %}<{{ i }}>{% endfor %}{{ y }}'),
+        ],
+        expected_stdout='<1><2><3>',
+        expected_exception=True,
+    ),
+
+    Case(
+        'Atomic output',
+        argv=[
+            'template.jinja2',
+            '--data', 'data.json',
+            '--output', 'out/out.txt',
+            '--atomic-output',
+        ],
+        files=[
+            File('data.json', '{"x": 1}'),
+            File('template.jinja2', 'x={{ x }}'),
+            File('out/out.txt', 'stale'),
+        ],
+        expected_files=[
+            File('out/out.txt', 'x=1'),
+        ],
+    ),
+
+    Case(
+        'Data backend override',
+        argv=[
+            'template.jinja2',
+            '--data', 'data.yaml',
+            '--data-backend', 'pyyaml',
+            '--data-backend', 'json',
+        ],
+        files=[
+            File('data.yaml', 'foo: [1, 2]'),
+            File('template.jinja2', '{{ foo | sum }}'),
+        ],
+        expected_stdout='3',
+    ),
+    # Batch mode tests
+    Case(
+        'Batch manifest rendering',
+        argv=['--manifest', 'jobs.yaml'],
+        files=[
+            File('jobs.yaml', '\n'.join((
+                '- {template: a.jinja2, data: one.json, output: a-one.txt}',
+                '- {template: b.jinja2, data: one.json, output: b-one.txt}',
+                '- {template: a.jinja2, data: two.yaml}',
+            ))),
+            File('a.jinja2', 'A={{ x }}'),
+            File('b.jinja2', 'B={{ x }}'),
+            File('one.json', '{"x": 1}'),
+            File('two.yaml', 'x: 2'),
+        ],
+        expected_files=[
+            File('a-one.txt', 'A=1'),
+            File('b-one.txt', 'B=1'),
+        ],
+        expected_stdout='A=2',
+    ),
+    Case(
+        'Batch manifest with a jobs table',
+        argv=['--manifest', 'jobs.toml'],
+        files=[
+            File('jobs.toml', '\n'.join((
+                '[[jobs]]',
+                'template = "a.jinja2"',
+                'data = "one.json"',
+            ))),
+            File('a.jinja2', 'A={{ x }}'),
+            File('one.json', '{"x": 1}'),
+        ],
+        expected_stdout='A=1',
+    ),
+    Case(
+        'Batch manifest with an invalid job',
+        argv=['--manifest', 'jobs.json'],
+        files=[
+            File('jobs.json', '[{"template": "a.jinja2"}]'),
+            File('a.jinja2', 'A={{ x }}'),
+        ],
+        expected_exception=True,
+    ),
+    Case(
+        'Batch failures do not stop the other jobs',
+        argv=['--manifest', 'jobs.json'],
+        files=[
+            File('jobs.json', '\n'.join((
+                '[',
+                '  {"template": "a.jinja2", "data": "one.json", "output": "1.txt"},',
+                '  {"template": "missing.jinja2", "data": "one.json", "output": "2.txt"},',
+                '  {"template": "a.jinja2", "data": "two.json", "output": "3.txt"}',
+                ']',
+            ))),
+            File('a.jinja2', 'A={{ x }}'),
+            File('one.json', '{"x": 1}'),
+            File('two.json', '{"x": 2}'),
+        ],
+        expected_files=[
+            File('1.txt', 'A=1'),
+            File('3.txt', 'A=2'),
+        ],
+        expected_stderr='Job missing.jinja2 (one.json -> 2.txt) failed: '
+        'TemplateNotFound: \'missing.jinja2\' not found in search path: \'.\'\n',
+        expected_exception=True,
+    ),
+    Case(
+        'Batch template by data glob matrix',
+        argv=[
+            'a.jinja2', 'b.jinja2',
+            '--data-glob', 'hosts/*.json',
+            '--output', 'out/{template_stem}-{data_stem}.txt',
+        ],
+        files=[
+            File('a.jinja2', 'A={{ x }}'),
+            File('b.jinja2', 'B={{ x }}'),
+            File('hosts/one.json', '{"x": 1}'),
+            File('hosts/two.json', '{"x": 2}'),
+            File('out/.keep', ''),
+        ],
+        expected_files=[
+            File('out/a-one.txt', 'A=1'),
+            File('out/b-one.txt', 'B=1'),
+            File('out/a-two.txt', 'A=2'),
+            File('out/b-two.txt', 'B=2'),
+        ],
+    ),
+    Case(
+        'Batch matrix to stdout',
+        argv=['a.jinja2', '--data-glob', '*.json'],
+        files=[
+            File('a.jinja2', '{{ x }};'),
+            File('2.json', '{"x": 2}'),
+            File('1.json', '{"x": 1}'),
+        ],
+        expected_stdout='1;2;',
+    ),
+    Case(
+        'Several templates without batch mode',
+        argv=['a.jinja2', 'b.jinja2', '--data', 'one.json'],
+        files=[
+            File('a.jinja2', 'A'),
+            File('b.jinja2', 'B'),
+            File('one.json', '{}'),
+        ],
+        expected_exception=True,
+    ),
+
     # Format support tests
     Case(
         'YAML .yaml file input',
@@ -452,6 +663,102 @@ test_cases = (
         ],
         expected_stdout='hello-3',
     ),
+    Case(
+        'Wildcard query filter',
+        argv=['template.jinja2', '--data', 'data.yaml'],
+        files=[
+            File('data.yaml', '\n'.join((
+                'hosts:',
+                '  web: {interfaces: [{ip: 10.0.0.1}, {ip: 10.0.0.2}]}',
+                '  db: {interfaces: [{ip: 10.0.1.1}, {name: lo}]}',
+            ))),
+            File('template.jinja2', '\n'.join((
+                "{{ hosts | query('*.interfaces[*].ip') | join(',') }}",
+                "{{ query(hosts, \"['db'].interfaces[-1].name\") }}",
+            ))),
+        ],
+        expected_stdout='10.0.0.1,10.0.0.2,10.0.1.1\n[\'lo\']',
+    ),
+    Case(
+        'Wildcard query results keep their parents when enriched',
+        argv=['template.jinja2', '--data', 'data.json', '--enrich'],
+        files=[
+            File('data.json', '{"hosts": [{"name": "a", "ports": [80, 443]}, {"name": "b", "ports": [22]}]}'),
+            File('template.jinja2',
+                 "{% for port in hosts | query('[*].ports.*') %}{{ port.parent.parent.name }}:{{ port }} "
+                 "{% endfor %}"),
+        ],
+        expected_stdout='a:80 a:443 b:22 ',
+    ),
+    Case(
+        'Invalid query',
+        argv=['template.jinja2', '--data', 'data.json'],
+        files=[
+            File('data.json', '{"a": {}}'),
+            File('template.jinja2', "{{ a | query('b..c') }}"),
+        ],
+        expected_exception=True,
+    ),
+    Case(
+        'Lookup by key with index_by',
+        argv=['template.jinja2', '--data', 'data.yaml', '--enrich', '--j2_trim_blocks'],
+        files=[
+            File('data.yaml', '\n'.join((
+                'hosts: [{name: a, ip: 10.0.0.1}, {name: b, ip: 10.0.0.2}, {name: a, ip: dup}, {ip: none}]',
+                'services: [{name: web, host: b}, {name: db, host: a}]',
+                'site: {hosts: [{meta: {id: 7}, zone: eu}]}',
+            ))),
+            File('template.jinja2', '\n'.join((
+                '{% for service in services %}',
+                "{{ service.name }}: {{ (hosts | index_by('name'))[service.host].ip }}",
+                '{% endfor %}',
+                "{{ (hosts | index_by('name')) | list }} {{ index_by(hosts, 'name').b.parent | length }}",
+                "{{ index_by(site.hosts, 'meta.id')[7].zone }}",
+            ))),
+        ],
+        expected_stdout='web: 10.0.0.2\ndb: 10.0.0.1\n[\'a\', \'b\'] 4\neu',
+    ),
+    Case(
+        'Several data files are deep merged in order',
+        argv=[
+            'template.jinja2',
+            '--data', 'base.yaml',
+            '--data', 'env.json',
+            '--data', 'host.toml',
+        ],
+        files=[
+            File('base.yaml', '\n'.join((
+                'name: base',
+                'ports: [80, 443]',
+                'db: {host: localhost, port: 5432, options: {ssl: false}}',
+            ))),
+            File('env.json', '{"ports": [8080], "db": {"host": "db.prod", "options": {"ssl": true}}}'),
+            File('host.toml', 'name = "web-1"\n[db]\nport = 6432\n'),
+            File('template.jinja2', '{{ name }} {{ ports }} {{ db.host }}:{{ db.port }} {{ db.options.ssl }}'),
+        ],
+        expected_stdout='web-1 [8080] db.prod:6432 True',
+    ),
+    Case(
+        'Data files merged over the stdin data',
+        argv=['template.jinja2', '--data', '-', '--data', 'override.json', '--data-format', 'json'],
+        stdin='{"a": 1, "b": {"c": 2, "d": 3}}',
+        files=[
+            File('override.json', '{"b": {"d": 4}}'),
+            File('template.jinja2', '{{ a }} {{ b.c }} {{ b.d }}'),
+        ],
+        expected_stdout='1 2 4',
+    ),
+    Case(
+        'Manifest jobs with several data files',
+        argv=['--manifest', 'jobs.json'],
+        files=[
+            File('jobs.json', '[{"template": "t.jinja2", "data": ["base.json", "web.json"]}]'),
+            File('base.json', '{"role": "none", "port": 80}'),
+            File('web.json', '{"role": "web"}'),
+            File('t.jinja2', '{{ role }}:{{ port }}'),
+        ],
+        expected_stdout='web:80',
+    ),
 )
 
 
@@ -491,6 +798,411 @@ def test_format_template(fs: FakeFilesystem, monkeypatch, case: Case) -> None:
     assert case.expected_stdout == stdout_mock.read()
 
 
+def test_deep_merge_leaves_its_inputs_untouched():
+    from jinja2_toolbox.merge import deep_merge
+
+    base = {'a': {'b': 1, 'c': [1, 2]}, 'd': 1}
+    override = {'a': {'c': [3]}, 'e': {'f': 1}}
+    merged = deep_merge(base, override)
+
+    assert merged == {'a': {'b': 1, 'c': [3]}, 'd': 1, 'e': {'f': 1}}
+    assert base == {'a': {'b': 1, 'c': [1, 2]}, 'd': 1}
+    assert merged['e'] is override['e']
+    assert deep_merge(base) is base
+    assert deep_merge(base, [1]) == [1]
+
+
+def test_data_cache(tmp_path, monkeypatch):
+    from jinja2_toolbox.cli import read_data
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data.yaml').write_text('a: [1, 2]\nb: 2020-01-01\n')
+
+    parsed = []
+    original_load = YamlProvider.load_buffer
+
+    def load_spy(self, data):
+        parsed.append(self.backend)
+        return original_load(self, data)
+
+    monkeypatch.setattr(YamlProvider, 'load_buffer', load_spy)
+
+    expected = read_data('data.yaml', None)
+    parsed.clear()
+
+    assert read_data('data.yaml', None, cache_dir='cache') == expected
+    assert read_data('data.yaml', None, cache_dir='cache') == expected
+    assert len(parsed) == 1
+    assert len(list((tmp_path / 'cache').iterdir())) == 1
+
+    # Any content change is a miss, even with the same size and mtime
+    stat = (tmp_path / 'data.yaml').stat()
+    (tmp_path / 'data.yaml').write_text('a: [1, 3]\nb: 2020-01-01\n')
+    os.utime(tmp_path / 'data.yaml', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert read_data('data.yaml', None, cache_dir='cache')['a'] == [1, 3]
+    assert len(parsed) == 2
+
+    # So is another parser
+    read_data('data.yaml', None, ('pyyaml',), cache_dir='cache')
+    assert parsed[-1] == 'pyyaml'
+    assert len(list((tmp_path / 'cache').iterdir())) == 3
+
+    # A corrupted entry is parsed again
+    for entry in (tmp_path / 'cache').iterdir():
+        entry.write_bytes(b'garbage')
+    assert read_data('data.yaml', None, cache_dir='cache')['a'] == [1, 3]
+    assert len(parsed) == 4
+
+    # So is one unpickling a class that no longer exists, and it is rewritten
+    for entry in (tmp_path / 'cache').iterdir():
+        entry.write_bytes(b'cjinja2_toolbox_removed\nThing\n)R.')
+    assert read_data('data.yaml', None, cache_dir='cache')['a'] == [1, 3]
+    assert read_data('data.yaml', None, cache_dir='cache')['a'] == [1, 3]
+    assert len(parsed) == 5
+
+
+def test_data_snapshot(tmp_path, monkeypatch, capsys):
+    import datetime
+    from jinja2_toolbox.cli import read_data
+    from jinja2_toolbox.snapshot import Snapshot, compile_data
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data.yaml').write_text('hosts: [{name: a}, {name: b}]\nsince: 2020-01-01\n')
+    (tmp_path / 'keys.yaml').write_text('1: one\n2020-01-01: date\n')
+    (tmp_path / 'list.json').write_text('[1, 2]')
+    (tmp_path / 'hosts.jinja2').write_text('{% for host in hosts %}{{ host.name }} {% endfor %}{{ since }}')
+
+    monkeypatch.setattr('sys.argv', ['jinja2-toolbox', 'compile-data', 'data.yaml', 'keys.yaml', 'list.json'])
+    toolbox_main()
+    snapshot = read_data('data.yaml.j2snap', None)
+    assert isinstance(snapshot, Snapshot)
+    assert dict(snapshot) == read_data('data.yaml', None)
+    assert snapshot['since'] == datetime.date(2020, 1, 1)
+    assert snapshot['hosts'] is snapshot['hosts']
+    assert read_data('list.json.j2snap', None) == [1, 2]
+    assert dict(read_data('keys.yaml.j2snap', None)) == {1: 'one', datetime.date(2020, 1, 1): 'date'}
+
+    monkeypatch.setattr('sys.argv', ['jinja2-toolbox', 'hosts.jinja2', '--data', 'data.yaml.j2snap'])
+    toolbox_main()
+    assert capsys.readouterr().out == 'a b 2020-01-01'
+
+    # Touching the source doesn't make the snapshot stale, changing it does
+    os.utime(tmp_path / 'data.yaml', ns=(0, 0))
+    read_data('data.yaml.j2snap', None)
+    (tmp_path / 'data.yaml').write_text('hosts: []\n')
+    with pytest.raises(RuntimeError, match='stale'):
+        read_data('data.yaml.j2snap', None)
+    # Nor does a source that is gone
+    (tmp_path / 'data.yaml').unlink()
+    assert read_data('data.yaml.j2snap', None)['hosts'][1] == {'name': 'b'}
+
+    for invalid in (b'', b'J2SNAP', b'{"hosts": []}' * 4):
+        (tmp_path / 'invalid.j2snap').write_bytes(invalid)
+        with pytest.raises(RuntimeError):
+            read_data('invalid.j2snap', None)
+    with pytest.raises(RuntimeError):
+        compile_data('list.json.j2snap', 'again.j2snap')
+
+    # Compiled by another Python version
+    import marshal
+    other = bytearray((tmp_path / 'list.json.j2snap').read_bytes())
+    other[7:10] = bytes((marshal.version, 3, sys.version_info[1] + 1))
+    (tmp_path / 'other.j2snap').write_bytes(other)
+    with pytest.raises(RuntimeError, match=f'compiled by Python 3.{sys.version_info[1] + 1}.*compile-data'):
+        read_data('other.j2snap', None)
+
+
+def test_query_compilation():
+    from jinja2_toolbox.query import compile_query
+
+    assert compile_query('a.*.b[*][0]["c.d"][\'e\'].f-g') == (
+        ('key', 'a'), ('wildcard', None), ('key', 'b'), ('wildcard', None), ('index', 0),
+        ('key', 'c.d'), ('key', 'e'), ('key', 'f-g'))
+    assert compile_query('[*]') == (('wildcard', None),)
+    assert compile_query('') == ()
+    assert compile_query('a.b') is compile_query('a.b')
+
+    for invalid in ('.a', 'a.', 'a..b', 'a[0]b', 'a[x]', 'a[', "a['b]"):
+        with pytest.raises(RuntimeError):
+            compile_query(invalid)
+
+
+def test_query_on_enriched_data():
+    from jinja2_toolbox.query import query
+
+    data = {'hosts': [{'name': 'a', 'ports': [80, 443]}, {'name': 'b', 'ports': [22]}]}
+    assert query(data, 'hosts[*].ports[-1]') == [443, 22]
+    assert query(data, 'hosts.*.missing') == []
+
+    for memoize in (False, True):
+        ports = query(enrich(data, memoize=memoize), 'hosts[*].ports[-1]')
+        assert ports == [443, 22]
+        assert [port.parent.parent['name'] for port in ports] == ['a', 'b']
+        assert ports[0].parent.parent.parent.depleted is data['hosts']
+
+    # Matches sharing a parent share its proxy
+    ports = query(enrich(data), 'hosts[0].ports[*]')
+    assert ports[0].parent is ports[1].parent
+
+    root = enrich(data, memoize=True)
+    assert query(root, 'hosts[1]')[0] is root['hosts'][1]
+
+
+def test_query_enriches_the_matches_only(monkeypatch):
+    from jinja2_toolbox import data_proxies
+    from jinja2_toolbox.query import query
+
+    data = {'hosts': [{'name': f'host-{i}'} for i in range(100)]}
+    data['hosts'][42]['vip'] = ['10.0.0.1', '10.0.0.2']
+    data['hosts'][7]['vip'] = []
+
+    for memoize in (False, True):
+        root = enrich(data, memoize=memoize)
+        enriched = []
+        original_enrich = data_proxies.enrich
+
+        def enrich_spy(d, *args, **kwargs):
+            enriched.append(d)
+            return original_enrich(d, *args, **kwargs)
+
+        monkeypatch.setattr(data_proxies, 'enrich', enrich_spy)
+        vips = query(root, 'hosts[*].vip[*]')
+        monkeypatch.undo()
+
+        assert vips == ['10.0.0.1', '10.0.0.2']
+        assert vips[0].parent is vips[1].parent
+        assert vips[0].parent.parent['name'] == 'host-42'
+        # The siblings the wildcard expanded and the next steps dropped
+        # never got a proxy
+        assert enriched == [data['hosts'], data['hosts'][42], data['hosts'][42]['vip'], *data['hosts'][42]['vip']]
+        if memoize:
+            assert vips[1] is root['hosts'][42]['vip'][1]
+
+
+def test_index_by_is_memoized_per_render(monkeypatch):
+    from jinja2_toolbox import query as query_module
+    from jinja2_toolbox.query import index_by
+    from jinja2_toolbox.render_scope import render_scope
+
+    hosts = [{'name': f'h{i}', 'ip': i} for i in range(10)]
+    built = []
+    original_positions = query_module._index_positions
+
+    def positions_spy(sequence, steps, path):
+        built.append(steps)
+        return original_positions(sequence, steps, path)
+
+    monkeypatch.setattr(query_module, '_index_positions', positions_spy)
+
+    with render_scope():
+        for proxies in (hosts, enrich(hosts), enrich(hosts, memoize=True)):
+            assert index_by(proxies, 'name')['h3']['ip'] == 3
+        assert index_by(hosts, 'ip')[4]['name'] == 'h4'
+    assert len(built) == 2
+
+    with render_scope():
+        index_by(hosts, 'name')
+    index_by(hosts, 'name')
+    assert len(built) == 4
+
+    with pytest.raises(RuntimeError):
+        index_by({'a': 1}, 'name')
+
+    # Keys that can't be hashed
+    monkeypatch.undo()
+    hosts[2]['name'] = ['h2', 'alias']
+    with pytest.raises(RuntimeError, match=r"index_by\('name'\): item 2 has a list at 'name'"):
+        index_by(hosts, 'name')
+    hosts[2]['name'] = {'first': 'h2'}
+    with pytest.raises(RuntimeError, match=r"index_by\('\[0\]'\): item 2 has a dict"):
+        index_by(enrich([[host['name']] for host in hosts]), '[0]')
+
+
+def test_lazy_json(tmp_path, monkeypatch, capsys):
+    import json
+    from jinja2_toolbox import lazy_json
+    from jinja2_toolbox.lazy_json import LazyJsonArray, LazyJsonObject, load_lazy_json
+
+    monkeypatch.setattr(lazy_json, 'LAZY_THRESHOLD', 64)
+    data = {
+        'name': 'a "quoted" } name',
+        'hosts': [{'name': f'h{i}', 'tags': ['x', '[y]'], 'port': 8000 + i} for i in range(5)],
+        'empty': {'list': [], 'map': {}},
+        'small': [1, 2.5, None, True],
+    }
+    (tmp_path / 'data.json').write_text(json.dumps(data, indent=2))
+
+    loaded = load_lazy_json(tmp_path / 'data.json')
+    assert isinstance(loaded, LazyJsonObject)
+    assert isinstance(loaded['hosts'], LazyJsonArray)
+    assert isinstance(loaded['small'], list)
+    assert loaded['hosts'] is loaded['hosts']
+    assert list(loaded) == list(data)
+    assert len(loaded['hosts']) == 5
+    assert loaded['hosts'][-1] == data['hosts'][-1]
+    assert loaded['hosts'][1:3] == data['hosts'][1:3]
+    assert list(loaded['hosts']) == data['hosts']
+    assert dict(loaded) == data
+
+    for text, expected in (('[]', []), (' 42 ', 42), ('{"a": [1, {"b": null}]}', {'a': [1, {'b': None}]})):
+        (tmp_path / 'value.json').write_text(text)
+        loaded = load_lazy_json(tmp_path / 'value.json')
+        assert (list(loaded) if isinstance(loaded, LazyJsonArray) else loaded) == expected
+
+    for invalid in ('', '{"a": 1,}', '{"a" 1}', '{"a": 1} 2', '{"a": [1, 2}', '{"a": "b'):
+        (tmp_path / 'invalid.json').write_text(invalid)
+        with pytest.raises((RuntimeError, ValueError)):
+            dict(load_lazy_json(tmp_path / 'invalid.json'))
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'hosts.jinja2').write_text(
+        '{% for host in hosts %}{{ host.name }}:{{ host.port }} {% endfor %}{{ hosts | length }}')
+    for flags in ((), ('--enrich',)):
+        monkeypatch.setattr('sys.argv', [
+            'jinja2-toolbox', 'hosts.jinja2', '--data', 'data.json', '--lazy-data', *flags])
+        toolbox_main()
+        assert capsys.readouterr().out == 'h0:8000 h1:8001 h2:8002 h3:8003 h4:8004 5'
+
+
+def test_profile_report(tmp_path, monkeypatch, capsys):
+    import json
+    from jinja2 import Template
+    from jinja2.filters import FILTERS
+    from jinja2_toolbox.cli import make_environment
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'base.jinja2').write_text('<{% block body %}{% endblock %}>')
+    (tmp_path / 'page.jinja2').write_text(
+        '{% extends "base.jinja2" %}{% block body %}'
+        '{{ names | map("upper") | join(",") }} {% include "part.jinja2" %}{% endblock %}')
+    (tmp_path / 'part.jinja2').write_text('{{ names | first | enrich | deplete }}')
+    (tmp_path / 'data.json').write_text('{"names": ["a", "b"]}')
+
+    monkeypatch.setattr('sys.argv', [
+        'jinja2-toolbox', 'page.jinja2', '--data', 'data.json', '--enrich',
+        '--profile', '--profile-format', 'json', '--profile-file', 'profile.json'])
+    toolbox_main()
+    assert capsys.readouterr().out == '<A,B a>'
+
+    report = json.loads((tmp_path / 'profile.json').read_text())
+    calls = {(entry['category'], entry['name']): entry['calls'] for entry in report}
+    for key in (('stage', 'environment'), ('stage', 'read data'), ('stage', 'enrich'),
+                ('stage', 'load template'), ('stage', 'render'), ('data', 'data.json'),
+                ('compile', 'page.jinja2'), ('compile', 'part.jinja2'), ('template', 'base.jinja2'),
+                ('block', 'page.jinja2:body'), ('filter', 'enrich'), ('filter', 'deplete')):
+        assert calls[key] == 1
+    assert calls[('filter', 'map')] == 1
+    totals = [entry['total'] for entry in report]
+    assert totals == sorted(totals, reverse=True)
+
+    # Nothing is instrumented without --profile
+    env = make_environment('.', {})
+    assert env.template_class is Template
+    assert env.filters['upper'] is FILTERS['upper']
+    assert 'compile' not in vars(env)
+
+
+def test_cached_filter(tmp_path, monkeypatch, capsys):
+    import asyncio
+    import json
+    from types import SimpleNamespace
+    from jinja2_toolbox.filter_cache import cached_filter
+    from jinja2_toolbox.render_scope import render_scope
+
+    calls = []
+
+    @cached_filter(maxsize=2)
+    def lookup(value, suffix=''):
+        calls.append(value)
+        return f'{value}{suffix}'
+
+    # Nothing is cached outside of a render
+    assert lookup('a') == lookup('a') == 'a'
+    assert calls == ['a', 'a']
+
+    calls.clear()
+    with render_scope():
+        # Proxies share the entries of the values they wrap, lists and dicts
+        # are frozen into keys
+        for value in ('a', enrich('a'), 'a', enrich({'x': [1]}), {'x': [1]}):
+            lookup(value)
+        assert calls == ['a', {'x': [1]}]
+        assert lookup('a', suffix='!') == 'a!'
+        # Evicts the least recently used entries, 'a' and then {'x': [1]}
+        lookup('b')
+        lookup({'x': [1]})
+        assert calls == ['a', {'x': [1]}, 'a', 'b', {'x': [1]}]
+        # Unhashable arguments go straight to the filter
+        lookup(SimpleNamespace())
+    with render_scope():
+        lookup('a')
+    assert calls[-2:] == [SimpleNamespace(), 'a']
+
+    # Equal values of different types don't share an entry
+    @cached_filter
+    def show(value):
+        return repr(value)
+
+    with render_scope():
+        assert [show(value) for value in (1, True, 1.0, [1], (1,), [True], (True,))] == [
+            '1', 'True', '1.0', '[1]', '(1,)', '[True]', '(True,)']
+    assert show.cache_stats.misses == 7
+    assert vars(lookup.cache_stats) == {'hits': 3, 'misses': 6, 'evictions': 3, 'uncacheable': 1}
+
+    process_calls = []
+
+    @cached_filter(scope='process')
+    async def upper(value):
+        process_calls.append(value)
+        return value.upper()
+
+    for _ in range(2):
+        with render_scope():
+            assert asyncio.run(upper('a')) == 'A'
+    assert process_calls == ['a']
+    upper.cache_clear()
+    assert asyncio.run(upper('a')) == 'A'
+    assert process_calls == ['a', 'a']
+
+    with pytest.raises(RuntimeError):
+        cached_filter(scope='thread')(str.upper)
+
+    # Hits and misses are in the profile report
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / 'cached_ext.py').write_text(
+        'from jinja2 import pass_context\n'
+        'from jinja2.ext import Extension\n'
+        'from jinja2_toolbox.filter_cache import cached_filter\n'
+        '\n'
+        '@cached_filter\n'
+        '@pass_context\n'
+        'def greet(context, name):\n'
+        '    return context["greeting"] + " " + name\n'
+        '\n'
+        'class CachedExt(Extension):\n'
+        '    def __init__(self, environment):\n'
+        '        super().__init__(environment)\n'
+        '        environment.filters["greet"] = greet\n')
+    (tmp_path / 'page.jinja2').write_text('{% for name in names %}{{ name | greet }};{% endfor %}')
+    (tmp_path / 'data.json').write_text('{"greeting": "hi", "names": ["a", "b", "a", "a"]}')
+    for report_format in ('json', 'text'):
+        monkeypatch.setattr('sys.argv', [
+            'jinja2-toolbox', 'page.jinja2', '--data', 'data.json', '--enrich',
+            '--j2_extensions', 'cached_ext.CachedExt',
+            '--profile', '--profile-format', report_format, '--profile-file', 'profile'])
+        toolbox_main()
+        assert capsys.readouterr().out == 'hi a;hi b;hi a;hi a;'
+
+    assert 'cache      greet                2        2          0     50.0%' in (tmp_path / 'profile').read_text()
+    monkeypatch.setattr('sys.argv', [*sys.argv[:-3], 'json', '--profile-file', 'profile'])
+    toolbox_main()
+    capsys.readouterr()
+    report = json.loads((tmp_path / 'profile').read_text())
+    assert report[-1] == {'category': 'cache', 'name': 'greet', 'hits': 2, 'misses': 2,
+                          'evictions': 0, 'uncacheable': 0}
+
+
 def test_data_proxy_repr():
     value_proxy = enrich(123, None)
     assert repr(value_proxy) == '123'
@@ -512,3 +1224,789 @@ def test_enrich_unsupported_type():
     with pytest.raises(RuntimeError) as e_info:
         enrich(io.StringIO())
     assert e_info.value.args[0] == f'Unsupported data type {type(io.StringIO())} for wrapping'
+
+
+def test_proxy_types_are_reused():
+    assert type(enrich(1)) is type(enrich(2))
+    assert type(enrich([1])) is type(enrich([2, 3]))
+    assert type(enrich({'a': 1})) is type(enrich({'b': 2}))
+    assert type(enrich({'a': 1})) is not type(enrich([1]))
+
+
+def test_memoized_proxy_identity():
+    data = {'items': [{'name': 'a'}, {'name': 'b'}]}
+    root = enrich(data, memoize=True)
+    assert root['items'] is root['items']
+    assert root['items'][1] is root['items'][-1]
+    assert root['items'][0]['name'].parent is root['items'][0]
+    assert deplete(root['items'][0]) is data['items'][0]
+    assert root['items'][0:1] == [{'name': 'a'}]
+
+    plain = enrich(data)
+    assert plain['items'] is not plain['items']
+
+
+def test_slotted_proxy_forwarding():
+    mapping_proxy = enrich({'a': [1, 2, 2]})
+    assert not hasattr(mapping_proxy, '__dict__')
+    assert isinstance(mapping_proxy, dict)
+    assert mapping_proxy.get('a') == [1, 2, 2]
+    assert dict(mapping_proxy.items()) == {'a': [1, 2, 2]}
+    assert mapping_proxy['a'].count(2) == 2
+    assert mapping_proxy['a'].parent is mapping_proxy
+    with pytest.raises(TypeError):
+        hash(mapping_proxy)
+
+    value_proxy = enrich('bar')
+    assert isinstance(value_proxy, str)
+    assert value_proxy.upper() == 'BAR'
+    assert hash(value_proxy) == hash('bar')
+    with pytest.raises(AttributeError):
+        value_proxy.value
+
+
+def test_parallel_batch(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'a.jinja2').write_text('{{ x }};')
+    (tmp_path / 'fail.jinja2').write_text('{{ y }}')
+    for i in range(20):
+        (tmp_path / f'{i:02}.json').write_text(f'{{"x": {i}}}')
+
+    monkeypatch.setattr('sys.argv', [
+        'jinja2-toolbox', 'a.jinja2', 'fail.jinja2', '--data-glob', '*.json', '--jobs', '4'])
+    with pytest.raises(RuntimeError) as e_info:
+        toolbox_main()
+    assert e_info.value.args[0] == '20 of 40 render jobs failed'
+
+    captured = capsys.readouterr()
+    assert captured.out == ''.join(f'{i};' for i in range(20))
+    assert captured.err.count("UndefinedError: 'y' is undefined") == 20
+
+
+def test_async_batch(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / 'slow_ext.py').write_text('\n'.join((
+        'import asyncio',
+        'from jinja2.ext import Extension',
+        'in_flight = []',
+        'most_in_flight = []',
+        'async def slow(value):',
+        '    in_flight.append(value)',
+        '    most_in_flight.append(len(in_flight))',
+        '    await asyncio.sleep(0.01)',
+        '    in_flight.remove(value)',
+        '    return value * 2',
+        'class SlowExt(Extension):',
+        '    def __init__(self, environment):',
+        '        super().__init__(environment)',
+        '        environment.filters["slow"] = slow',
+    )))
+    (tmp_path / 'a.jinja2').write_text('{% for i in items %}{{ i | slow }},{% endfor %};')
+    (tmp_path / 'fail.jinja2').write_text('{{ y }}')
+    for i in range(10):
+        (tmp_path / f'{i}.json').write_text(f'{{"items": [{i}, {i + 1}]}}')
+
+    argv = ['jinja2-toolbox', 'a.jinja2', 'fail.jinja2', '--data-glob', '*.json',
+            '--j2_enable_async', '--j2_extensions', 'slow_ext.SlowExt']
+    monkeypatch.setattr('sys.argv', argv)
+    with pytest.raises(RuntimeError) as e_info:
+        toolbox_main()
+    assert e_info.value.args[0] == '10 of 20 render jobs failed'
+
+    # In the job order, although the jobs overlapped
+    captured = capsys.readouterr()
+    assert captured.out == ''.join(f'{i * 2},{i * 2 + 2},;' for i in range(10))
+    assert captured.err.count("UndefinedError: 'y' is undefined") == 10
+    import slow_ext
+    assert max(slow_ext.most_in_flight) > 1
+
+    # Streamed into files, a failing job leaves no partial output behind
+    monkeypatch.setattr('sys.argv', [
+        *argv[:2], '--data-glob', '*.json', '--output', '{data_stem}.out', '--stream', '--stream-buffer', '1',
+        '--atomic-output', '--j2_enable_async', '--j2_extensions', 'slow_ext.SlowExt',
+        '--async-jobs', '1'])
+    (tmp_path / '0.out').write_text('old')
+    (tmp_path / 'a.jinja2').write_text('{% for i in items %}{{ i | slow }},{% endfor %}{{ items[5] }}')
+    with pytest.raises(RuntimeError):
+        toolbox_main()
+    assert (tmp_path / '0.out').read_text() == 'old'
+    (tmp_path / 'a.jinja2').write_text('{% for i in items %}{{ i | slow }},{% endfor %}')
+    toolbox_main()
+    assert (tmp_path / '0.out').read_text() == '0,2,'
+    assert slow_ext.most_in_flight[-1] == 1
+
+
+def test_bytecode_cache(tmp_path, monkeypatch, capsys):
+    from jinja2 import Environment
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'template.jinja2').write_text('{% for i in x %}<{{ i }}>{% endfor %}')
+    (tmp_path / 'data.json').write_text('{"x": [1, 2]}')
+
+    compiled = []
+    original_compile = Environment.compile
+
+    def compile_spy(self, source, *args, **kwargs):
+        compiled.append(source)
+        return original_compile(self, source, *args, **kwargs)
+
+    monkeypatch.setattr(Environment, 'compile', compile_spy)
+
+    def render(*extra_args):
+        monkeypatch.setattr('sys.argv', [
+            'jinja2-toolbox', 'template.jinja2', '--data', 'data.json',
+            '--bytecode-cache', 'cache', *extra_args])
+        toolbox_main()
+        return capsys.readouterr().out
+
+    assert render() == '<1><2>'
+    assert len(compiled) == 1
+    assert len(list((tmp_path / 'cache').iterdir())) == 1
+
+    assert render() == '<1><2>'
+    assert len(compiled) == 1
+
+    # Options affecting the generated code get their own cache entries
+    assert render('--j2_variable_start_string', '<<', '--j2_variable_end_string', '>>') \
+        == '<{{ i }}><{{ i }}>'
+    assert len(compiled) == 2
+    assert len(list((tmp_path / 'cache').iterdir())) == 2
+
+    (tmp_path / 'template.jinja2').write_text('{{ x | length }}')
+    assert render() == '2'
+    assert len(compiled) == 3
+
+
+def test_precompiled_templates(tmp_path, monkeypatch, capsys):
+    from jinja2 import Environment, TemplateSyntaxError
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'templates' / 'partials').mkdir(parents=True)
+    (tmp_path / 'templates' / 'page.jinja2').write_text(
+        '{% for i in x %}{% include "partials/item.jinja2" %}{% endfor %}\n')
+    (tmp_path / 'templates' / 'partials' / 'item.jinja2').write_text('<{{ i }}>')
+    (tmp_path / 'templates' / 'notes.txt').write_text('{% not a template')
+    (tmp_path / 'data.json').write_text('{"x": [1, 2]}')
+
+    def precompile(*extra_args):
+        monkeypatch.setattr('sys.argv', [
+            'jinja2-toolbox', 'precompile', '--template-dir', 'templates', '--output', 'compiled',
+            *extra_args])
+        toolbox_main()
+
+    # Every file is a template unless --extension says otherwise
+    with pytest.raises(TemplateSyntaxError):
+        precompile()
+    assert not (tmp_path / 'compiled').exists()
+    precompile('--extension', 'jinja2', '--j2_trim_blocks')
+    # Compiled again over the previous directory
+    precompile('--extension', 'jinja2', '--j2_trim_blocks')
+    assert len(list((tmp_path / 'compiled' / '__pycache__').glob('tmpl_*.pyc'))) == 2
+
+    # Directories it didn't write are never replaced, empty ones are
+    (tmp_path / 'keep').mkdir()
+    (tmp_path / 'keep' / 'file.txt').write_text('mine')
+    for output in ('keep', 'templates'):
+        monkeypatch.setattr('sys.argv', [
+            'jinja2-toolbox', 'precompile', '--template-dir', 'templates', '--output', output,
+            '--extension', 'jinja2'])
+        with pytest.raises(RuntimeError, match='refusing to replace it'):
+            toolbox_main()
+    assert (tmp_path / 'keep' / 'file.txt').read_text() == 'mine'
+    assert (tmp_path / 'templates' / 'page.jinja2').exists()
+    (tmp_path / 'empty').mkdir()
+    monkeypatch.setattr('sys.argv', [
+        'jinja2-toolbox', 'precompile', '--template-dir', 'templates', '--output', 'empty',
+        '--extension', 'jinja2'])
+    toolbox_main()
+    assert (tmp_path / 'empty' / 'jinja2-toolbox-precompiled.json').exists()
+
+    compiled = []
+    original_compile = Environment.compile
+
+    def compile_spy(self, source, *args, **kwargs):
+        compiled.append(source)
+        return original_compile(self, source, *args, **kwargs)
+
+    monkeypatch.setattr(Environment, 'compile', compile_spy)
+
+    def render(*extra_args):
+        monkeypatch.setattr('sys.argv', [
+            'jinja2-toolbox', 'page.jinja2', '--data', 'data.json', '--template-dir', 'missing',
+            '--precompiled', 'compiled', *extra_args])
+        toolbox_main()
+        return capsys.readouterr().out
+
+    assert render('--j2_trim_blocks') == '<1><2>'
+    assert compiled == []
+
+    with pytest.raises(RuntimeError, match='precompiled with other environment options'):
+        render()
+    with pytest.raises(RuntimeError, match='no use with --precompiled'):
+        render('--j2_trim_blocks', '--bytecode-cache', 'cache')
+    with pytest.raises(RuntimeError, match='no precompiled templates'):
+        render('--j2_trim_blocks', '--precompiled', 'templates')
+    with pytest.raises(RuntimeError, match='--render-cache can\'t be combined with --precompiled'):
+        render('--j2_trim_blocks', '--render-cache', 'rendered')
+
+
+def test_render_cache(tmp_path, monkeypatch, capsys):
+    import errno
+    import jinja2_toolbox.cli
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'page.jinja2').write_text('{% include "part.jinja2" %}{{ x }}')
+    (tmp_path / 'part.jinja2').write_text('<')
+    (tmp_path / 'dynamic.jinja2').write_text('{% include name %}')
+    (tmp_path / 'data.json').write_text('{"x": 1, "name": "part.jinja2"}')
+
+    rendered = []
+    original_render_to = jinja2_toolbox.cli.render_to
+
+    def render_to_spy(env, job, *args):
+        rendered.append(job.template)
+        return original_render_to(env, job, *args)
+
+    monkeypatch.setattr(jinja2_toolbox.cli, 'render_to', render_to_spy)
+
+    def render(*extra_args, template='page.jinja2', output='-'):
+        rendered.clear()
+        monkeypatch.setattr('sys.argv', [
+            'jinja2-toolbox', template, '--data', 'data.json', '--output', output,
+            '--render-cache', 'cache', *extra_args])
+        toolbox_main()
+        return capsys.readouterr().out if output == '-' else (tmp_path / output).read_text()
+
+    assert render() == '<1'
+    assert rendered == ['page.jinja2']
+    assert render() == '<1'
+    assert rendered == []
+    assert render(output='page.out') == '<1'
+    assert rendered == []
+
+    # Any change to the template closure, the data or the options misses
+    (tmp_path / 'part.jinja2').write_text('>')
+    assert render(output='page.out') == '>1'
+    assert rendered == ['page.jinja2']
+    (tmp_path / 'data.json').write_text('{"x": 2, "name": "part.jinja2"}')
+    assert render(output='page.out') == '>2'
+    assert rendered == ['page.jinja2']
+    assert render('--j2_variable_start_string', '<<', '--j2_variable_end_string', '>>',
+                  output='page.out') == '>{{ x }}'
+    assert rendered == ['page.jinja2']
+    assert render(output='page.out') == '>2'
+    assert rendered == []
+
+    # Hard linked outputs are replaced, never written through
+    assert render('--render-cache-link', output='linked.out') == '>2'
+    assert (tmp_path / 'linked.out').stat().st_nlink == 2
+    assert (tmp_path / 'page.out').stat().st_nlink == 1
+
+    # Copied when the cache is on another file system
+    def cross_device_link(src, dst):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    with monkeypatch.context() as patched:
+        patched.setattr(os, 'link', cross_device_link)
+        assert render('--render-cache-link', output='copied.out') == '>2'
+        assert (tmp_path / 'copied.out').stat().st_nlink == 1
+        (tmp_path / 'data.json').write_text('{"x": 4, "name": "part.jinja2"}')
+        assert render('--render-cache-link', output='copied.out') == '>4'
+        assert rendered == ['page.jinja2']
+    (tmp_path / 'data.json').write_text('{"x": 2, "name": "part.jinja2"}')
+
+    # Included names computed at render time are never cached
+    assert render(template='dynamic.jinja2') == '>'
+    assert render(template='dynamic.jinja2') == '>'
+    assert rendered == ['dynamic.jinja2']
+
+    assert len(list((tmp_path / 'cache').iterdir())) == 5
+    # Storing beyond the size evicts the other entries, least recently used
+    # first, but not the one just stored
+    (tmp_path / 'data.json').write_text('{"x": 3, "name": "part.jinja2"}')
+    assert render('--render-cache-size', '0.000001') == '>3'
+    assert len(list((tmp_path / 'cache').iterdir())) == 1
+    assert render('--render-cache-size', '0.000001') == '>3'
+    assert rendered == []
+
+    # The async batch mode uses the same cache
+    import jinja2_toolbox.async_render
+    original_render_to_async = jinja2_toolbox.async_render.render_to_async
+
+    async def render_to_async_spy(env, job, *args):
+        rendered.append(job.template)
+        return await original_render_to_async(env, job, *args)
+
+    monkeypatch.setattr(jinja2_toolbox.async_render, 'render_to_async', render_to_async_spy)
+    monkeypatch.setattr('sys.argv', [
+        'jinja2-toolbox', 'page.jinja2', '--data-glob', 'data.json', '--output', '{data_stem}.out',
+        '--render-cache', 'cache', '--j2_enable_async'])
+    rendered.clear()
+    toolbox_main()
+    toolbox_main()
+    assert (tmp_path / 'data.out').read_text() == '>3'
+    assert rendered == ['page.jinja2']
+
+
+def test_metrics_file(tmp_path, monkeypatch, capsys):
+    import json
+    from jinja2_toolbox.cli import read_data
+    from jinja2_toolbox.metrics import collect_metrics
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'page.jinja2').write_text('{% include "part.jinja2" %}{{ hosts | length }}')
+    (tmp_path / 'part.jinja2').write_text('é')
+    (tmp_path / 'broken.jinja2').write_text('{{ missing.name }}')
+    (tmp_path / 'data.json').write_text('{"hosts": [{"name": "a"}, {"name": "b"}]}')
+
+    def render(*extra_args):
+        monkeypatch.setattr('sys.argv', [
+            'jinja2-toolbox', 'page.jinja2', '--data', 'data.json', '--enrich', '--data-cache', 'cache',
+            '--bytecode-cache', 'bytecode', '--metrics-file', 'metrics.jsonl', *extra_args])
+        toolbox_main()
+        return [json.loads(line) for line in (tmp_path / 'metrics.jsonl').read_text().splitlines()]
+
+    records = render()
+    assert capsys.readouterr().out == 'é2'
+    job, run = records
+    assert job['kind'] == 'job'
+    assert (job['template'], job['data_files'], job['output']) == ('page.jinja2', ['data.json'], '-')
+    data, = job['data']
+    assert data['path'] == 'data.json'
+    assert (data['format'], data['size'], data['cache']) == ('json', 41, 'miss')
+    # orjson, when installed, leaves such a small file to the stdlib parser
+    assert data['backend'] == 'json'
+    # The root, the list, two mappings and their names
+    assert job['enrich_nodes'] == 6
+    assert (job['templates_compiled'], job['compile_cache']) == (2, 'miss')
+    assert job['output_bytes'] == 3
+    for name in ('template_load_seconds', 'render_seconds', 'seconds', 'peak_rss_bytes'):
+        assert job[name] > 0
+    assert data['parse_seconds'] > 0
+    assert run['kind'] == 'run' and run['jobs'] == 1 and run['environment_seconds'] > 0
+
+    # Appended, and the caches now hit
+    job = render()[2]
+    capsys.readouterr()
+    assert (job['data'][0]['cache'], job['templates_compiled'], job['compile_cache']) == ('hit', 0, 'hit')
+
+    monkeypatch.setattr('sys.argv', [
+        'jinja2-toolbox', 'page.jinja2', 'broken.jinja2', '--data-glob', 'data.json', '--output',
+        '{template_stem}.out', '--render-cache', 'rendered', '--metrics-file', 'batch.jsonl'])
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            toolbox_main()
+    records = [json.loads(line) for line in (tmp_path / 'batch.jsonl').read_text().splitlines()]
+    assert [(record['kind'], record.get('template'), record.get('render_cache')) for record in records] == [
+        ('job', 'page.jinja2', 'miss'), ('job', 'broken.jinja2', 'miss'), ('run', None, None),
+        ('job', 'page.jinja2', 'hit'), ('job', 'broken.jinja2', 'miss'), ('run', None, None)]
+    assert records[3]['output_bytes'] == 3
+    assert records[4]['error'] == "UndefinedError: 'missing' is undefined"
+    assert records[5]['error'] == 'RuntimeError: 1 of 2 render jobs failed'
+
+    # The same hooks report to library code
+    with collect_metrics(step='load') as metrics:
+        read_data('data.json', None)
+    assert metrics['step'] == 'load' and metrics['data'][0]['size'] == 41
+    read_data('data.json', None)
+    assert len(metrics['data']) == 1
+
+
+def test_streamed_output_is_flushed_per_chunk():
+    class Stdout(io.StringIO):
+        writes_flushed = 0
+
+        def flush(self):
+            self.writes_flushed += 1
+
+    stdout = Stdout()
+    write_output('-', iter(('a', 'b', 'c')), stdout, flush=True)
+    assert stdout.getvalue() == 'abc'
+    assert stdout.writes_flushed == 3
+
+
+def test_async_environment_streams(tmp_path, monkeypatch):
+    # Writes seen by the template while it renders: none if the whole output
+    # was rendered before the first write
+    class Stdout(io.StringIO):
+        writes = 0
+
+        def write(self, chunk):
+            self.writes += 1
+            return super().write(chunk)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / 'probe_ext.py').write_text(
+        'import sys, time\n'
+        'from jinja2.ext import Extension\n'
+        '\n'
+        'def writes(value):\n'
+        '    time.sleep(0.02)\n'
+        '    return sys.stdout.writes\n'
+        '\n'
+        'class ProbeExt(Extension):\n'
+        '    def __init__(self, environment):\n'
+        '        super().__init__(environment)\n'
+        '        environment.filters["writes"] = writes\n')
+    (tmp_path / 'template.jinja2').write_text('{% for i in x %}{{ i | writes }},{% endfor %}')
+    (tmp_path / 'data.json').write_text('{"x": [1, 2, 3, 4, 5]}')
+
+    stdout = Stdout()
+    monkeypatch.setattr('sys.stdout', stdout)
+    monkeypatch.setattr('sys.argv', [
+        'jinja2-toolbox', 'template.jinja2', '--data', 'data.json', '--stream', '--stream-buffer', '1',
+        '--j2_enable_async', '--j2_extensions', 'probe_ext.ProbeExt'])
+    toolbox_main()
+    seen = [int(writes) for writes in stdout.getvalue().rstrip(',').split(',')]
+    assert seen[-1] > 0
+    assert stdout.writes > 5
+
+
+def test_stream_output_waits_for_a_slow_writer(monkeypatch):
+    import asyncio
+    import time
+    from jinja2_toolbox import async_render
+
+    monkeypatch.setattr(async_render, '_HANDOVER_CHUNKS', 4)
+    produced = written = backlog = 0
+
+    class SlowStdout(io.StringIO):
+        def write(self, chunk):
+            nonlocal written
+            time.sleep(0.002)
+            written += 1
+            return super().write(chunk)
+
+    async def chunks():
+        nonlocal produced, backlog
+        for i in range(200):
+            produced += 1
+            backlog = max(backlog, produced - written)
+            yield f'{i},'
+
+    stdout = SlowStdout()
+    asyncio.run(async_render.stream_output('-', chunks(), stdout, 1, False))
+    assert stdout.getvalue() == ''.join(f'{i},' for i in range(200))
+    # The handed over chunks, the one the writer holds and the one rendered
+    assert backlog <= 4 + 2
+
+    # A writer failing while the render waits for it ends the render
+    class FailingStdout(io.StringIO):
+        def write(self, chunk):
+            time.sleep(0.01)
+            raise OSError('broken pipe')
+
+    with pytest.raises(OSError, match='broken pipe'):
+        asyncio.run(async_render.stream_output('-', chunks(), FailingStdout(), 1, False))
+
+
+def test_atomic_output(tmp_path):
+    out = tmp_path / 'out.txt'
+
+    write_output(str(out), ('a', 'b'), io.StringIO(), atomic=True)
+    assert out.read_text() == 'ab'
+    out.chmod(0o640)
+    written = out.stat()
+
+    write_output(str(out), ('ab',), io.StringIO(), atomic=True)
+    assert out.stat().st_ino == written.st_ino
+    assert out.stat().st_mtime_ns == written.st_mtime_ns
+
+    write_output(str(out), ('abc',), io.StringIO(), atomic=True)
+    assert out.read_text() == 'abc'
+    assert out.stat().st_ino != written.st_ino
+    assert out.stat().st_mode & 0o777 == 0o640
+
+    def failing_chunks():
+        yield 'partial'
+        raise RuntimeError('render failed')
+
+    with pytest.raises(RuntimeError):
+        write_output(str(out), failing_chunks(), io.StringIO(), atomic=True)
+    assert out.read_text() == 'abc'
+    assert [p.name for p in tmp_path.iterdir()] == ['out.txt']
+
+
+PROVIDER_SAMPLES = (
+    (JsonProvider, '{"a": [1, 2.5, "x", true, null, {"b": "\\u00e9"}], "c": 1e3, "d": -7}'),
+    (YamlProvider, '\n'.join((
+        'a: [1, 2.5, x, true, null, {b: é}]',
+        'c: 1.0e+3',
+        'd: -7',
+        'e: &anchor {f: 0x10}',
+        'g: *anchor',
+        'h: |',
+        '  multi',
+        '  line',
+    ))),
+    (TomlProvider, '\n'.join((
+        'a = [1, 2, 3]',
+        'b = "é"',
+        'c = 1e3',
+        'd = 1979-05-27T07:32:00Z',
+        '[e]',
+        'f = { g = true }',
+    ))),
+)
+
+
+@pytest.mark.parametrize(
+    'provider, backend, sample',
+    [
+        (provider, backend, sample)
+        for provider, sample in PROVIDER_SAMPLES
+        for backend, available in provider.BACKENDS.items()
+        if available()
+    ],
+    ids=lambda value: getattr(value, '__name__', value if len(str(value)) < 10 else ''))
+def test_provider_backends_parity(tmp_path, provider, backend, sample):
+    from jinja2_toolbox.mapped import mapped_file
+
+    reference_backend = list(provider.BACKENDS)[-1]
+    reference = provider([reference_backend]).load(io.StringIO(sample))
+    loaded = provider([backend]).load(io.StringIO(sample))
+    assert loaded == reference
+
+    assert provider([backend]).load_buffer(sample.encode()) == reference
+    (tmp_path / 'sample').write_text(sample)
+    with mapped_file(tmp_path / 'sample') as data:
+        assert provider([backend]).load_buffer(data) == reference
+
+
+def test_provider_fastest_backend_by_default():
+    for provider, _sample in PROVIDER_SAMPLES:
+        available = [name for name, check in provider.BACKENDS.items() if check()]
+        assert provider().backend == available[0]
+        assert provider(['unrelated', available[-1]]).backend == available[-1]
+
+
+def test_orjson_falls_back_to_stdlib(monkeypatch):
+    # orjson is an optional parser, not a dependency
+    pytest.importorskip('orjson')
+    provider = JsonProvider(['orjson'])
+    assert provider.load(io.StringIO('[1]')) == [1]
+    assert provider.parsed_with == 'orjson'
+    assert math.isnan(provider.load(io.StringIO('{"a": NaN}'))['a'])
+    assert provider.parsed_with == 'json'
+    assert provider.load(io.StringIO('[123456789012345678901234567890]')) == [
+        123456789012345678901234567890]
+    with pytest.raises(ValueError):
+        provider.load(io.StringIO('{"a": '))
+
+    # The wide numbers are found across the chunks buffers are scanned in
+    monkeypatch.setattr('jinja2_toolbox.json_provider._SCAN_CHUNK', 16)
+    for padding in range(16):
+        data = f'[{" " * padding}123456789012345678901234567890]'.encode()
+        assert provider.load_buffer(data) == [123456789012345678901234567890]
+    assert math.isnan(provider.load_buffer(b'{"a": NaN}')['a'])
+    assert provider.parsed_with == 'json'
+
+    # Below _ORJSON_MIN_SIZE the stdlib parses the file, unless orjson is forced
+    provider = JsonProvider()
+    assert provider.backend == 'orjson'
+    assert provider.load_buffer(b'[1]') == [1]
+    assert provider.parsed_with == 'json'
+
+
+def test_json_without_orjson(monkeypatch):
+    monkeypatch.setitem(JsonProvider.BACKENDS, 'orjson', lambda: False)
+    provider = JsonProvider()
+    assert provider.backend == 'json'
+    assert provider.load_buffer(b'{"a": [1]}') == {'a': [1]}
+    assert provider.parsed_with == 'json'
+    with pytest.raises(RuntimeError, match='orjson backend for json data is not available'):
+        JsonProvider(['orjson'])
+
+
+def test_data_backends_match_providers():
+    from jinja2_toolbox.cli import DATA_BACKENDS, DATA_PROVIDERS, get_provider
+
+    backends = {
+        name
+        for data_type in DATA_PROVIDERS
+        for name in get_provider(data_type).BACKENDS
+    }
+    assert set(DATA_BACKENDS) == backends
+
+
+def test_json_render_does_not_import_other_parsers(tmp_path):
+    (tmp_path / 'template.jinja2').write_text('{{ x }}')
+    (tmp_path / 'data.json').write_text('{"x": 1}')
+
+    script = (
+        'import sys; '
+        'sys.argv = ["jinja2-toolbox", "template.jinja2", "--data", "data.json"]; '
+        'from jinja2_toolbox.cli import main; main(); '
+        'print(*sys.modules, file=sys.stderr)'
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', script],
+        cwd=tmp_path, capture_output=True, text=True, check=True,
+        env={**os.environ, 'PYTHONPATH': str(Path(__file__).parent.parent)})
+
+    assert result.stdout == '1'
+    imported = set(result.stderr.split())
+    assert 'jinja2_toolbox.json_provider' in imported
+    for module in ('yaml', 'toml', 'tomllib', 'jinja2_toolbox.yaml_provider',
+                   'jinja2_toolbox.toml_provider', 'concurrent.futures'):
+        assert module not in imported
+
+
+@pytest.mark.parametrize('flags', [(), ('--j2_enable_async',)])
+def test_render_server(tmp_path, monkeypatch, flags):
+    import argparse
+    import threading
+    from jinja2_toolbox import cli, server
+    from jinja2_toolbox.client import request_render
+
+    (tmp_path / 'templates').mkdir()
+    (tmp_path / 'templates' / 'a.jinja2').write_text('{{ x }} {{ x.parent | length }}')
+    (tmp_path / 'data.json').write_text('{"x": 1}')
+    socket_path = str(tmp_path / 'render.sock')
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--stream-buffer', type=int, default=256)
+    ap.add_argument('--data-cache-entries', type=int, default=4)
+    cli.add_data_args(ap)
+    cli.add_environment_args(ap)
+    args = ap.parse_args(['--template-dir', str(tmp_path / 'templates'), *flags])
+
+    # Private from the start, not chmod-ed once bound
+    umask = os.umask(0o022)
+    try:
+        with monkeypatch.context() as patched:
+            patched.setattr(os, 'chmod', lambda *args: None)
+            render_server = server.RenderServer(socket_path, cli.environment_from_args(args), args)
+    finally:
+        os.umask(umask)
+    assert os.stat(socket_path).st_mode & 0o777 == 0o600
+    thread = threading.Thread(target=render_server.serve_forever)
+    thread.start()
+    try:
+        def render(**kwargs):
+            return ''.join(request_render(socket_path, 'a.jinja2', **kwargs))
+
+        data = str(tmp_path / 'data.json')
+        assert render(data=data, enrich=True) == '1 1'
+        assert render(data_content='{"x": [1, 2]}', data_format='json', enrich=True) == '[1, 2] 1'
+
+        (tmp_path / 'data.json').write_text('{"x": 22}')
+        assert render(data=data, enrich=True) == '22 1'
+
+        (tmp_path / 'templates' / 'a.jinja2').write_text('x={{ x }}')
+        os.utime(tmp_path / 'templates' / 'a.jinja2', (0, 0))
+        assert render(data=data) == 'x=22'
+
+        (tmp_path / 'override.json').write_text('{"x": 3}')
+        assert render(data=[data, str(tmp_path / 'override.json')]) == 'x=3'
+
+        with pytest.raises(RuntimeError) as e_info:
+            render(data_content='{}', data_format='json')
+        assert e_info.value.args[0] == "UndefinedError: 'x' is undefined"
+
+        with pytest.raises(RuntimeError) as e_info:
+            render(data_content='{}')
+        assert e_info.value.args[0] == 'RuntimeError: The data format must be specified for inline data'
+
+        with pytest.raises(RuntimeError):
+            server.prepare_socket_path(socket_path)
+    finally:
+        render_server.shutdown()
+        render_server.server_close()
+        thread.join()
+
+    assert not os.path.exists(socket_path)
+    server.prepare_socket_path(socket_path)
+
+
+def test_render_server_stops_on_sigterm(tmp_path):
+    import signal
+    import time
+
+    socket_path = tmp_path / 'render.sock'
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'jinja2_toolbox', 'serve', '--socket', str(socket_path)],
+        cwd=tmp_path, env={**os.environ, 'PYTHONPATH': str(Path(__file__).parent.parent)})
+    try:
+        deadline = time.monotonic() + 10
+        while not socket_path.exists():
+            assert process.poll() is None and time.monotonic() < deadline
+            time.sleep(0.05)
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=10) == 128 + signal.SIGTERM
+    finally:
+        process.kill()
+    assert not socket_path.exists()
+
+
+def test_watch_renders_affected_jobs(tmp_path, monkeypatch):
+    from jinja2_toolbox.cli import (add_data_args, add_environment_args, add_render_args, environment_from_args,
+                                    load_context, render_job)
+    from jinja2_toolbox.batch import RenderJob, run_jobs
+    from jinja2_toolbox.watch import Watcher
+    import argparse
+
+    monkeypatch.chdir(tmp_path)
+    files = {
+        'base.jinja2': '[{% block body %}{% endblock %}]',
+        'partial.jinja2': 'partial',
+        'a.jinja2': '{% extends "base.jinja2" %}{% block body %}a {% include "partial.jinja2" %}{% endblock %}',
+        'b.jinja2': '{% extends "base.jinja2" %}{% block body %}b {{ x }}{% endblock %}',
+        'c.jinja2': 'c',
+        'data.json': '{"x": 1}',
+    }
+    for name, content in files.items():
+        (tmp_path / name).write_text(content)
+
+    def touch(name, content):
+        # A distinct mtime, as a later edit would have
+        path = tmp_path / name
+        mtime = path.stat().st_mtime_ns if path.exists() else 0
+        path.write_text(content)
+        os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+
+    # The defaults of the real options, new ones included
+    ap = argparse.ArgumentParser()
+    add_render_args(ap)
+    add_data_args(ap)
+    add_environment_args(ap)
+    args = ap.parse_args([])
+    env = environment_from_args(args)
+    jobs = [RenderJob(name, 'data.json', f'{name}.out') for name in ('a.jinja2', 'b.jinja2', 'c.jinja2')]
+    rendered = []
+
+    def render_jobs(jobs):
+        rendered.append([job.template for job in jobs])
+        return run_jobs(jobs, lambda job, stdout: render_job(env, job, args, load_context, stdout), io.StringIO())
+
+    watcher = Watcher(env, jobs, render_jobs, io.StringIO())
+    watcher.render(jobs)
+    assert (tmp_path / 'a.jinja2.out').read_text() == '[a partial]'
+
+    watcher.step(watcher.poll())
+    assert rendered[1:] == []
+
+    touch('partial.jinja2', 'PARTIAL')
+    watcher.step(watcher.poll())
+    assert rendered[-1] == ['a.jinja2']
+    assert (tmp_path / 'a.jinja2.out').read_text() == '[a PARTIAL]'
+
+    touch('base.jinja2', '<{% block body %}{% endblock %}>')
+    watcher.step(watcher.poll())
+    assert rendered[-1] == ['a.jinja2', 'b.jinja2']
+    assert (tmp_path / 'b.jinja2.out').read_text() == '<b 1>'
+
+    touch('data.json', '{"x": 2}')
+    watcher.step(watcher.poll())
+    assert rendered[-1] == ['a.jinja2', 'b.jinja2', 'c.jinja2']
+
+    # References added by an edit, to a template that doesn't exist yet
+    touch('c.jinja2', 'c {% include "new.jinja2" %}')
+    watcher.step(watcher.poll())
+    assert rendered[-1] == ['c.jinja2']
+    touch('new.jinja2', 'new')
+    watcher.step(watcher.poll())
+    assert rendered[-1] == ['c.jinja2']
+    assert (tmp_path / 'c.jinja2.out').read_text() == 'c new'